@@ -1,5 +1,7 @@
-from .base import Route, RouteBase, NonIterableRouteBase, before, after
-from .template import TemplateRoute, XHRPartialRoute, ROCARoute
+from .base import (Route, RouteBase, NonIterableRouteBase, StreamingRoute,
+                   before, after)
+from .template import (TemplateRoute, StreamingTemplateRoute, XHRPartialRoute,
+                       ROCARoute)
 from .forms import FormRoute, TemplateFormRoute, XHRPartialFormRoute
 
 
@@ -11,7 +13,9 @@ __all__ = (
     'Route',
     'RouteBase',
     'NonIterableRouteBase',
+    'StreamingRoute',
     'TemplateRoute',
+    'StreamingTemplateRoute',
     'XHRPartialRoute',
     'ROCARoute',
     'FormRoute',
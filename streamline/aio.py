@@ -0,0 +1,211 @@
+"""
+This module contains mixins and classes that allow route handler methods and
+hooks to be written as coroutines (``async def``).
+
+Coroutines are executed on an event loop that runs in a separate thread (one
+loop per worker process), while the WSGI thread which handles the request
+waits for the result. This allows the handler to run several operations
+concurrently (e.g., using :py:func:`asyncio.gather`) without changing the way
+the response is created and rendered.
+
+.. note::
+    This module requires Python 3.5 or newer.
+
+.. warning::
+    :py:data:`bottle.request` and :py:data:`bottle.response` are thread-local
+    objects which are not available in the event loop thread. Coroutines must
+    use the ``request`` and ``response`` attributes of the route handler
+    object instead, which are swapped for non-local copies while the coroutine
+    runs.
+"""
+
+import asyncio
+import functools
+import os
+import threading
+
+import bottle
+
+from .base import RouteBase
+from .template import TemplateRoute, XHRPartialRoute
+from .forms import FormRoute, TemplateFormRoute, XHRPartialFormRoute
+
+
+class EventLoopThread(object):
+    """
+    Event loop running in a daemon thread. The loop and the thread are
+    started when the loop is first requested, and restarted if the process
+    has been forked since.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start a new event loop in a daemon thread.
+        """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name='streamline-event-loop')
+        self.thread.daemon = True
+        self.thread.start()
+        self.pid = os.getpid()
+
+    def get_loop(self):
+        """
+        Return the event loop, starting it if necessary.
+        """
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.start()
+        return self.loop
+
+    def run(self, coro, timeout=None):
+        """
+        Run the coroutine on the event loop and block until it completes or
+        ``timeout`` seconds elapse. The result of the coroutine is returned,
+        and any exceptions it raises are propagated. If the timeout expires,
+        the coroutine is cancelled and
+        :py:class:`concurrent.futures.TimeoutError` is raised.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+
+#: Event loop shared by all async route handlers in the process
+event_loop = EventLoopThread()
+
+
+def wrap_handler(handler):
+    """
+    Wrap a compiled verb handler so that a coroutine it returns is run on the
+    event loop, and its result used as the return value.
+    """
+    @functools.wraps(handler)
+    def wrapper(self, *args, **kwargs):
+        return self.resolve(handler(self, *args, **kwargs))
+    return wrapper
+
+
+class AsyncMixin(object):
+    """
+    Mixin that allows handler methods and hooks of a route handler class to
+    be coroutine functions. It must be placed before the route handler class
+    in the list of bases.
+
+    Example::
+
+        class Dashboard(AsyncMixin, TemplateRoute):
+            template_name = 'dashboard'
+
+            async def get(self):
+                stats, news = await asyncio.gather(get_stats(), get_news())
+                return dict(stats=stats, news=news)
+
+    Regular methods keep working as before. Any handler (or method invoked by
+    the handler, such as :py:meth:`~streamline.forms.FormMixin.form_valid`)
+    that returns a coroutine will have the coroutine run on the event loop.
+    """
+
+    #: Event loop used to run the coroutines
+    event_loop = event_loop
+
+    #: Maximum number of seconds to wait for a coroutine to finish, or
+    #: ``None`` to wait indefinitely
+    coroutine_timeout = None
+
+    @classmethod
+    def compile_class(cls):
+        super(AsyncMixin, cls).compile_class()
+        cls._handlers = dict((verb, wrap_handler(handler))
+                             for verb, handler in cls._handlers.items())
+
+    def run_coroutine(self, coro):
+        """
+        Run the coroutine on the event loop and return its result. While the
+        coroutine runs, the ``request`` and ``response`` attributes are
+        replaced by non-local copies of the request and response objects.
+        Changes made to the copy of the response are applied to the original
+        response once the coroutine finishes.
+        """
+        request, response = self.request, self.response
+        self.request = bottle.BaseRequest(request.environ)
+        self.response = response.copy(cls=self.HTTPResponse)
+        try:
+            return self.event_loop.run(coro, self.coroutine_timeout)
+        finally:
+            self.response.apply(response)
+            self.request, self.response = request, response
+
+    def resolve(self, value):
+        """
+        Return the result of running ``value`` on the event loop if it is a
+        coroutine, or ``value`` itself otherwise.
+        """
+        if asyncio.iscoroutine(value):
+            return self.run_coroutine(value)
+        return value
+
+    def call_hook(self, hook):
+        return self.resolve(hook(self))
+
+
+class AsyncRouteBase(AsyncMixin, RouteBase):
+    """
+    Provides the same functionality as :py:class:`~streamline.base.RouteBase`
+    with support for coroutine handlers.
+    """
+    pass
+
+
+class AsyncTemplateRoute(AsyncMixin, TemplateRoute):
+    """
+    Provides the same functionality as
+    :py:class:`~streamline.template.TemplateRoute` with support for coroutine
+    handlers.
+    """
+    pass
+
+
+class AsyncXHRPartialRoute(AsyncMixin, XHRPartialRoute):
+    """
+    Provides the same functionality as
+    :py:class:`~streamline.template.XHRPartialRoute` with support for
+    coroutine handlers.
+    """
+    pass
+
+
+class AsyncFormRoute(AsyncMixin, FormRoute):
+    """
+    Provides the same functionality as :py:class:`~streamline.forms.FormRoute`
+    with support for coroutine handlers.
+    """
+    pass
+
+
+class AsyncTemplateFormRoute(AsyncMixin, TemplateFormRoute):
+    """
+    Provides the same functionality as
+    :py:class:`~streamline.forms.TemplateFormRoute` with support for coroutine
+    handlers.
+    """
+    pass
+
+
+class AsyncXHRPartialFormRoute(AsyncMixin, XHRPartialFormRoute):
+    """
+    Provides the same functionality as
+    :py:class:`~streamline.forms.XHRPartialFormRoute` with support for
+    coroutine handlers.
+    """
+    pass
@@ -0,0 +1,214 @@
+"""
+This module contains an ASGI adapter which allows applications built with
+streamline route handler classes to be served by ASGI servers.
+
+The adapter translates the ASGI connection scope into a WSGI environment and
+lets the bottle application dispatch the request as usual, so route
+registration, plugins, hooks, and the ``request`` and ``response`` objects
+used by the handlers all work the same way as under a WSGI server. Since the
+handlers are regular (blocking) code, the application and iteration over the
+response body are run in a thread pool as a single job, so that they share
+the thread to which bottle binds the request, while the body chunks are sent
+to the client from the event loop as they are produced.
+
+Example::
+
+    import bottle
+    from streamline.asgi import ASGIApplication
+
+    MyRoute.route('/')
+    application = ASGIApplication(bottle.default_app())
+
+.. note::
+    This module requires Python 3.5 or newer.
+"""
+
+import asyncio
+import sys
+import tempfile
+import threading
+
+import bottle
+
+
+#: Marks the end of the response body iterator
+END = object()
+
+
+class ASGIApplication(object):
+    """
+    ASGI application that serves the bottle application ``app``. If ``app``
+    is omitted, the bottle's default app is used.
+
+    Blocking calls are made using ``executor``, which defaults to the event
+    loop's default executor.
+    """
+
+    #: Request bodies larger than this number of bytes are spooled to disk
+    max_memory_body = bottle.BaseRequest.MEMFILE_MAX
+
+    #: Maximum number of body chunks produced ahead of sending them
+    max_pending_chunks = 16
+
+    def __init__(self, app=None, executor=None):
+        self.app = app or bottle.default_app()
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported scope type {}'.format(scope['type']))
+
+    async def handle_lifespan(self, receive, send):
+        """
+        Acknowledge the lifespan startup and shutdown events.
+        """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        """
+        Read the request body and return a file object positioned at its
+        beginning.
+        """
+        body = tempfile.SpooledTemporaryFile(max_size=self.max_memory_body)
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            body.write(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        body.seek(0)
+        return body
+
+    def get_environ(self, scope, body):
+        """
+        Return a WSGI environment dict for the ASGI connection scope and
+        request body file.
+        """
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            # PEP 3333 strings are bytes decoded as latin-1
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version',
+                                                          '1.1')),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'asgi.scope': scope,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            value = value.decode('latin1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            if name in environ:
+                value = environ[name] + ',' + value
+            environ[name] = value
+        if body is not None:
+            # The server has already decoded any transfer encoding, so the
+            # body size is always known at this point
+            body.seek(0, 2)
+            environ['CONTENT_LENGTH'] = str(body.tell())
+            environ.pop('HTTP_TRANSFER_ENCODING', None)
+            body.seek(0)
+        return environ
+
+    def run_app(self, environ, start_response, put, slots, cancelled):
+        """
+        Call the application and iterate over the response body, passing each
+        chunk to ``put``, followed by :py:data:`END` or the exception that
+        was raised. This runs as a single job in the executor, because bottle
+        binds ``request`` and ``response`` to the thread which calls the
+        application, and lazily produced bodies still use them.
+
+        A slot is acquired from the ``slots`` semaphore before each chunk is
+        passed on, so that no more than
+        :py:attr:`~ASGIApplication.max_pending_chunks` chunks are produced
+        ahead of the client. Iteration stops when ``cancelled`` is set.
+        """
+        try:
+            iterable = self.app(environ, start_response)
+            try:
+                for chunk in iterable:
+                    slots.acquire()
+                    if cancelled.is_set():
+                        break
+                    put(chunk)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        except BaseException as exc:
+            put(exc)
+        else:
+            put(END)
+
+    async def handle_http(self, scope, receive, send):
+        """
+        Dispatch the request to the bottle application and send the response
+        back to the client.
+        """
+        loop = asyncio.get_event_loop()
+        body = await self.read_body(receive)
+        environ = self.get_environ(scope, body)
+        start = {}
+        queue = asyncio.Queue()
+        slots = threading.Semaphore(self.max_pending_chunks)
+        cancelled = threading.Event()
+
+        def start_response(status, headers, exc_info=None):
+            start['status'] = int(status.split(' ', 1)[0])
+            start['headers'] = [(k.lower().encode('latin1'),
+                                 v.encode('latin1')) for k, v in headers]
+
+        def put(item):
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        async def get():
+            item = await queue.get()
+            if isinstance(item, BaseException):
+                raise item
+            return item
+
+        job = loop.run_in_executor(self.executor, self.run_app, environ,
+                                   start_response, put, slots, cancelled)
+        try:
+            chunk = await get()
+            await send({'type': 'http.response.start',
+                        'status': start['status'],
+                        'headers': start['headers']})
+            while chunk is not END:
+                if chunk:
+                    await send({'type': 'http.response.body',
+                                'body': chunk,
+                                'more_body': True})
+                slots.release()
+                chunk = await get()
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            # Stop the iteration if the response was not sent completely
+            cancelled.set()
+            slots.release()
+            await job
+            body.close()
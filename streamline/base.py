@@ -3,11 +3,16 @@ This module contains the base class which is used by all other class-based
 route handler classes.
 """
 
+import calendar
+import datetime
 import functools
+import hashlib
+import types
 
 import bottle
 
 from . import utils
+from .timing import Timing, clock, get_hook_name
 
 
 METHODS = (
@@ -18,8 +23,271 @@ METHODS = (
     'delete',
 )
 
+#: Methods for which conditional requests are handled
+CONDITIONAL_METHODS = ('get', 'head')
 
-class RouteBase(object):
+#: Names of class attributes which make up the HTTP cache policy
+CACHE_POLICY = (
+    'max_age',
+    's_maxage',
+    'cache_visibility',
+    'stale_while_revalidate',
+    'stale_if_error',
+    'vary',
+    'surrogate_keys',
+)
+
+#: Marker that can be yielded by :py:class:`StreamingRoute` handlers to flush
+#: the buffered chunks immediately
+FLUSH = object()
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+#: Names of class attributes which hold the lists of hooks
+HOOK_ATTRS = ('before_hooks', 'after_hooks')
+
+
+class HookList(list):
+    """
+    List of hooks stored in :py:attr:`RouteBase.before_hooks` and
+    :py:attr:`RouteBase.after_hooks`. Modifying any hook list increments
+    the ``version`` class attribute, and route handler classes whose hooks
+    were compiled for an older version compile them again before handling
+    the next request, so hooks appended to the lists directly take effect.
+    """
+
+    #: Incremented whenever a hook list is modified
+    version = 0
+
+    #: Whether the hooks are added to those of the base classes rather than
+    #: replacing them (only lists created by :py:meth:`RouteBase.add_hook`)
+    extends = False
+
+
+def _hook_list_mutator(name):
+    method = getattr(list, name)
+
+    def mutator(self, *args):
+        result = method(self, *args)
+        HookList.version += 1
+        return result
+    mutator.__name__ = name
+    return mutator
+
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'clear', 'sort',
+              'reverse', '__setitem__', '__delitem__', '__iadd__', '__imul__',
+              '__setslice__', '__delslice__'):
+    if hasattr(list, _name):
+        setattr(HookList, _name, _hook_list_mutator(_name))
+del _name
+
+
+def collect_hooks(cls, attr):
+    """
+    Return the hooks stored in the ``attr`` attribute of ``cls`` and its base
+    classes, with those of the base classes first. A list of hooks which is
+    assigned to the attribute replaces the hooks of the base classes, and a
+    list created by :py:meth:`RouteBase.add_hook` extends them.
+    """
+    lists = []
+    for klass in cls.__mro__:
+        hooks = klass.__dict__.get(attr)
+        if hooks is None:
+            continue
+        lists.append(hooks)
+        if not getattr(hooks, 'extends', False):
+            break
+    return [hook for hooks in reversed(lists) for hook in hooks]
+
+
+class RouteMeta(type):
+    """
+    Metaclass for :py:class:`RouteBase` and its subclasses. It invokes the
+    :py:meth:`~RouteBase.compile_class` class method when a class is created,
+    so that information which only depends on the class (the handler for each
+    HTTP verb, route name, and so on) is calculated once rather than on every
+    request.
+
+    Setting a public attribute on a class (e.g., patching a verb method)
+    recompiles the class and all of its subclasses.
+    """
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+        for attr in HOOK_ATTRS:
+            if attr in attrs and not isinstance(attrs[attr], HookList):
+                type.__setattr__(cls, attr, HookList(attrs[attr]))
+        cls.compile_class()
+
+    def __setattr__(cls, name, value):
+        if name in HOOK_ATTRS and not isinstance(value, HookList):
+            value = HookList(value)
+        type.__setattr__(cls, name, value)
+        cls._recompile(name)
+
+    def __delattr__(cls, name):
+        type.__delattr__(cls, name)
+        cls._recompile(name)
+
+    def _recompile(cls, name):
+        if name.startswith('_') and name not in ('__module__', '__name__'):
+            return
+        cls.compile_class()
+        for subclass in cls.__subclasses__():
+            subclass._recompile(name)
+
+
+def parse_etags(value):
+    """
+    Return the list of entity tags in the value of ``If-None-Match`` header,
+    with weak tags converted to strong ones.
+    """
+    return [etag.strip().replace('W/', '', 1)
+            for etag in value.split(',') if etag.strip()]
+
+
+def to_timestamp(value):
+    """
+    Convert a :py:class:`~datetime.datetime` object (naive values are
+    assumed to be UTC) or a number to an integer timestamp.
+    """
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple())
+    return int(value)
+
+
+def build_cache_headers(max_age=None, s_maxage=None, cache_visibility=None,
+                        stale_while_revalidate=None, stale_if_error=None,
+                        vary=(), surrogate_keys=()):
+    """
+    Return a list of ``(name, value)`` header pairs that express the cache
+    policy. See :py:attr:`RouteBase.max_age` and related attributes. Raises
+    :py:exc:`TypeError` if ``vary`` or ``surrogate_keys`` is a string rather
+    than a sequence of strings.
+    """
+    for name, value in (('vary', vary), ('surrogate_keys', surrogate_keys)):
+        if isinstance(value, (bytes, str, text_type)):
+            raise TypeError('{} must be a sequence of strings, not a '
+                            'string: {!r}'.format(name, value))
+    directives = []
+    if cache_visibility is not None:
+        directives.append(cache_visibility)
+    for name, value in (('max-age', max_age),
+                        ('s-maxage', s_maxage),
+                        ('stale-while-revalidate', stale_while_revalidate),
+                        ('stale-if-error', stale_if_error)):
+        if value is not None:
+            directives.append('{}={}'.format(name, int(value)))
+    headers = []
+    if directives:
+        headers.append(('Cache-Control', ', '.join(directives)))
+    if vary:
+        headers.append(('Vary', ', '.join(vary)))
+    if surrogate_keys:
+        headers.append(('Surrogate-Key', ' '.join(surrogate_keys)))
+    return headers
+
+
+def find_class_attr(cls, name):
+    """
+    Return the raw value of class attribute ``name`` as found in the class
+    dict of ``cls`` or one of its bases, without invoking the descriptor
+    protocol. Returns ``None`` if the attribute does not exist.
+    """
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return klass.__dict__[name]
+    return None
+
+
+class Hook(object):
+    """
+    Wrapper for hook functions which are registered with additional options.
+    Hooks with name and/or path prefixes are only invoked for routes whose
+    name and path start with the specified prefixes. After-create hooks with
+    the ``always`` flag are also invoked when a before-create hook
+    short-circuits the request.
+    """
+
+    def __init__(self, fn, name=None, path=None, always=False):
+        self.fn = fn
+        self.name = name
+        self.path = path
+        self.always = always
+
+    def matches(self, names, paths):
+        """
+        Return ``True`` if any of the route names matches the name prefix, and
+        any of the route paths matches the path prefix.
+        """
+        if self.name is not None:
+            if not any(n.startswith(self.name) for n in names):
+                return False
+        if self.path is not None:
+            if not any(p.startswith(self.path) for p in paths):
+                return False
+        return True
+
+    def __call__(self, route):
+        return self.fn(route)
+
+    def __repr__(self):
+        return '<Hook {!r} name={!r} path={!r} always={!r}>'.format(
+            self.fn, self.name, self.path, self.always)
+
+
+def make_hook(fn, name=None, path=None, always=False):
+    """
+    Return ``fn`` wrapped in :py:class:`Hook` if any of the options is
+    specified, or ``fn`` itself otherwise.
+    """
+    if name is None and path is None and not always:
+        return fn
+    return Hook(fn, name, path, always)
+
+
+def filter_hooks(hooks, names, paths, always=False):
+    """
+    Return a tuple of hook functions from ``hooks`` that apply to a route
+    with specified names and paths. If ``always`` is ``True``, only hooks
+    with the ``always`` flag are included.
+    """
+    selected = []
+    for hook in hooks:
+        if not isinstance(hook, Hook):
+            if not always:
+                selected.append(hook)
+        elif hook.matches(names, paths) and (hook.always or not always):
+            selected.append(hook.fn)
+    return tuple(selected)
+
+
+def compile_handler(cls, name):
+    """
+    Return a function that invokes the ``name`` method of the route handler
+    object that is passed to it as first argument, followed by the remaining
+    arguments. Returns ``None`` if the class has no such attribute.
+
+    Plain functions are returned as is, so calling them involves no attribute
+    lookup. Other attributes (static methods, mock objects, etc) are looked up
+    on the object at call time.
+    """
+    attr = find_class_attr(cls, name)
+    if attr is None:
+        return None
+    if isinstance(attr, types.FunctionType):
+        return attr
+
+    def handler(self, *args, **kwargs):
+        return getattr(self, name)(*args, **kwargs)
+    return handler
+
+
+class RouteBase(utils.with_metaclass(RouteMeta, object)):
     """
     Base class for class-based route handlers. This class produces iterable
     objects which are initialized with request parameters, and perform the
@@ -53,10 +321,54 @@ class RouteBase(object):
     redirect = staticmethod(bottle.redirect)
     #: alias of :py:class:`bottle.HTTPResponse`
     HTTPResponse = bottle.HTTPResponse
+    #: alias of :py:class:`bottle.HTTPError`
+    HTTPError = bottle.HTTPError
 
+    #: List of before-create hooks registered on this class. Hooks registered
+    #: on a class apply to it and all of its subclasses. A subclass which
+    #: assigns its own list replaces the hooks of its base classes.
     before_hooks = []
+    #: List of after-create hooks registered on this class, in the order in
+    #: which they were registered (they are invoked in reverse order). A
+    #: subclass which assigns its own list replaces the hooks of its base
+    #: classes.
     after_hooks = []
 
+    #: Whether time spent in request handling phases is recorded
+    record_timing = False
+    #: Whether the recorded timing is sent in the ``Server-Timing`` header
+    #: (has no effect unless :py:attr:`~RouteBase.record_timing` is enabled)
+    server_timing = False
+    #: :py:class:`~streamline.metrics.MetricsRegistry` object which collects
+    #: the request metrics (see :py:func:`streamline.metrics.install`).
+    #: Setting this attribute implies timing is recorded.
+    metrics = None
+
+    #: Number of seconds for which clients may cache responses to GET
+    #: requests (``max-age`` directive of ``Cache-Control`` header)
+    max_age = None
+    #: Number of seconds for which shared caches (proxies and CDNs) may cache
+    #: the responses (``s-maxage`` directive)
+    s_maxage = None
+    #: ``'public'`` or ``'private'``, or ``None`` to omit the directive
+    cache_visibility = None
+    #: Number of seconds for which caches may serve stale responses while
+    #: revalidating them (``stale-while-revalidate`` directive)
+    stale_while_revalidate = None
+    #: Number of seconds for which caches may serve stale responses when the
+    #: server fails (``stale-if-error`` directive)
+    stale_if_error = None
+    #: Names of request headers listed in the ``Vary`` header
+    vary = ()
+    #: Surrogate keys listed in the ``Surrogate-Key`` header, which CDNs use
+    #: to purge groups of responses
+    surrogate_keys = ()
+
+    #: Whether a weak ``ETag`` is calculated from the response body for
+    #: responses to GET requests that do not have one (see
+    #: :py:meth:`~RouteBase.get_etag`)
+    auto_etag = False
+
     def __init__(self, *args, **kwargs):
         """
         This method is invoked when the request handler is called. The default
@@ -67,7 +379,13 @@ class RouteBase(object):
         :py:meth:`~RouteBase.construct_body` method, which is, in turn, called
         by :py:meth:`~RouteBase.__iter__` method when bottle attempts to cast
         the response.
+
+        If :py:attr:`~RouteBase.record_timing` is enabled (or metrics are
+        collected), a :py:class:`~streamline.timing.Timing` object is stored in
+        the ``timing`` attribute and in the ``streamline.timing`` key of the
+        request environment. Otherwise the ``timing`` attribute is ``None``.
         """
+        start = clock()
         self.args = args
         self.kwargs = kwargs
         self.body = []
@@ -75,6 +393,11 @@ class RouteBase(object):
         self.config = self.request.app.config
         self.method = self.request.method.lower()
         self.is_xhr = self.request.is_xhr
+        self.timing = None
+        if self._timed:
+            self.timing = Timing(start)
+            self.request.environ['streamline.timing'] = self.timing
+            self.timing.add('init', clock() - start)
 
     @classmethod
     def route(cls, path=None, name=None, app=None, **kwargs):
@@ -104,15 +427,112 @@ class RouteBase(object):
             raise RuntimeError('No path specified for {}'.format(cls))
         kwargs['name'] = name or cls.get_name()
         kwargs['method'] = cls.get_valid_methods()
-        kwargs['apply'] = cls.include_plugins
-        kwargs['skip'] = cls.exclude_plugins
+        kwargs['apply'], kwargs['skip'] = cls._plugins
         kwargs['callback'] = cls
         app.route(path, **kwargs)
+        if '_routes' not in cls.__dict__:
+            cls._routes = []
+        cls._routes.append((kwargs['name'], path))
+        cls.compile_hooks()
+
+    @classmethod
+    def compile_class(cls):
+        """
+        Calculate and store the class-level information used during route
+        registration and request handling. This method is invoked by the
+        :py:class:`RouteMeta` metaclass when the class is created, and
+        whenever a public attribute is assigned on the class.
+
+        Subclasses that need to precalculate their own class-level data should
+        extend this method and store the results in attributes whose names
+        start with an underscore.
+        """
+        handlers = {}
+        for method in METHODS:
+            handler = compile_handler(cls, method)
+            if handler is not None:
+                handlers[method] = handler
+        cls._handlers = handlers
+        cls._valid_methods = [m.upper() for m in METHODS if m in handlers]
+        cls._allow_headers = {'Allow': ', '.join(cls._valid_methods)}
+        cls._plugins = (cls.include_plugins and list(cls.include_plugins),
+                        cls.exclude_plugins and list(cls.exclude_plugins))
+        cls._route_name = cls.name or cls.get_generic_name()
+        cls._timed = bool(cls.record_timing or cls.metrics is not None)
+        cls._cache_policy = dict((name, getattr(cls, name))
+                                 for name in CACHE_POLICY)
+        cls._cache_headers = build_cache_headers(**cls._cache_policy)
+        cls._conditional = not (getattr(cls.get_etag, 'is_default', False) and
+                                getattr(cls.get_last_modified, 'is_default',
+                                        False))
+        cls.compile_hooks()
+
+    @classmethod
+    def compile_hooks(cls):
+        """
+        Build the flat lists of before-create and after-create hooks that
+        apply to this class. Hooks registered on base classes come first among
+        the before-create hooks, and last among the after-create hooks. Hooks
+        that are scoped to route name or path prefixes are matched against the
+        names and paths under which the class was registered, or its default
+        name and path if it has not been registered yet.
+
+        This method is invoked when the class is compiled, whenever it is
+        registered as a route handler, and before handling a request if any
+        list of hooks was modified since the hooks were compiled.
+        """
+        # The version is read first, so that changes made while compiling
+        # cause another compilation
+        cls._hooks_version = HookList.version
+        routes = cls.__dict__.get('_routes') or [(cls._route_name, cls.path)]
+        names = [n for n, _ in routes if n is not None]
+        paths = [p for _, p in routes if p is not None]
+        before_hooks = collect_hooks(cls, 'before_hooks')
+        after_hooks = collect_hooks(cls, 'after_hooks')
+        after_hooks.reverse()
+        cls._before_chain = filter_hooks(before_hooks, names, paths)
+        cls._after_chain = filter_hooks(after_hooks, names, paths)
+        cls._short_circuit_chain = filter_hooks(after_hooks, names, paths,
+                                                always=True)
+
+    @classmethod
+    def update_hooks(cls):
+        """
+        Compile the hooks again if any list of hooks was modified since they
+        were compiled.
+        """
+        if cls._hooks_version != HookList.version:
+            cls.compile_hooks()
+
+    @classmethod
+    def get_before_hooks(cls):
+        """
+        Return a list of before-create hooks that are invoked for this class,
+        in the order in which they are invoked.
+        """
+        cls.update_hooks()
+        return list(cls._before_chain)
+
+    @classmethod
+    def get_after_hooks(cls, short_circuit=False):
+        """
+        Return a list of after-create hooks that are invoked for this class,
+        in the order in which they are invoked. If ``short_circuit`` is
+        ``True``, return the hooks that are invoked when a before-create hook
+        short-circuits the request.
+        """
+        cls.update_hooks()
+        if short_circuit:
+            return list(cls._short_circuit_chain)
+        return list(cls._after_chain)
 
     @classmethod
     def get_valid_methods(cls):
-        props = dir(cls)
-        return [m.upper() for m in METHODS if m in props]
+        """
+        Return a list of upper-case HTTP verbs for which the class has a
+        handler method.
+        """
+        return list(cls._valid_methods)
 
     @classmethod
     def get_path(cls):
@@ -139,45 +559,412 @@ class RouteBase(object):
         on a generic name returned by :py:meth:`~RouteBase.get_generic_name`
         class method.
         """
-        return cls.name or cls.get_generic_name()
+        return cls._route_name
+
+    @classmethod
+    def add_hook(cls, attr, fn, **options):
+        """
+        Append a hook to the list stored in ``attr`` attribute of this class
+        and recompile the hooks for the class and its subclasses. Keyword
+        arguments are passed to :py:func:`~streamline.base.make_hook`. If the
+        class has no list of its own, a list which extends the hooks of the
+        base classes is created.
+        """
+        if attr not in cls.__dict__:
+            hooks = HookList()
+            hooks.extends = True
+            setattr(cls, attr, hooks)
+        getattr(cls, attr).append(make_hook(fn, **options))
+        cls._recompile(attr)
 
-    @staticmethod
-    def before(fn):
+    @classmethod
+    def before(cls, fn, name=None, path=None):
         """
         Register a function as a before-create hook. Before-create hooks are
         invoked before the :py:attr:`~RouteBase.create_response` call. They
-        take the route handler object as the only argument, and their return
-        value is ignored.
+        take the route handler object as the only argument.
+
+        If a hook returns a value other than ``None``, the request is
+        short-circuited: the value is used as the response body (it can also
+        be a :py:class:`~bottle.HTTPResponse` object), and the remaining
+        before-create hooks, :py:meth:`~RouteBase.create_response` (and
+        therefore the handler method and template rendering), and the
+        after-create hooks which were not registered with the ``always`` flag
+        are skipped.
+
+        The hook applies to the class on which this method is invoked and all
+        of its subclasses, so hooks registered on :py:class:`RouteBase` apply
+        to all routes. The hook can be further limited to routes whose name
+        starts with ``name`` and/or path starts with ``path``.
+
+        Functions may also be appended to :py:attr:`~RouteBase.before_hooks`
+        directly, but only this method (or the
+        :py:func:`~streamline.base.before` decorator) can limit the hook to
+        route names and paths.
+
+        .. note::
+            In earlier versions, this was a static method which registered
+            the hook on :py:class:`RouteBase` regardless of the class on which
+            it was invoked. Hooks registered through a subclass now only
+            apply to that subclass and its subclasses. Use the
+            :py:func:`~streamline.base.before` decorator or
+            ``RouteBase.before()`` to register hooks for all routes.
         """
-        RouteBase.before_hooks.append(fn)
+        cls.add_hook('before_hooks', fn, name=name, path=path)
 
-    @staticmethod
-    def after(fn):
+    @classmethod
+    def after(cls, fn, name=None, path=None, always=False):
         """
         Register a function as an after-create hook. After-create hooks are
         invoked after the :py:attr:`~RouteBase.create_response` call, before
         iteration over the response body begins. They take the route handler
         object as the only argument, and their return value is ignored.
+
+        After-create hooks are invoked in reverse order of registration. The
+        scope of the hook is determined the same way as in
+        :py:meth:`~RouteBase.before`. If ``always`` is ``True``, the hook is
+        also invoked when a before-create hook short-circuits the request.
+
+        .. note::
+            In earlier versions, this was a static method which registered
+            the hook on :py:class:`RouteBase` regardless of the class on which
+            it was invoked. Hooks registered through a subclass now only
+            apply to that subclass and its subclasses. Use the
+            :py:func:`~streamline.base.after` decorator or
+            ``RouteBase.after()`` to register hooks for all routes.
         """
-        RouteBase.after_hooks.insert(0, fn)
+        cls.add_hook('after_hooks', fn, name=name, path=path, always=always)
 
     def get_method(self):
         return self.request.method.lower()
 
+    def apply_cache_headers(self, headers):
+        """
+        Set the cache policy ``headers`` on the response. Headers that were
+        already set are kept, except ``Vary`` whose values are merged.
+        """
+        response_headers = self.response.headers
+        for name, value in headers:
+            if name == 'Vary':
+                utils.add_vary(response_headers,
+                               *[v.strip() for v in value.split(',')])
+            elif name not in response_headers:
+                response_headers[name] = value
+
+    def set_cache_policy(self, **overrides):
+        """
+        Override the class-level cache policy for the current response.
+        Keyword arguments have the same names as the cache policy attributes
+        (:py:attr:`~RouteBase.max_age` and related attributes). For example::
+
+            def get(self, post_id):
+                post = get_post(post_id)
+                if post.draft:
+                    self.set_cache_policy(cache_visibility='private',
+                                          s_maxage=None)
+                ...
+
+        The policy of a GET response is set from the class attributes before
+        the handler is invoked, so headers that the handler sets directly take
+        precedence as well.
+        """
+        policy = dict(self._cache_policy, **overrides)
+        for name in ('Cache-Control', 'Surrogate-Key'):
+            if name in self.response.headers:
+                del self.response.headers[name]
+        self.apply_cache_headers(build_cache_headers(**policy))
+
+    def get_etag(self):
+        """
+        Return the entity tag of the resource, or ``None`` if it is unknown.
+        The value may be a quoted tag (``W/`` prefix marks a weak tag), or an
+        unquoted string, which is quoted automatically.
+
+        This method and :py:meth:`~RouteBase.get_last_modified` are called
+        before the handler for GET requests, and should be cheap (e.g., look
+        up the version or modification time of a record). If the resource was
+        not modified since the version the client has, a 304 response is
+        returned without invoking the handler or rendering the template. The
+        default implementation returns ``None``.
+        """
+        return None
+    get_etag.is_default = True
+
+    def get_last_modified(self):
+        """
+        Return the time of last modification of the resource as a
+        :py:class:`~datetime.datetime` object in UTC or a timestamp, or
+        ``None`` if it is unknown. See :py:meth:`~RouteBase.get_etag`.
+        """
+        return None
+    get_last_modified.is_default = True
+
+    def set_validators(self):
+        """
+        Set the ``ETag`` and ``Last-Modified`` headers using the values
+        returned by :py:meth:`~RouteBase.get_etag` and
+        :py:meth:`~RouteBase.get_last_modified`.
+        """
+        etag = self.get_etag()
+        if etag is not None:
+            if not etag.endswith('"'):
+                etag = '"{}"'.format(etag)
+            self.response.headers['ETag'] = etag
+        last_modified = self.get_last_modified()
+        if last_modified is not None:
+            self.response.headers['Last-Modified'] = bottle.http_date(
+                to_timestamp(last_modified))
+
+    def is_not_modified(self):
+        """
+        Return ``True`` if the ``ETag`` or ``Last-Modified`` header of the
+        response matches the conditional headers of the request, and a 304
+        response should be returned. ``If-None-Match`` takes precedence over
+        ``If-Modified-Since``.
+        """
+        if self.method not in CONDITIONAL_METHODS or \
+                self.response.status_code != 200:
+            return False
+        headers = self.response.headers
+        if_none_match = self.request.environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            etag = headers.get('ETag')
+            if etag is None:
+                return False
+            etags = parse_etags(if_none_match)
+            return '*' in etags or etag.replace('W/', '', 1) in etags
+        if_modified_since = self.request.environ.get('HTTP_IF_MODIFIED_SINCE')
+        last_modified = headers.get('Last-Modified')
+        if if_modified_since is None or last_modified is None:
+            return False
+        since = bottle.parse_date(if_modified_since.split(';')[0].strip())
+        modified = bottle.parse_date(last_modified)
+        return since is not None and modified is not None and \
+            modified <= since
+
+    def not_modified(self):
+        """
+        Return a 304 response which retains the headers set so far.
+        """
+        resp = self.response.copy(cls=self.HTTPResponse)
+        resp.status = 304
+        resp.body = b''
+        return resp
+
+    def method_not_allowed(self):
+        """
+        Raise a HTTP 405 error which lists the verbs supported by the class in
+        the ``Allow`` header.
+        """
+        raise self.HTTPError(405, 'Method not allowed.', **self._allow_headers)
+
+    def measure(self, phase, fn, *args):
+        """
+        Invoke ``fn`` with the specified positional arguments and return its
+        return value. If timing is recorded, the time spent in the call is
+        recorded as ``phase``.
+        """
+        timing = self.timing
+        if timing is None:
+            return fn(*args)
+        start = clock()
+        try:
+            return fn(*args)
+        finally:
+            timing.add(phase, clock() - start)
+
     def create_response(self):
+        if self._cache_headers and self.method in CONDITIONAL_METHODS:
+            self.apply_cache_headers(self._cache_headers)
+        if self._conditional and self.method in CONDITIONAL_METHODS:
+            self.set_validators()
+            if self.is_not_modified():
+                self.body = self.not_modified()
+                return
+        handler = self._handlers.get(self.get_method())
+        if handler is None:
+            self.method_not_allowed()
+        if self.timing is None:
+            self.body = handler(self, *self.args, **self.kwargs)
+        else:
+            self.body = self.measure('handler', functools.partial(
+                handler, self, *self.args, **self.kwargs))
+
+    def set_content_length(self, length):
+        """
+        Set the ``Content-Length`` header unless it was already set by the
+        handler.
+        """
+        if 'Content-Length' not in self.response.headers:
+            self.response.headers['Content-Length'] = str(length)
+
+    def adapt_body(self, body):
+        """
+        Convert the response body into an iterable that bottle can pass on to
+        the WSGI server with as little extra work as possible, and set the
+        ``Content-Length`` header when the body size is known.
+
+        Depending on the type of the body, the following is done:
+
+        - :py:class:`~bottle.HTTPResponse` objects are passed on to bottle
+        - text is encoded once using the response charset
+        - bytestrings are passed on as a single chunk (a weak ``ETag`` is
+          calculated from them if :py:attr:`~RouteBase.auto_etag` is enabled)
+        - ``bytearray`` and ``memoryview`` objects are converted to a
+          bytestring (WSGI requires bytestrings)
+        - file-like objects are served using the server's file wrapper
+        - lists and tuples have their text items encoded, and if all items are
+          bytestrings, their total length is used as content length
+        - any other iterable is passed on as is
+        """
+        if isinstance(body, self.HTTPResponse):
+            return iter([body])
+        if isinstance(body, text_type):
+            body = body.encode(self.response.charset)
+        elif isinstance(body, (bytearray, memoryview)):
+            body = bytes(body)
+        if isinstance(body, bytes):
+            if self.auto_etag and self.method in CONDITIONAL_METHODS:
+                if 'ETag' not in self.response.headers:
+                    self.response.headers['ETag'] = 'W/"{}"'.format(
+                        hashlib.sha1(body).hexdigest())
+                if self.is_not_modified():
+                    return iter([self.not_modified()])
+            self.set_content_length(len(body))
+            return iter([body])
+        if hasattr(body, 'read'):
+            length = utils.get_file_size(body)
+            if length is not None:
+                self.set_content_length(length)
+            # Bottle only uses the file wrapper for file-like objects that are
+            # returned directly or as a body of a HTTPResponse
+            resp = self.response.copy(cls=self.HTTPResponse)
+            resp.body = body
+            return iter([resp])
+        if isinstance(body, (list, tuple)):
+            charset = self.response.charset
+            body = [c.encode(charset) if isinstance(c, text_type) else c
+                    for c in body]
+            if all(isinstance(c, bytes) for c in body):
+                self.set_content_length(sum(len(c) for c in body))
+        return iter(body)
+
+    def call_hook(self, hook):
+        """
+        Invoke the hook with the route handler object as the only argument
+        and return its return value.
+        """
+        return hook(self)
+
+    def run_hook(self, hook, phase):
+        """
+        Invoke the hook using :py:meth:`~RouteBase.call_hook`, and return its
+        return value. If timing is recorded, the time spent in the hook is
+        recorded as ``<phase>.<hook name>``.
+        """
+        if self.timing is None:
+            return self.call_hook(hook)
+        name = '{}.{}'.format(phase, get_hook_name(hook))
+        return self.measure(name, self.call_hook, hook)
+
+    def run_hooks(self, hooks, phase='after'):
+        """
+        Invoke each hook in ``hooks``. The return values are ignored.
+        """
+        for hook in hooks:
+            self.run_hook(hook, phase)
+
+    def run_before_hooks(self):
+        """
+        Invoke the before-create hooks until one of them returns a value other
+        than ``None``, and return that value. Returns ``None`` if no hook
+        short-circuits the request.
+        """
+        for hook in self._before_chain:
+            result = self.run_hook(hook, 'before')
+            if result is not None:
+                return result
+        return None
+
+    def iter_timed(self, body):
+        """
+        Iterate over ``body`` and record the time spent producing the chunks
+        as the ``body`` phase. Once the iteration is finished,
+        :py:meth:`~RouteBase.finish_timing` is invoked.
+        """
+        status = None
+        size = 0
+        elapsed = 0
         try:
-            meth = getattr(self, self.get_method())
-        except AttributeError:
-            self.abort(405)
-        self.body = meth(*self.args, **self.kwargs)
+            while True:
+                start = clock()
+                try:
+                    chunk = next(body)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += clock() - start
+                if isinstance(chunk, self.HTTPResponse):
+                    status = chunk.status_code
+                else:
+                    size += len(chunk)
+                yield chunk
+        finally:
+            self.timing.add('body', elapsed)
+            if status is None:
+                status = self.response.status_code
+            self.finish_timing(status, size)
+
+    def finish_timing(self, status, size):
+        """
+        Finalize the timing record with the response status code and size,
+        pass it to :py:meth:`~RouteBase.report_timing`, and to the metrics
+        registry if there is one.
+        """
+        self.timing.finish(status, size)
+        self.report_timing(self.timing)
+        if self.metrics is not None:
+            self.metrics.observe_route(self, self.timing)
+
+    def report_timing(self, timing):
+        """
+        Called with the :py:class:`~streamline.timing.Timing` object once the
+        response body has been produced. Default implementation does nothing.
+        Override this method to log or otherwise process the timing data.
+        """
+        pass
+
+    def get_response_body(self):
+        """
+        Run the hooks and create the response, and return the body as an
+        iterable that is passed on to bottle.
+        """
+        self.update_hooks()
+        result = self.run_before_hooks()
+        if result is None:
+            self.create_response()
+            self.run_hooks(self._after_chain)
+        else:
+            self.body = result
+            self.run_hooks(self._short_circuit_chain)
+        return self.adapt_body(self.body)
 
     def __iter__(self):
-        for hook in self.before_hooks:
-            hook(self)
-        self.create_response()
-        for hook in self.after_hooks:
-            hook(self)
-        return iter(self.body)
+        if self.timing is None:
+            return self.get_response_body()
+        try:
+            body = self.get_response_body()
+        except self.HTTPResponse as exc:
+            self.finish_timing(exc.status_code, 0)
+            raise
+        except Exception:
+            self.finish_timing(500, 0)
+            raise
+        if self.server_timing:
+            # The body phase is not included since the headers are sent
+            # before the body is produced
+            self.response.headers['Server-Timing'] = self.timing.as_header()
+        return self.iter_timed(body)
 
 #: Alias for ``RouteBase``
 Route = RouteBase
@@ -185,17 +972,12 @@ Route = RouteBase
 
 class NonIterableResponseMixin(object):
     """
-    This mixin prevents the response data from being iterated upon byte-by-byte
-    by bottle, which in case of large responses has a big performance impact,
-    by wrapping the response data in a list.
+    This mixin used to prevent the response data from being iterated upon
+    byte-by-byte by bottle. :py:meth:`RouteBase.adapt_body` now handles string
+    bodies efficiently, so this mixin no longer adds any behavior, and is only
+    kept for backwards compatibility.
     """
-    def __iter__(self):
-        for hook in self.before_hooks:
-            hook(self)
-        self.create_response()
-        for hook in self.after_hooks:
-            hook(self)
-        return iter([self.body])
+    pass
 
 
 class NonIterableRouteBase(NonIterableResponseMixin, RouteBase):
@@ -207,23 +989,124 @@ class NonIterableRouteBase(NonIterableResponseMixin, RouteBase):
     pass
 
 
-def before(fn):
+class StreamingResponseMixin(object):
     """
-    Decorator that registers a function as a before hook.
+    This mixin allows handler methods to return iterables (typically
+    generators) that produce the response body in chunks. Chunks are encoded
+    and buffered until at least :py:attr:`~StreamingResponseMixin.buffer_size`
+    bytes are collected, and then passed on to the server as a single chunk.
+    This keeps the memory usage constant while avoiding a large number of
+    small writes to the socket.
+
+    Handlers may yield :py:data:`~streamline.base.FLUSH` marker (also
+    available as ``self.FLUSH``) to pass on the buffered data immediately.
+
+    Example::
+
+        class Report(StreamingRoute):
+            def get(self):
+                yield '<html><head>...</head>'
+                yield self.FLUSH
+                for row in get_rows():
+                    yield '<p>{}</p>'.format(row)
+                yield '</html>'
+
+    Since the handler's generator is consumed after the after-create hooks
+    are invoked, the hooks cannot inspect the body contents.
+    """
+
+    #: Flush marker
+    FLUSH = FLUSH
+
+    #: Body types that are not coalesced
+    SINGLE_CHUNK_TYPES = (bottle.HTTPResponse, text_type, bytes, bytearray,
+                          memoryview)
+
+    #: Minimum number of bytes that are buffered before a chunk is passed on
+    buffer_size = 64 * 1024
+
+    def get_buffer_size(self):
+        """
+        Return the buffer size. Default behavior is to return the
+        :py:attr:`~StreamingResponseMixin.buffer_size` property.
+        """
+        return self.buffer_size
+
+    def coalesce(self, chunks):
+        """
+        Iterate over ``chunks`` and yield bytestrings that are at least as
+        large as the buffer size, except for the final chunk and chunks that
+        are passed on due to the flush marker. Text chunks are encoded using
+        the response charset.
+        """
+        buffer_size = self.get_buffer_size()
+        charset = self.response.charset
+        buf = []
+        buffered = 0
+        for chunk in chunks:
+            if chunk is FLUSH:
+                if buf:
+                    yield b''.join(buf)
+                    buf = []
+                    buffered = 0
+                continue
+            if isinstance(chunk, text_type):
+                chunk = chunk.encode(charset)
+            buf.append(chunk)
+            buffered += len(chunk)
+            if buffered >= buffer_size:
+                yield b''.join(buf)
+                buf = []
+                buffered = 0
+        if buf:
+            yield b''.join(buf)
+
+    def adapt_body(self, body):
+        """
+        Coalesce chunks of iterable bodies. Other types of body are handled by
+        :py:meth:`RouteBase.adapt_body`.
+        """
+        if isinstance(body, self.SINGLE_CHUNK_TYPES) or hasattr(body, 'read'):
+            return super(StreamingResponseMixin, self).adapt_body(body)
+        return self.coalesce(body)
+
+
+class StreamingRoute(StreamingResponseMixin, RouteBase):
+    """
+    Provides the same functionality as :py:class:`RouteBase`, with
+    :py:class:`StreamingResponseMixin` included, so that handlers can produce
+    the response body in chunks.
+    """
+    pass
+
+
+def before(fn=None, name=None, path=None):
+    """
+    Decorator that registers a function as a before hook. When the name or
+    path prefix is specified, the hook is only invoked for matching routes.
 
     Example::
 
         @before
         def myhook(route):
             pass
+
+        @before(path='/admin/')
+        def adminhook(route):
+            pass
     """
-    RouteBase.before(fn)
+    if fn is None:
+        return functools.partial(before, name=name, path=path)
+    RouteBase.before(fn, name, path)
     return fn
 
 
-def after(fn):
+def after(fn=None, name=None, path=None, always=False):
     """
-    Decorator that register a function as an after hook.
+    Decorator that register a function as an after hook. When the name or
+    path prefix is specified, the hook is only invoked for matching routes.
+    When ``always`` is ``True``, the hook is also invoked for requests that
+    were short-circuited by a before hook.
 
     Example::
 
@@ -231,6 +1114,12 @@ def after(fn):
         def myhook(route):
             pass
 
+        @after(name='api:')
+        def apihook(route):
+            pass
+
     """
-    RouteBase.after(fn)
+    if fn is None:
+        return functools.partial(after, name=name, path=path, always=always)
+    RouteBase.after(fn, name, path, always)
     return fn
@@ -0,0 +1,397 @@
+"""
+This module contains a route handler class which renders several fragments
+(typically handled by :py:class:`~streamline.template.XHRPartialRoute`
+subclasses) in a single request, and returns them in one JSON or multipart
+envelope.
+
+Pages which load a number of fragments using separate XHR requests pay the
+connection, hook, and plugin overhead for each of them. With the batch route
+registered::
+
+    BatchRoute.route()
+
+the client requests all fragments at once, either by POSTing a JSON list to
+the batch route, or by passing the same list as the ``fragments`` query
+parameter of a GET request::
+
+    [{"name": "cart", "args": {"id": 12}},
+     {"name": "notifications", "query": {"limit": 5}}]
+
+Each item contains the name of a route, and optionally the URL arguments of
+the route (``args``) and query parameters (``query``). Fragments are handled
+in-process by the route handler classes registered for those names, as GET
+XHR requests whose environment is a copy of the batch request's environment,
+so cookies and other headers are shared. Each fragment is dispatched through
+the plugins applied to its route (e.g., authorization checks), with
+:py:data:`bottle.request` and :py:data:`bottle.response` bound to the
+fragment. Application's ``before_request`` and ``after_request`` hooks are
+only triggered once, for the batch request.
+
+The response is a JSON object with a ``fragments`` list, which contains the
+``name``, ``status``, ``headers`` and ``body`` of each fragment in the order
+in which they were requested. Clients that send ``multipart/mixed`` in the
+``Accept`` header receive a multipart response instead, with one part per
+fragment, whose name and status are given by ``X-Fragment-Name`` and
+``X-Fragment-Status`` headers. Headers which a fragment sets more than once
+are joined with commas in the JSON envelope.
+
+Cookies set by fragments are not included in the fragment headers. Their
+``Set-Cookie`` headers are copied to the batch response instead, so that
+session changes made by fragments reach the client.
+"""
+
+import io
+import json
+import uuid
+
+import bottle
+
+from .base import RouteBase, text_type
+
+
+#: Request headers which are not passed on to fragments
+EXCLUDED_HEADERS = (
+    # The envelope is encoded as a whole, and the fragments must not be
+    # replaced by 304 responses
+    'HTTP_ACCEPT_ENCODING',
+    'HTTP_IF_MATCH',
+    'HTTP_IF_NONE_MATCH',
+    'HTTP_IF_MODIFIED_SINCE',
+    'HTTP_IF_UNMODIFIED_SINCE',
+    'CONTENT_LENGTH',
+    'CONTENT_TYPE',
+)
+
+#: Attributes of :py:data:`bottle.response` which are bound to the thread
+RESPONSE_STATE = ('_status_line', '_status_code', '_headers', '_cookies',
+                  'body')
+
+#: Prefixes of environment keys in which bottle and streamline store
+#: per-request data
+EXCLUDED_PREFIXES = ('bottle.request', 'bottle.route', 'route.',
+                     'streamline.')
+
+
+class Fragment(object):
+    """
+    Response of a single fragment.
+    """
+    __slots__ = ('name', 'status', 'headers', 'body')
+
+    def __init__(self, name, status, headers=(), body=b''):
+        self.name = name
+        self.status = status
+        self.headers = list(headers)
+        self.body = body
+
+    def get_header(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+
+def is_valid_item(item):
+    """
+    Return ``True`` if ``item`` is a dict which describes a fragment request:
+    ``name`` is a string, ``args`` (if present) is a dict, and ``query`` (if
+    present) is a dict or a list of pairs.
+    """
+    if not isinstance(item, dict) or \
+            not isinstance(item.get('name'), (str, text_type)):
+        return False
+    if not isinstance(item.get('args') or {}, dict):
+        return False
+    query = item.get('query') or {}
+    if isinstance(query, list):
+        return all(isinstance(pair, list) and len(pair) == 2
+                   for pair in query)
+    return isinstance(query, dict)
+
+
+def save_context():
+    """
+    Return the environ and response state bound to bottle's request and
+    response in the current thread, or ``None`` if they are not bound.
+    """
+    try:
+        return (bottle.request.environ,
+                [getattr(bottle.response, name) for name in RESPONSE_STATE])
+    except RuntimeError:
+        return None
+
+
+def restore_context(saved):
+    """
+    Bind bottle's request and response to the state returned by
+    :py:func:`save_context`.
+    """
+    if saved is None:
+        return
+    environ, state = saved
+    bottle.request.bind(environ)
+    for name, value in zip(RESPONSE_STATE, state):
+        setattr(bottle.response, name, value)
+
+
+def read_body(chunks, charset):
+    """
+    Return the chunks of a response body joined into a bytestring.
+    """
+    data = []
+    for chunk in chunks:
+        if hasattr(chunk, 'read'):
+            fileobj = chunk
+            try:
+                chunk = fileobj.read()
+            finally:
+                if hasattr(fileobj, 'close'):
+                    fileobj.close()
+        if isinstance(chunk, text_type):
+            chunk = chunk.encode(charset)
+        data.append(chunk)
+    return b''.join(data)
+
+
+class BatchRoute(RouteBase):
+    """
+    Route handler class which handles a list of fragment requests and returns
+    the responses in a single envelope.
+
+    By default, any named route whose handler is a route handler class can
+    be requested as a fragment. :py:attr:`~BatchRoute.allowed_routes` can be
+    used to limit the routes that are available.
+
+    Fragments are handled one after another, unless an executor object (such
+    as :py:class:`concurrent.futures.ThreadPoolExecutor`) is specified as
+    :py:attr:`~BatchRoute.executor`, in which case they are handled
+    concurrently using the executor's ``map()`` method. Bottle's request and
+    response are bound to the fragment in the thread that handles it, and
+    restored afterwards.
+    """
+
+    #: Route path
+    path = '/batch'
+
+    #: Names of routes that can be requested as fragments (``None`` allows
+    #: all named routes)
+    allowed_routes = None
+
+    #: Maximum number of fragments in a single request
+    max_fragments = 20
+
+    #: Executor used to handle the fragments concurrently
+    executor = None
+
+    def get_fragment_requests(self):
+        """
+        Return the list of requested fragments. Each item is a dict with
+        ``name``, and optional ``args`` and ``query`` keys. Aborts with 400
+        status if the list is missing or malformed (see
+        :py:func:`is_valid_item`).
+        """
+        if self.method == 'post':
+            try:
+                items = self.request.json
+            except ValueError:
+                items = None
+        else:
+            try:
+                items = json.loads(self.request.query.get('fragments', ''))
+            except ValueError:
+                items = None
+        if isinstance(items, dict):
+            items = items.get('fragments')
+        if not isinstance(items, list) or \
+                not all(is_valid_item(item) for item in items):
+            self.abort(400, 'Invalid list of fragments')
+        if len(items) > self.max_fragments:
+            self.abort(400, 'Too many fragments')
+        return items
+
+    def is_allowed(self, name, callback):
+        """
+        Return ``True`` if the route with specified name and handler can be
+        requested as a fragment.
+        """
+        if not isinstance(callback, type) or \
+                not issubclass(callback, RouteBase) or \
+                issubclass(callback, BatchRoute):
+            return False
+        return self.allowed_routes is None or name in self.allowed_routes
+
+    def get_fragment_environ(self, path, query_string):
+        """
+        Return the environment of a GET XHR request for specified path and
+        query string, based on the environment of the batch request.
+        """
+        environ = dict((key, value)
+                       for key, value in self.request.environ.items()
+                       if key not in EXCLUDED_HEADERS and
+                       not key.startswith(EXCLUDED_PREFIXES))
+        environ['REQUEST_METHOD'] = 'GET'
+        environ['PATH_INFO'] = path
+        environ['QUERY_STRING'] = query_string
+        environ['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+        environ['wsgi.input'] = io.BytesIO()
+        return environ
+
+    def handle_fragment(self, item):
+        """
+        Handle the fragment request described by ``item``, and return a
+        :py:class:`Fragment` object.
+        """
+        name = item['name']
+        args = item.get('args') or {}
+        try:
+            path = self.app.router.build(name, **args)
+        except bottle.RouteBuildError:
+            return Fragment(name, 404)
+        path, _, query_string = path.partition('?')
+        query = item.get('query')
+        if query:
+            if isinstance(query, list):
+                # JSON has no tuples, but urlencode() requires them
+                query = [tuple(pair) for pair in query]
+            extra = bottle.urlencode(query, True)
+            query_string = query_string + '&' + extra if query_string \
+                else extra
+        environ = self.get_fragment_environ(path, query_string)
+        try:
+            route, url_args = self.app.router.match(environ)
+        except bottle.HTTPError as exc:
+            return Fragment(name, exc.status_code)
+        if not self.is_allowed(route.name, route.callback):
+            return Fragment(name, 403)
+        environ['bottle.route'] = environ['route.handle'] = route
+        environ['route.url_args'] = url_args
+        return self.call_handler(name, route, environ, url_args)
+
+    def call_handler(self, name, route, environ, url_args):
+        """
+        Call the route's callback with the plugins applied to the route, with
+        bottle's request and response bound to the fragment, and return the
+        response as a :py:class:`Fragment` object.
+        """
+        saved = save_context()
+        request = bottle.request
+        response = bottle.response
+        request.bind(environ)
+        response.bind()
+        try:
+            result = route.call(**url_args)
+            if isinstance(result, (bytes, text_type, bottle.HTTPResponse)):
+                result = [result]
+            chunks = []
+            for chunk in result:
+                if isinstance(chunk, bottle.HTTPResponse):
+                    response = chunk
+                    chunk = chunk.body
+                chunks.append(chunk)
+            return self.create_fragment(name, response, chunks)
+        except bottle.HTTPResponse as exc:
+            return self.create_fragment(name, exc, [exc.body])
+        except Exception:
+            if not self.app.catchall:
+                raise
+            return Fragment(name, 500)
+        finally:
+            # Fragments are created above, as restoring replaces the response
+            restore_context(saved)
+
+    def create_fragment(self, name, response, chunks):
+        """
+        Return a :py:class:`Fragment` object for the response and the chunks
+        of its body.
+        """
+        body = read_body(chunks, response.charset)
+        headers = [(key, value) for key, value in response.headerlist
+                   if key != 'Content-Length']
+        return Fragment(name, response.status_code, headers, body)
+
+    def copy_cookies(self, fragments):
+        """
+        Move the ``Set-Cookie`` headers of the fragments to the batch
+        response.
+        """
+        for fragment in fragments:
+            headers = []
+            for key, value in fragment.headers:
+                if key.lower() == 'set-cookie':
+                    self.response.add_header('Set-Cookie', value)
+                else:
+                    headers.append((key, value))
+            fragment.headers = headers
+
+    def handle_fragments(self, items):
+        """
+        Handle all fragment requests and return the list of
+        :py:class:`Fragment` objects.
+        """
+        if self.executor is None:
+            return [self.handle_fragment(item) for item in items]
+        return list(self.executor.map(self.handle_fragment, items))
+
+    def wants_multipart(self):
+        """
+        Return ``True`` if the fragments should be returned as a multipart
+        response rather than JSON.
+        """
+        return 'multipart/mixed' in self.request.get_header('Accept', '')
+
+    def to_json(self, fragments):
+        """
+        Return the fragments encoded as a JSON envelope.
+        """
+        self.response.content_type = 'application/json'
+        data = []
+        for fragment in fragments:
+            charset = 'utf-8'
+            content_type = fragment.get_header('Content-Type', '')
+            if 'charset=' in content_type:
+                charset = content_type.split('charset=')[-1].split(';')[0]
+            headers = {}
+            for key, value in fragment.headers:
+                if key in headers:
+                    value = headers[key] + ', ' + value
+                headers[key] = value
+            data.append({
+                'name': fragment.name,
+                'status': fragment.status,
+                'headers': headers,
+                'body': fragment.body.decode(charset.strip(), 'replace'),
+            })
+        return json.dumps({'fragments': data})
+
+    def to_multipart(self, fragments):
+        """
+        Return the fragments encoded as a ``multipart/mixed`` body.
+        """
+        boundary = uuid.uuid4().hex
+        self.response.content_type = \
+            'multipart/mixed; boundary={}'.format(boundary)
+        delimiter = '--{}\r\n'.format(boundary).encode('ascii')
+        parts = []
+        for fragment in fragments:
+            headers = fragment.headers + [
+                ('X-Fragment-Name', fragment.name),
+                ('X-Fragment-Status', str(fragment.status)),
+                ('Content-Length', str(len(fragment.body))),
+            ]
+            head = ''.join('{}: {}\r\n'.format(key, value)
+                           for key, value in headers)
+            parts.append(delimiter + head.encode('latin1') + b'\r\n' +
+                         fragment.body + b'\r\n')
+        parts.append('--{}--\r\n'.format(boundary).encode('ascii'))
+        return b''.join(parts)
+
+    def get(self):
+        fragments = self.handle_fragments(self.get_fragment_requests())
+        self.copy_cookies(fragments)
+        if self.wants_multipart():
+            return self.to_multipart(fragments)
+        return self.to_json(fragments)
+
+    def post(self):
+        return self.get()
@@ -0,0 +1,923 @@
+"""
+This module contains mixins and classes for caching rendered responses on the
+server.
+
+Responses are cached in process memory by default. When the application runs
+in several worker processes, :py:class:`SharedMemoryCache` lets all workers
+on the host share one cache. Responses can be tagged with surrogate keys, and
+invalidating a tag removes all responses that carry it.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import bottle
+
+from .base import text_type
+from .timing import clock
+
+
+log = logging.getLogger(__name__)
+
+
+class CachedResponse(object):
+    """
+    Rendered response stored in the cache. It consists of the status code,
+    list of ``(name, value)`` header pairs, and the body as a bytestring.
+
+    Responses which may be served stale have a ``stale_after`` timestamp
+    (wall-clock time, so that it is meaningful in other processes).
+    """
+
+    __slots__ = ('status', 'headers', 'body', 'expires', 'stale_after')
+
+    def __init__(self, status, headers, body, expires=None, stale_after=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+        self.stale_after = stale_after
+
+    @property
+    def size(self):
+        """
+        Approximate number of bytes used by the response.
+        """
+        return len(self.body) + sum(len(n) + len(v) for n, v in self.headers)
+
+    def is_expired(self, now=None):
+        """
+        Return ``True`` if the response has expired.
+        """
+        if self.expires is None:
+            return False
+        return (clock() if now is None else now) >= self.expires
+
+    def is_stale(self, now=None):
+        """
+        Return ``True`` if the response is stale and should be refreshed.
+        """
+        if self.stale_after is None:
+            return False
+        return (time.time() if now is None else now) >= self.stale_after
+
+
+def make_key(name, *parts):
+    """
+    Return a key consisting of ``name`` and a hash of the remaining
+    arguments.
+    """
+    digest = hashlib.sha1(repr(parts).encode('utf8')).hexdigest()
+    return '{}:{}'.format(name, digest)
+
+
+def apply_response(response, cached):
+    """
+    Set the status and headers of the ``cached`` response on the
+    ``response`` object and return the body.
+    """
+    response.status = cached.status
+    seen = set()
+    for name, value in cached.headers:
+        if name in seen:
+            response.add_header(name, value)
+        else:
+            response.set_header(name, value)
+            seen.add(name)
+    return cached.body
+
+
+class CacheBackend(object):
+    """
+    Interface for cache backends. Backends store
+    :py:class:`~streamline.cache.CachedResponse` objects under string keys.
+    """
+
+    def get(self, key):
+        """
+        Return the response stored under ``key``, or ``None`` if there is no
+        such response or it has expired.
+        """
+        raise NotImplementedError()
+
+    def set(self, key, response, timeout=None, tags=()):
+        """
+        Store the response under ``key`` for ``timeout`` seconds (or
+        indefinitely if ``timeout`` is ``None``). The response is removed
+        when any of the ``tags`` is invalidated.
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """
+        Remove the response stored under ``key`` if any.
+        """
+        raise NotImplementedError()
+
+    def invalidate_tags(self, tags):
+        """
+        Remove all responses which were stored with any of the ``tags``.
+        """
+        raise NotImplementedError()
+
+    def clear(self):
+        """
+        Remove all responses.
+        """
+        raise NotImplementedError()
+
+
+class LRUCache(CacheBackend):
+    """
+    In-process cache backend which evicts the least recently used responses
+    once the total size of stored responses exceeds ``max_size`` bytes.
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.key_tags = {}
+        self.tag_keys = {}
+        self.lock = threading.Lock()
+
+    def remove(self, key):
+        """
+        Remove the response stored under ``key``. Must be called while
+        holding the lock.
+        """
+        response = self.entries.pop(key, None)
+        if response is None:
+            return
+        self.size -= response.size
+        for tag in self.key_tags.pop(key, ()):
+            keys = self.tag_keys[tag]
+            keys.discard(key)
+            if not keys:
+                del self.tag_keys[tag]
+
+    def get(self, key):
+        with self.lock:
+            response = self.entries.get(key)
+            if response is None:
+                return None
+            if response.is_expired():
+                self.remove(key)
+                return None
+            # Re-insert to mark the response as most recently used
+            del self.entries[key]
+            self.entries[key] = response
+            return response
+
+    def set(self, key, response, timeout=None, tags=()):
+        if timeout is not None:
+            response.expires = clock() + timeout
+        size = response.size
+        if size > self.max_size:
+            return
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = response
+            self.size += size
+            if tags:
+                self.key_tags[key] = tuple(tags)
+                for tag in tags:
+                    self.tag_keys.setdefault(tag, set()).add(key)
+            while self.size > self.max_size:
+                self.remove(next(iter(self.entries)))
+
+    def delete(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def invalidate_tags(self, tags):
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tag_keys.get(tag, ())):
+                    self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.key_tags.clear()
+            self.tag_keys.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+HEADER = struct.Struct('<8sQQQQQ')
+HEADER_SIZE = 64
+INDEX_ENTRY = struct.Struct('<16sQI4x')
+TAG_ENTRY = struct.Struct('<QQ')
+RECORD = struct.Struct('<4sI16sdQH')
+MAGIC = b'STRMLSHM'
+RECORD_MAGIC = b'SLCR'
+#: Number of consecutive slots searched in the index and tag tables
+PROBE = 8
+
+
+def tag_hash(tag):
+    """
+    Return a non-zero 64-bit hash of the tag.
+    """
+    digest = hashlib.md5(tag.encode('utf8')).digest()
+    return struct.unpack('<Q', digest[:8])[0] or 1
+
+
+class SharedMemoryCache(CacheBackend):
+    """
+    Cache backend which stores responses in a memory-mapped file, so that
+    all worker processes on the host which open the same file share a single
+    cache. It is not available on platforms without :py:mod:`fcntl`.
+
+    The file consists of a header, an index table with ``index_slots``
+    entries which maps keys to response records, a table of
+    ``tag_slots`` tag versions, and an arena of ``arena_size`` bytes in
+    which response records are written one after another, wrapping around at
+    the end. When the arena is full, the oldest records are overwritten, so
+    the total memory used by the cache never exceeds the size of the file.
+
+    Reads do not take any locks. Instead, a reader validates the record it
+    has copied out of the arena, and treats it as a miss if it was overwritten
+    in the meantime. Writes and invalidations are serialized using a file
+    lock.
+
+    Each record stores the versions of its tags at the time it was written.
+    Invalidating a tag increments its version, which makes all records with
+    that tag stale for all processes at once.
+
+    A tag takes up a slot in the tag table from the first time it is
+    invalidated, and it is looked up in the :py:data:`PROBE` slots that follow
+    its hash. If all of them are taken by other tags, invalidating the tag
+    invalidates the whole cache instead (a warning is logged), and the tag
+    table is emptied, as none of the remaining records is valid. ``tag_slots``
+    should therefore be several times larger than the number of distinct tags
+    which are invalidated during the lifetime of cached responses.
+    """
+
+    def __init__(self, path, arena_size=64 * 1024 * 1024, index_slots=65536,
+                 tag_slots=16384):
+        if fcntl is None:
+            raise RuntimeError('SharedMemoryCache requires fcntl module')
+        self.path = path
+        self.thread_lock = threading.Lock()
+        self.index_offset = HEADER_SIZE
+        self.tags_offset = self.index_offset + index_slots * INDEX_ENTRY.size
+        self.arena_offset = self.tags_offset + tag_slots * TAG_ENTRY.size
+        self.file_size = self.arena_offset + arena_size
+        self.pid = None
+        self.open_lock_file()
+        with self.locked():
+            with open(path, 'a+b') as f:
+                if os.fstat(f.fileno()).st_size < self.file_size:
+                    f.truncate(self.file_size)
+                self.mm = mmap.mmap(f.fileno(), self.file_size)
+            magic, self.index_slots, self.tag_slots, self.arena_size = \
+                HEADER.unpack_from(self.mm, 0)[:4]
+            if magic != MAGIC:
+                self.index_slots = index_slots
+                self.tag_slots = tag_slots
+                self.arena_size = arena_size
+                HEADER.pack_into(self.mm, 0, MAGIC, index_slots, tag_slots,
+                                 arena_size, 0, 0)
+            elif (self.index_slots, self.tag_slots, self.arena_size) != \
+                    (index_slots, tag_slots, arena_size):
+                raise ValueError('{} was created with different '
+                                 'parameters'.format(path))
+
+    def open_lock_file(self):
+        """
+        Open the file descriptor used for locking. File locks are shared
+        between processes which inherited the descriptor, so each process
+        opens its own.
+        """
+        self.lock_fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT)
+        self.pid = os.getpid()
+
+    def locked(self):
+        """
+        Return a context manager which holds the write lock.
+        """
+        if self.pid != os.getpid():
+            self.open_lock_file()
+        return FileLock(self.thread_lock, self.lock_fd)
+
+    def get_header(self):
+        return HEADER.unpack_from(self.mm, 0)
+
+    def get_write_pos(self):
+        return self.get_header()[4]
+
+    def get_epoch(self):
+        return self.get_header()[5]
+
+    def find_tag(self, h):
+        """
+        Return the slot offset and current version of the tag with hash
+        ``h``. The slot offset is ``None`` if the tag is not in the table and
+        there is no free slot for it.
+        """
+        start = h % self.tag_slots
+        for i in range(PROBE):
+            offset = (self.tags_offset +
+                      ((start + i) % self.tag_slots) * TAG_ENTRY.size)
+            slot_hash, version = TAG_ENTRY.unpack_from(self.mm, offset)
+            if slot_hash == h:
+                return offset, version
+            if slot_hash == 0:
+                return offset, 0
+        return None, 0
+
+    def find_key(self, digest):
+        """
+        Return the offset of the index slot which holds ``digest``, or the
+        offset of the slot which should be used for it.
+        """
+        write_pos = self.get_write_pos()
+        start = struct.unpack('<Q', digest[:8])[0] % self.index_slots
+        candidate = None
+        candidate_pos = None
+        for i in range(PROBE):
+            offset = (self.index_offset +
+                      ((start + i) % self.index_slots) * INDEX_ENTRY.size)
+            slot_digest, pos, _ = INDEX_ENTRY.unpack_from(self.mm, offset)
+            if slot_digest == digest:
+                return offset
+            if pos == 0 or write_pos > pos - 1 + self.arena_size:
+                # Empty slot or the record was overwritten
+                pos = 0
+            if candidate is None or pos < candidate_pos:
+                candidate = offset
+                candidate_pos = pos
+        return candidate
+
+    def get(self, key):
+        digest = hashlib.md5(key.encode('utf8')).digest()
+        start = struct.unpack('<Q', digest[:8])[0] % self.index_slots
+        for i in range(PROBE):
+            offset = (self.index_offset +
+                      ((start + i) % self.index_slots) * INDEX_ENTRY.size)
+            slot_digest, pos, length = INDEX_ENTRY.unpack_from(self.mm,
+                                                               offset)
+            if slot_digest == digest and pos:
+                break
+        else:
+            return None
+        pos -= 1
+        if self.get_write_pos() > pos + self.arena_size:
+            return None
+        start = self.arena_offset + pos % self.arena_size
+        data = self.mm[start:start + length]
+        # The writer reserves space before writing, so if the write position
+        # is still within one lap of the record, the copy is intact
+        if self.get_write_pos() > pos + self.arena_size:
+            return None
+        if len(data) < RECORD.size:
+            return None
+        magic, size, record_digest, expires, epoch, ntags = \
+            RECORD.unpack_from(data, 0)
+        if magic != RECORD_MAGIC or record_digest != digest or \
+                size != length:
+            return None
+        if expires and expires <= time.time():
+            return None
+        if epoch != self.get_epoch():
+            return None
+        offset = RECORD.size
+        for _ in range(ntags):
+            h, version = TAG_ENTRY.unpack_from(data, offset)
+            if self.find_tag(h)[1] != version:
+                return None
+            offset += TAG_ENTRY.size
+        # The tag table is emptied after the epoch is incremented, so the
+        # versions are only meaningful if the epoch has not changed
+        if epoch != self.get_epoch():
+            return None
+        status, headers, body, stale_after = pickle.loads(data[offset:])
+        return CachedResponse(status, headers, body, stale_after=stale_after)
+
+    def set(self, key, response, timeout=None, tags=()):
+        digest = hashlib.md5(key.encode('utf8')).digest()
+        payload = pickle.dumps((response.status, response.headers,
+                                response.body, response.stale_after), 2)
+        expires = time.time() + timeout if timeout is not None else 0
+        length = RECORD.size + len(tags) * TAG_ENTRY.size + len(payload)
+        # Keep records aligned to 8 bytes
+        reserved = (length + 7) & ~7
+        if reserved > self.arena_size:
+            return
+        with self.locked():
+            header = list(self.get_header())
+            pos = header[4]
+            offset = pos % self.arena_size
+            if offset + reserved > self.arena_size:
+                # Records do not wrap around the end of the arena
+                pos += self.arena_size - offset
+                offset = 0
+            header[4] = pos + reserved
+            HEADER.pack_into(self.mm, 0, *header)
+            parts = [RECORD.pack(RECORD_MAGIC, length, digest, expires,
+                                 header[5], len(tags))]
+            for tag in tags:
+                h = tag_hash(tag)
+                parts.append(TAG_ENTRY.pack(h, self.find_tag(h)[1]))
+            parts.append(payload)
+            start = self.arena_offset + offset
+            self.mm[start:start + length] = b''.join(parts)
+            INDEX_ENTRY.pack_into(self.mm, self.find_key(digest), digest,
+                                  pos + 1, length)
+
+    def delete(self, key):
+        digest = hashlib.md5(key.encode('utf8')).digest()
+        with self.locked():
+            offset = self.find_key(digest)
+            slot_digest = INDEX_ENTRY.unpack_from(self.mm, offset)[0]
+            if slot_digest == digest:
+                INDEX_ENTRY.pack_into(self.mm, offset, b'\0' * 16, 0, 0)
+
+    def invalidate_tags(self, tags):
+        with self.locked():
+            for tag in tags:
+                h = tag_hash(tag)
+                offset, version = self.find_tag(h)
+                if offset is None:
+                    # The tag table is full, so invalidate everything
+                    log.warning('Tag table of %s is full, invalidating the '
+                                'whole cache', self.path)
+                    self.bump_epoch()
+                    continue
+                TAG_ENTRY.pack_into(self.mm, offset, h, version + 1)
+
+    def bump_epoch(self):
+        """
+        Increment the epoch, which invalidates all records, and empty the tag
+        table, whose versions are no longer used by any valid record. Must be
+        called while holding the lock.
+        """
+        header = list(self.get_header())
+        header[5] += 1
+        HEADER.pack_into(self.mm, 0, *header)
+        self.mm[self.tags_offset:self.arena_offset] = \
+            b'\0' * (self.arena_offset - self.tags_offset)
+
+    def clear(self):
+        with self.locked():
+            self.bump_epoch()
+
+    def close(self):
+        """
+        Unmap the file and close the lock file.
+        """
+        self.mm.close()
+        os.close(self.lock_fd)
+
+
+class FileLock(object):
+    """
+    Context manager which acquires a thread lock and an exclusive lock on a
+    file descriptor.
+    """
+
+    def __init__(self, thread_lock, fd):
+        self.thread_lock = thread_lock
+        self.fd = fd
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+
+#: Cache backend used by default
+default_cache = LRUCache()
+
+#: Cache keys which are being refreshed in the background
+revalidating = set()
+revalidating_lock = threading.Lock()
+
+
+class CachedRouteMixin(object):
+    """
+    Mixin that caches the rendered responses to GET requests on the server.
+    When a cached response is found, it is served without invoking the
+    handler method or rendering the template. Before-create and after-create
+    hooks are still invoked. It must be placed before the route handler class
+    in the list of bases.
+
+    Example::
+
+        class Home(CachedRouteMixin, TemplateRoute):
+            template_name = 'home'
+            cache_timeout = 60
+            cache_query_params = ['page']
+
+    The cache key is built from the route name, route arguments, values of
+    query parameters listed in :py:attr:`~CachedRouteMixin.cache_query_params`
+    and the XHR flag. Only responses with 200 status, no cookies, a body
+    that is a string, and a ``Cache-Control`` header that does not contain
+    any of :py:attr:`~CachedRouteMixin.uncached_directives` are stored.
+    Handlers can prevent caching of a particular response by setting the
+    ``cache_timeout`` attribute to 0.
+
+    When :py:attr:`~CachedRouteMixin.cache_stale_timeout` is set, responses
+    are kept for that many seconds after they expire (stale-while-revalidate).
+    A stale response is served immediately, and a copy of the request is
+    handled in a background thread to refresh the cached response. Only one
+    refresh per cache key is in flight in each process. Once the stale period
+    is over, requests are handled normally and wait for the response to be
+    rendered. ::
+
+        class Dashboard(CachedRouteMixin, TemplateRoute):
+            template_name = 'dashboard'
+            cache_timeout = 30
+            cache_stale_timeout = 600
+
+    Background refresh only runs the handler and the hooks, so handlers of
+    such routes must not depend on the global ``bottle.request`` and
+    ``bottle.response`` objects, and should use the ``request`` and
+    ``response`` attributes instead.
+    """
+
+    #: Cache backend, defaults to :py:data:`~streamline.cache.default_cache`
+    cache_backend = None
+
+    #: Number of seconds for which responses are cached (``None`` means that
+    #: the responses are cached until evicted)
+    cache_timeout = 300
+
+    #: Number of seconds after expiry for which the stale response is
+    #: served while it is refreshed in the background (0 disables it)
+    cache_stale_timeout = 0
+
+    #: Names of query parameters whose values are included in the cache key
+    cache_query_params = ()
+
+    #: Tags (surrogate keys) with which the responses are stored. Handlers
+    #: can assign a different list to the ``cache_tags`` attribute to tag a
+    #: particular response (e.g., with the IDs of records it depends on).
+    cache_tags = ()
+
+    #: Headers that are not stored with the response
+    uncached_headers = ('content-length', 'set-cookie', 'date')
+
+    #: ``Cache-Control`` directives which prevent the response from being
+    #: stored, as it is specific to the user or must not be reused
+    uncached_directives = ('private', 'no-store', 'no-cache')
+
+    #: Cache key of the current request (``None`` if cache is not used)
+    cache_key = None
+    #: Whether the current response was served from the cache
+    cache_hit = False
+    #: Whether the current request is a background refresh
+    cache_refresh = False
+
+    def get_cache_backend(self):
+        """
+        Return the cache backend. Default behavior is to return the
+        :py:attr:`~CachedRouteMixin.cache_backend` property or the default
+        backend.
+        """
+        if self.cache_backend is None:
+            return default_cache
+        return self.cache_backend
+
+    def get_cache_key(self):
+        """
+        Return the cache key for the current request. Values of the request
+        headers listed in the ``vary`` attribute are part of the key, so each
+        variant of the response is cached separately.
+        """
+        query = self.request.query
+        params = [(p, query.getall(p)) for p in self.cache_query_params]
+        parts = [self.get_name(), self.args, sorted(self.kwargs.items()),
+                 params, bool(self.request.is_xhr)]
+        if self.vary:
+            parts.append([(name, self.request.get_header(name))
+                          for name in self.vary])
+        return make_key(*parts)
+
+    def is_cache_enabled(self):
+        """
+        Return ``True`` if the cache is used for the current request.
+        """
+        return self.method == 'get'
+
+    def get_cache_tags(self):
+        """
+        Return the tags with which the response is stored. Default behavior
+        is to return the :py:attr:`~CachedRouteMixin.cache_tags` property.
+        """
+        return self.cache_tags
+
+    def invalidate_cache_tags(self, tags):
+        """
+        Remove all cached responses which were stored with any of the
+        ``tags``. This is typically called by handlers which modify records
+        that cached pages depend on.
+        """
+        self.get_cache_backend().invalidate_tags(tags)
+
+    def get_cached_response(self):
+        """
+        Return the cached response for the current request, or ``None``.
+        """
+        return self.get_cache_backend().get(self.cache_key)
+
+    def apply_cached_response(self, cached):
+        """
+        Set the status and headers of the cached response on the response
+        object and return the body.
+        """
+        return apply_response(self.response, cached)
+
+    def revalidate(self):
+        """
+        Refresh the cached response in a background thread, unless a refresh
+        for the same key is already in progress.
+        """
+        key = self.cache_key
+        with revalidating_lock:
+            if key in revalidating:
+                return
+            revalidating.add(key)
+        environ = self.request.environ.copy()
+        thread = threading.Thread(target=self.refresh_cached_response,
+                                  args=(key, environ))
+        thread.daemon = True
+        thread.start()
+
+    def refresh_cached_response(self, key, environ):
+        """
+        Handle a copy of the request with specified environ, and store the
+        response in the cache. This method runs in a background thread.
+        """
+        try:
+            # Hooks and templates may use bottle's request and response, so
+            # they are bound to the copy of the request in this thread
+            bottle.request.bind(environ)
+            bottle.response.bind()
+            route = self.__class__.__new__(self.__class__)
+            route.request = bottle.request
+            route.response = bottle.response
+            route.cache_refresh = True
+            route.__init__(*self.args, **self.kwargs)
+            for _ in route.get_response_body():
+                pass
+        except Exception:
+            log.exception('Failed to refresh cached response %s', key)
+        finally:
+            with revalidating_lock:
+                revalidating.discard(key)
+
+    def create_response(self):
+        self.cache_key = None
+        if self.is_cache_enabled():
+            self.cache_key = self.get_cache_key()
+            cached = None
+            if not self.cache_refresh:
+                cached = self.get_cached_response()
+            if cached is not None:
+                self.cache_hit = True
+                self.body = self.apply_cached_response(cached)
+                if cached.is_stale():
+                    self.revalidate()
+                if self.is_not_modified():
+                    self.body = self.not_modified()
+                return
+        super(CachedRouteMixin, self).create_response()
+
+    def should_cache_response(self, body):
+        """
+        Return ``True`` if the response with specified body should be stored
+        in the cache.
+        """
+        if self.cache_key is None or self.cache_hit:
+            return False
+        if self.cache_timeout == 0 or self.response.status_code != 200:
+            return False
+        if not isinstance(body, bytes):
+            return False
+        for name, value in self.response.headerlist:
+            name = name.lower()
+            if name == 'set-cookie':
+                return False
+            if name == 'cache-control' and \
+                    self.has_uncached_directive(value):
+                return False
+        return True
+
+    def has_uncached_directive(self, cache_control):
+        """
+        Return ``True`` if the ``Cache-Control`` header value contains any of
+        :py:attr:`~CachedRouteMixin.uncached_directives`.
+        """
+        directives = set(d.split('=', 1)[0].strip().lower()
+                         for d in cache_control.split(','))
+        return any(d in directives for d in self.uncached_directives)
+
+    def cache_response(self, body):
+        """
+        Store the response with specified body in the cache.
+        """
+        headers = [(n, v) for n, v in self.response.headerlist
+                   if n.lower() not in self.uncached_headers]
+        cached = CachedResponse(self.response.status_code, headers, body)
+        timeout = self.cache_timeout
+        if timeout is not None and self.cache_stale_timeout:
+            cached.stale_after = time.time() + timeout
+            timeout += self.cache_stale_timeout
+        self.get_cache_backend().set(self.cache_key, cached, timeout,
+                                     self.get_cache_tags())
+
+    def adapt_body(self, body):
+        if isinstance(body, text_type):
+            body = body.encode(self.response.charset)
+        if self.should_cache_response(body):
+            self.cache_response(body)
+        return super(CachedRouteMixin, self).adapt_body(body)
+
+
+class Flight(object):
+    """
+    Request which is being handled while identical requests wait for its
+    response.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+
+    def wait(self, timeout=None):
+        """
+        Wait for the request to finish and return the shared response, or
+        ``None`` if the response cannot be shared or the wait timed out.
+        """
+        self.event.wait(timeout)
+        return self.response
+
+    def finish(self, response):
+        """
+        Release waiting requests with the specified shared response.
+        """
+        self.response = response
+        self.event.set()
+
+
+#: Requests which are being handled, by coalescing key
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+
+class CoalescingRouteMixin(object):
+    """
+    Mixin that coalesces identical GET requests which are handled at the same
+    time (single-flight). The first request is handled normally, while
+    identical requests that arrive before it finishes wait for it and receive
+    a copy of its response instead of invoking the handler method. Hooks are
+    still invoked for all requests. It must be placed before the route
+    handler class in the list of bases, and can be combined with
+    :py:class:`CachedRouteMixin` (placed before this mixin) or used on its own
+    for idempotent requests whose responses are not cacheable.
+
+    Example::
+
+        class Report(CoalescingRouteMixin, TemplateRoute):
+            template_name = 'report'
+
+    Requests are identical if they have the same route arguments, query
+    string, XHR flag, and values of the headers returned by
+    :py:meth:`~CoalescingRouteMixin.get_coalesce_headers` (by default
+    ``Cookie``, ``Authorization``, and the headers listed in the ``vary``
+    attribute), so personalized responses are not shared between users. Only
+    responses with 200 status, no cookies, and a
+    body that is a string are shared. Otherwise, and when the wait exceeds
+    :py:attr:`~CoalescingRouteMixin.coalesce_timeout`, the waiting requests
+    are handled normally.
+    """
+
+    #: Number of seconds to wait for an identical request to finish
+    coalesce_timeout = 30
+
+    #: Names of query parameters that make requests different (``None``
+    #: means the whole query string is used)
+    coalesce_query_params = None
+
+    #: Request headers whose values make requests different, in addition to
+    #: the headers listed in the ``vary`` attribute
+    coalesce_headers = ('Cookie', 'Authorization')
+
+    #: Headers that are not copied to the waiting requests
+    uncoalesced_headers = ('content-length', 'date')
+
+    #: Flight led by the current request and its key
+    flight = None
+    flight_key = None
+    #: Whether the current response was copied from an identical request
+    coalesced = False
+
+    def is_coalescing_enabled(self):
+        """
+        Return ``True`` if the current request may be coalesced.
+        """
+        return self.method == 'get'
+
+    def get_coalesce_headers(self):
+        """
+        Return the names of request headers whose values make requests
+        different. Default behavior is to return
+        :py:attr:`~CoalescingRouteMixin.coalesce_headers` followed by the
+        headers listed in the ``vary`` attribute.
+        """
+        return tuple(self.coalesce_headers) + tuple(self.vary)
+
+    def get_coalesce_key(self):
+        """
+        Return the key under which identical requests are coalesced.
+        """
+        query = self.request.query
+        if self.coalesce_query_params is None:
+            params = sorted(query.allitems())
+        else:
+            params = [(p, query.getall(p)) for p in self.coalesce_query_params]
+        headers = [(name, self.request.get_header(name))
+                   for name in self.get_coalesce_headers()]
+        return make_key(self.get_name(), self.args,
+                        sorted(self.kwargs.items()), params,
+                        bool(self.request.is_xhr), headers)
+
+    def create_response(self):
+        if not self.is_coalescing_enabled():
+            super(CoalescingRouteMixin, self).create_response()
+            return
+        key = self.get_coalesce_key()
+        with in_flight_lock:
+            flight = in_flight.get(key)
+            if flight is None:
+                self.flight = in_flight[key] = Flight()
+                self.flight_key = key
+        if flight is not None:
+            shared = flight.wait(self.coalesce_timeout)
+            if shared is not None:
+                self.coalesced = True
+                self.body = apply_response(self.response, shared)
+                return
+        super(CoalescingRouteMixin, self).create_response()
+
+    def finish_flight(self, shared):
+        """
+        Release the requests waiting for the current request.
+        """
+        flight = self.flight
+        self.flight = None
+        with in_flight_lock:
+            if in_flight.get(self.flight_key) is flight:
+                del in_flight[self.flight_key]
+        flight.finish(shared)
+
+    def get_shared_response(self, body):
+        """
+        Return a copy of the response with specified body for the waiting
+        requests, or ``None`` if it cannot be shared.
+        """
+        if not isinstance(body, bytes) or self.response.status_code != 200:
+            return None
+        headers = []
+        for name, value in self.response.headerlist:
+            name_lower = name.lower()
+            if name_lower == 'set-cookie':
+                return None
+            if name_lower not in self.uncoalesced_headers:
+                headers.append((name, value))
+        return CachedResponse(self.response.status_code, headers, body)
+
+    def adapt_body(self, body):
+        if self.flight is not None:
+            if isinstance(body, text_type):
+                body = body.encode(self.response.charset)
+            self.finish_flight(self.get_shared_response(body))
+        return super(CoalescingRouteMixin, self).adapt_body(body)
+
+    def get_response_body(self):
+        try:
+            return super(CoalescingRouteMixin, self).get_response_body()
+        finally:
+            # Release the waiting requests if the response was not created
+            if self.flight is not None:
+                self.finish_flight(None)
@@ -0,0 +1,305 @@
+"""
+This module contains a mixin which compresses responses according to the
+encodings that the client accepts.
+
+Brotli compression is used when the ``brotli`` package is installed.
+"""
+
+import hashlib
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from . import utils
+from .base import FLUSH, StreamingResponseMixin, text_type
+from .cache import CachedResponse, LRUCache
+
+
+#: Content types that are compressed in addition to ``text/*``
+COMPRESSIBLE_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/rss+xml',
+    'application/atom+xml',
+    'image/svg+xml',
+)
+
+#: Supported encodings in order of preference
+if brotli is None:
+    ENCODINGS = ('gzip', 'deflate')
+else:
+    ENCODINGS = ('br', 'gzip', 'deflate')
+
+#: Cache of compressed bodies used by default
+default_compression_cache = LRUCache(16 * 1024 * 1024)
+
+
+def parse_accept_encoding(value):
+    """
+    Return a dict which maps the encodings in the value of
+    ``Accept-Encoding`` header to their quality values.
+    """
+    encodings = {}
+    for item in value.split(','):
+        parts = item.split(';')
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, val = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(val)
+                except ValueError:
+                    quality = 0.0
+        encodings[name] = quality
+    return encodings
+
+
+def negotiate_encoding(accept_encoding, encodings):
+    """
+    Return the encoding from ``encodings`` which the client prefers according
+    to the value of ``Accept-Encoding`` header, or ``None`` if the client
+    does not accept any of them. When qualities are equal, the order of
+    ``encodings`` decides.
+    """
+    accepted = parse_accept_encoding(accept_encoding)
+    wildcard = accepted.get('*', 0.0)
+    best = None
+    best_quality = 0.0
+    for encoding in encodings:
+        quality = accepted.get(encoding, wildcard)
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+    return best
+
+
+def get_compressor(encoding, level):
+    """
+    Return an object with ``compress(data)``, ``flush()`` and ``finish()``
+    methods which compresses data incrementally using ``encoding``.
+    """
+    if encoding == 'br':
+        return BrotliCompressor(level)
+    return ZlibCompressor(encoding, level)
+
+
+class ZlibCompressor(object):
+    """
+    Incremental gzip or deflate (zlib format) compressor.
+    """
+
+    def __init__(self, encoding, level):
+        wbits = zlib.MAX_WBITS
+        if encoding == 'gzip':
+            wbits |= 16
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor(object):
+    """
+    Incremental brotli compressor. Compression level is used as brotli
+    quality, which ranges from 0 to 11.
+    """
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def compress(data, encoding, level):
+    """
+    Return ``data`` compressed using ``encoding``.
+    """
+    compressor = get_compressor(encoding, level)
+    return compressor.compress(data) + compressor.finish()
+
+
+class CompressionMixin(object):
+    """
+    Mixin that compresses the response body using gzip, deflate, or brotli
+    (if available), depending on the ``Accept-Encoding`` request header. It
+    must be placed before the route handler class in the list of bases, and
+    after :py:class:`~streamline.cache.CachedRouteMixin` and
+    :py:class:`~streamline.cache.CoalescingRouteMixin` if they are used, so
+    that those store the uncompressed response.
+
+    Example::
+
+        class Home(CompressionMixin, TemplateRoute):
+            template_name = 'home'
+
+    Bodies which are strings are compressed in one go. Compressed bodies are
+    kept in a bounded cache keyed by the hash of the uncompressed body, so
+    pages which render the same bytes for many requests are compressed once.
+    Other iterable bodies are compressed incrementally. Chunks of
+    :py:class:`~streamline.base.StreamingRoute` bodies are already coalesced,
+    so each of them is flushed to the client as it is produced. Other
+    iterables are flushed at the :py:data:`~streamline.base.FLUSH` marker and
+    after every :py:attr:`~CompressionMixin.compress_flush_size` bytes.
+
+    Responses are not compressed if they are smaller than
+    :py:attr:`~CompressionMixin.compress_min_size`, if their content type is
+    not compressible (e.g., images and archives are already compressed), if
+    they already have a ``Content-Encoding`` header, or if the body is a file
+    or a :py:class:`~bottle.HTTPResponse` object.
+    """
+
+    #: Encodings in order of preference
+    compress_encodings = ENCODINGS
+
+    #: Compression level (1-9)
+    compress_level = 6
+
+    #: Bodies smaller than this number of bytes are not compressed
+    compress_min_size = 512
+
+    #: Number of uncompressed bytes after which the compressor is flushed
+    #: when streaming bodies whose chunks are not coalesced
+    compress_flush_size = 64 * 1024
+
+    #: Cache of compressed bodies (``None`` disables caching)
+    compression_cache = default_compression_cache
+
+    def is_compressible_type(self, content_type):
+        """
+        Return ``True`` if responses with specified content type (without
+        parameters) should be compressed.
+        """
+        return (content_type.startswith('text/') or
+                content_type in COMPRESSIBLE_TYPES)
+
+    def get_content_encoding(self):
+        """
+        Return the encoding with which the response is compressed, or
+        ``None`` if it is not compressed.
+        """
+        response = self.response
+        if response.status_code in (204, 304) or \
+                'Content-Encoding' in response.headers:
+            return None
+        content_type = response.content_type or response.default_content_type
+        content_type = content_type.split(';')[0].strip().lower()
+        if not self.is_compressible_type(content_type):
+            return None
+        utils.add_vary(response.headers, 'Accept-Encoding')
+        accept_encoding = self.request.environ.get('HTTP_ACCEPT_ENCODING')
+        if not accept_encoding:
+            return None
+        return negotiate_encoding(accept_encoding, self.compress_encodings)
+
+    def set_encoding_headers(self, encoding):
+        """
+        Set the headers of the response compressed using ``encoding``. Strong
+        ``ETag`` is converted to a weak one, because the compressed body is
+        not byte-identical to the original.
+        """
+        headers = self.response.headers
+        headers['Content-Encoding'] = encoding
+        if 'Content-Length' in headers:
+            del headers['Content-Length']
+        etag = headers.get('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            headers['ETag'] = 'W/' + etag
+
+    def compress_body(self, body, encoding):
+        """
+        Return the bytestring ``body`` compressed using ``encoding``, using
+        the cache of compressed bodies.
+        """
+        cache = self.compression_cache
+        if cache is None:
+            return compress(body, encoding, self.compress_level)
+        key = '{}:{}:{}'.format(encoding, self.compress_level,
+                                hashlib.sha1(body).hexdigest())
+        cached = cache.get(key)
+        if cached is not None:
+            return cached.body
+        data = compress(body, encoding, self.compress_level)
+        cache.set(key, CachedResponse(200, [], data))
+        return data
+
+    def compress_stream(self, chunks, encoding):
+        """
+        Iterate over ``chunks`` and yield compressed chunks. The compressor is
+        flushed after each chunk if the chunks were coalesced by
+        :py:class:`~streamline.base.StreamingResponseMixin`, and otherwise at
+        the :py:data:`~streamline.base.FLUSH` marker and once
+        :py:attr:`~CompressionMixin.compress_flush_size` bytes are compressed
+        since the last flush, so that small chunks do not produce a block each.
+        """
+        compressor = get_compressor(encoding, self.compress_level)
+        charset = self.response.charset
+        coalesced = isinstance(self, StreamingResponseMixin)
+        # Compressed data is held until the compressor is flushed, so that
+        # each flush produces a single chunk
+        buf = []
+        pending = 0
+        for chunk in chunks:
+            if chunk is FLUSH:
+                if pending:
+                    buf.append(compressor.flush())
+                    yield b''.join(buf)
+                    buf = []
+                    pending = 0
+                continue
+            if isinstance(chunk, text_type):
+                chunk = chunk.encode(charset)
+            if not chunk:
+                continue
+            buf.append(compressor.compress(chunk))
+            pending += len(chunk)
+            if coalesced or pending >= self.compress_flush_size:
+                buf.append(compressor.flush())
+                yield b''.join(buf)
+                buf = []
+                pending = 0
+        buf.append(compressor.finish())
+        yield b''.join(buf)
+
+    def adapt_body(self, body):
+        if isinstance(body, self.HTTPResponse) or hasattr(body, 'read'):
+            return super(CompressionMixin, self).adapt_body(body)
+        encoding = self.get_content_encoding()
+        if encoding is None:
+            return super(CompressionMixin, self).adapt_body(body)
+        if isinstance(body, text_type):
+            body = body.encode(self.response.charset)
+        elif isinstance(body, (bytearray, memoryview)):
+            body = bytes(body)
+        elif isinstance(body, (list, tuple)) and \
+                all(isinstance(c, bytes) for c in body):
+            body = b''.join(body)
+        if isinstance(body, bytes):
+            if len(body) < self.compress_min_size:
+                return super(CompressionMixin, self).adapt_body(body)
+            self.set_encoding_headers(encoding)
+            return super(CompressionMixin, self).adapt_body(
+                self.compress_body(body, encoding))
+        chunks = super(CompressionMixin, self).adapt_body(body)
+        self.set_encoding_headers(encoding)
+        return self.compress_stream(chunks, encoding)
@@ -0,0 +1,221 @@
+"""
+This module contains the lazy template context used by
+:py:class:`~streamline.template.TemplateMixin`, and functions for registering
+application-wide context providers.
+
+Context values that are expensive to compute can be wrapped with
+:py:func:`lazy`, and they are only computed when the template accesses
+them::
+
+    class Home(TemplateRoute):
+        template_name = 'home'
+        default_context = {
+            'request': bottle.request,
+            'unread': lazy(lambda route: count_unread(route.request)),
+        }
+
+Providers are callables which take the route handler object as the only
+argument. Each provider is called at most once per request, and only when
+its value is used. Providers that apply to all templates of an application
+are registered once, similar to context processors in other frameworks::
+
+    @context_provider('menu', ttl=300)
+    def menu(route):
+        return load_navigation_menu()
+
+The value of a provider with ``ttl`` is shared by all requests, and computed
+again once it is older than ``ttl`` seconds, so such providers must not
+depend on the request.
+
+Context values are looked up in the ``body`` of the route handler first, then
+in :py:attr:`~streamline.template.TemplateMixin.default_context`, and then in
+the application's providers.
+
+Only the values which are read by the template function are computed.
+SimpleTemplate templates and blocks, whether rendered by
+:py:func:`bottle.template` (the default template function),
+:py:func:`~streamline.template.minified_template`, or
+:py:class:`~streamline.engines.SimpleTemplateEngine`, only read the names
+which appear in their code, unless they use ``include()``, ``rebase()``,
+``get()``, ``defined()`` or ``setdefault()``. Jinja2 and Mako engines copy
+the context into a dict, so all values are computed when the whole template
+is rendered.
+"""
+
+import threading
+import weakref
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+import bottle
+
+from .timing import clock
+
+
+#: Context providers registered for each application
+registry = weakref.WeakKeyDictionary()
+registry_lock = threading.Lock()
+
+
+class ContextProvider(object):
+    """
+    Wrapper for a callable which computes a context value from the route
+    handler object. If ``ttl`` is specified, the value is shared by all
+    requests for ``ttl`` seconds.
+    """
+
+    def __init__(self, fn, ttl=None):
+        self.fn = fn
+        self.ttl = ttl
+        self.cached = None
+        self.lock = threading.Lock()
+
+    def __call__(self, route):
+        if self.ttl is None:
+            return self.fn(route)
+        cached = self.cached
+        if cached is not None and clock() < cached[0]:
+            return cached[1]
+        with self.lock:
+            # Another thread may have computed the value in the meantime
+            cached = self.cached
+            if cached is not None and clock() < cached[0]:
+                return cached[1]
+            value = self.fn(route)
+            self.cached = (clock() + self.ttl, value)
+        return value
+
+    def clear(self):
+        """
+        Discard the cached value.
+        """
+        self.cached = None
+
+
+def lazy(fn, ttl=None):
+    """
+    Wrap ``fn`` so that it is evaluated when the context value is accessed
+    (see :py:class:`ContextProvider`).
+    """
+    return ContextProvider(fn, ttl)
+
+
+def register_provider(name, fn, ttl=None, app=None):
+    """
+    Register ``fn`` as the provider of context value ``name`` for all
+    templates rendered by route handlers of ``app`` (Bottle's default app if
+    omitted).
+    """
+    app = app or bottle.default_app()
+    with registry_lock:
+        # Providers are replaced rather than modified, so that they can be
+        # read without locking
+        providers = dict(registry.get(app, {}))
+        providers[name] = ContextProvider(fn, ttl)
+        registry[app] = providers
+
+
+def context_provider(name=None, ttl=None, app=None):
+    """
+    Decorator which registers the decorated function as context provider
+    (see :py:func:`register_provider`). The name of the function is used if
+    ``name`` is omitted.
+    """
+    def decorator(fn):
+        register_provider(name or fn.__name__, fn, ttl, app)
+        return fn
+    return decorator
+
+
+def get_providers(app):
+    """
+    Return a dict of context providers registered for ``app``.
+    """
+    if app is None:
+        return {}
+    return registry.get(app, {})
+
+
+class LazyContext(MutableMapping):
+    """
+    Template context whose values are looked up in ``mappings`` in order, and
+    copied into the context on first access. Values which are
+    :py:class:`ContextProvider` objects are called with ``route`` as the
+    argument, so each of them is evaluated at most once. The mappings
+    themselves are not modified.
+    """
+
+    def __init__(self, route, *mappings):
+        self.route = route
+        self.mappings = mappings
+        self.values = {}
+        self.removed = set()
+
+    def __getitem__(self, key):
+        try:
+            return self.values[key]
+        except KeyError:
+            if key in self.removed:
+                raise
+        for mapping in self.mappings:
+            if key in mapping:
+                value = mapping[key]
+                if isinstance(value, ContextProvider):
+                    value = value(self.route)
+                self.values[key] = value
+                return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+        self.removed.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.values.pop(key, None)
+        self.removed.add(key)
+
+    def __contains__(self, key):
+        if key in self.values:
+            return True
+        if key in self.removed:
+            return False
+        return any(key in mapping for mapping in self.mappings)
+
+    def __iter__(self):
+        seen = set(self.removed)
+        for key in self.values:
+            seen.add(key)
+            yield key
+        for mapping in self.mappings:
+            for key in mapping:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(self.__class__.__name__,
+                                  sorted(self.values))
+
+    def is_evaluated(self, key):
+        """
+        Return ``True`` if the value of ``key`` has been accessed or set.
+        """
+        return key in self.values
+
+    def copy(self):
+        """
+        Return a copy of the context which shares the values evaluated so
+        far.
+        """
+        ctx = self.__class__(self.route, *self.mappings)
+        ctx.values = self.values.copy()
+        ctx.removed = set(self.removed)
+        return ctx
@@ -0,0 +1,454 @@
+"""
+This module contains template engines which can be used by template route
+handler classes instead of :py:func:`bottle.template`.
+
+Unlike :py:func:`bottle.template`, which keeps all templates it has ever
+loaded in a global dict and recompiles them on every request in debug mode,
+engines keep a bounded number of compiled templates per application, and only
+check template files for changes when automatic reloading is enabled. To use
+an engine, specify its class as the
+:py:attr:`~streamline.template.TemplateMixin.template_engine` property::
+
+    class Home(TemplateRoute):
+        template_name = 'home'
+        template_engine = Jinja2Engine
+
+Each application gets its own instance of each engine class, which is
+configured using the following application config keys:
+
+- ``streamline.templates.max_templates``: maximum number of compiled
+  templates kept in memory (default is 256)
+- ``streamline.templates.auto_reload``: whether template files are checked
+  for changes, which should only be enabled in development (default is off)
+
+Jinja2 and Mako engines are only available if the respective packages are
+installed.
+"""
+
+import os
+import re
+import threading
+import types
+import weakref
+from collections import OrderedDict
+
+import bottle
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+try:
+    from mako import exceptions as mako_exceptions
+    from mako import lookup as mako_lookup
+except ImportError:
+    mako_lookup = None
+
+
+#: Engine instances by application
+registry = weakref.WeakKeyDictionary()
+registry_lock = threading.Lock()
+
+#: Names used by templates (see :py:func:`get_context_names`)
+context_names = weakref.WeakKeyDictionary()
+
+BLOCK_START_RE = re.compile(r'^\s*%\s*#\s*block\s+(\w+)\s*$')
+BLOCK_END_RE = re.compile(r'^\s*%\s*#\s*endblock\b')
+
+#: Names which give SimpleTemplate code access to the whole context, so the
+#: context cannot be narrowed to the names that the code uses
+DYNAMIC_NAMES = frozenset(['include', 'rebase', 'get', 'setdefault',
+                           'defined', 'locals', 'globals', 'vars', 'eval',
+                           'exec'])
+
+
+def extract_block(source, name):
+    """
+    Return the part of the SimpleTemplate source between ``% # block name``
+    and the matching ``% # endblock`` lines, or ``None`` if there is no such
+    block. Blocks may be nested.
+    """
+    lines = source.splitlines(True)
+    start = None
+    depth = 0
+    for i, line in enumerate(lines):
+        match = BLOCK_START_RE.match(line)
+        if match:
+            if start is None:
+                if match.group(1) == name:
+                    start = i + 1
+            else:
+                depth += 1
+        elif start is not None and BLOCK_END_RE.match(line):
+            if depth == 0:
+                return ''.join(lines[start:i])
+            depth -= 1
+    return None
+
+
+def get_code_names(code):
+    """
+    Return the set of global names used by the code object and the code
+    objects nested in it.
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= get_code_names(const)
+    return names
+
+
+def get_context_names(template):
+    """
+    Return the set of names the :py:class:`~bottle.SimpleTemplate` uses, or
+    ``None`` if the template may access any context value (e.g., it includes
+    or extends other templates) or is not a SimpleTemplate.
+    """
+    try:
+        return context_names[template]
+    except KeyError:
+        pass
+    names = None
+    if isinstance(template, bottle.SimpleTemplate):
+        names = get_code_names(template.co)
+        if names & DYNAMIC_NAMES:
+            names = None
+    context_names[template] = names
+    return names
+
+
+def merge_context(args, kwargs):
+    """
+    Return the context passed to a template function as mappings in ``args``
+    and keyword arguments in ``kwargs``. A single mapping is returned as is,
+    so that values of a :py:class:`~streamline.context.LazyContext` are not
+    evaluated until the template uses them.
+    """
+    if len(args) == 1 and not kwargs:
+        return args[0]
+    for dictarg in args:
+        kwargs.update(dictarg)
+    return kwargs
+
+
+def narrow_context(context, names):
+    """
+    Return a dict containing only the values of ``context`` whose keys are in
+    ``names``. Other values of a
+    :py:class:`~streamline.context.LazyContext` are not evaluated.
+    """
+    return dict((key, context[key]) for key in names if key in context)
+
+
+class TemplateEngine(object):
+    """
+    Base class for template engines. Engine objects are callable with the
+    same arguments as :py:func:`bottle.template`, so they can be used
+    anywhere a template function is expected.
+    """
+
+    def __init__(self, lookup=None, max_templates=256, auto_reload=False,
+                 **settings):
+        if lookup is None:
+            lookup = bottle.TEMPLATE_PATH
+        self.lookup = [os.path.abspath(path) for path in lookup]
+        self.max_templates = max_templates
+        self.auto_reload = auto_reload
+        self.settings = settings
+
+    def get_template(self, name):
+        """
+        Return the compiled template with specified name. Raises
+        :py:exc:`bottle.TemplateError` if the template does not exist.
+        """
+        raise NotImplementedError()
+
+    def render_template(self, template, context):
+        """
+        Render the template object returned by
+        :py:meth:`~TemplateEngine.get_template` using the context dict.
+        """
+        raise NotImplementedError()
+
+    def stream_template(self, template, context):
+        """
+        Render the template object returned by
+        :py:meth:`~TemplateEngine.get_template` using the context dict, and
+        return an iterator of rendered chunks. Default behavior is to render
+        the whole template as a single chunk, and engines which support
+        incremental rendering should override it.
+        """
+        return iter([self.render_template(template, context)])
+
+    def stream(self, name, *args, **kwargs):
+        """
+        Same as calling the engine, but returns an iterator of rendered
+        chunks (see :py:meth:`~TemplateEngine.stream_template`).
+        """
+        return self.stream_template(self.get_template(name),
+                                    merge_context(args, kwargs))
+
+    def render_block(self, name, block, context):
+        """
+        Render only the block named ``block`` of the template with specified
+        name using the ``context`` mapping. Raises
+        :py:exc:`bottle.TemplateError` if the block does not exist.
+        """
+        raise NotImplementedError('{} does not support rendering '
+                                  'blocks'.format(self.__class__.__name__))
+
+    def load(self, name):
+        """
+        Load and compile the template with specified name.
+        """
+        self.get_template(name)
+
+    def clear(self):
+        """
+        Discard all compiled templates.
+        """
+        raise NotImplementedError()
+
+    def __call__(self, name, *args, **kwargs):
+        return self.render_template(self.get_template(name),
+                                    merge_context(args, kwargs))
+
+
+class SimpleTemplateEngine(TemplateEngine):
+    """
+    Engine which renders :py:class:`~bottle.SimpleTemplate` templates. Least
+    recently used templates are discarded once there are more than
+    ``max_templates`` of them. The ``adapter`` attribute can be set to a
+    subclass of :py:class:`~bottle.SimpleTemplate`, such as
+    :py:class:`~streamline.template.MinifiedSimpleTemplate`.
+
+    Templates are not rendered incrementally, because a template which
+    extends a base template using ``rebase()`` must be rendered completely
+    before the base template is.
+
+    Blocks, which can be rendered on their own using
+    :py:meth:`~TemplateEngine.render_block`, are marked with template
+    comments, so they do not affect the rendering of the whole template::
+
+        % # block items
+        % for item in items:
+            <li>{{ item }}</li>
+        % end
+        % # endblock
+
+    The block is compiled as a separate template, so only its code is
+    executed, and only the context values it uses are looked up. The same is
+    true for whole templates, unless they use ``include()``, ``rebase()``,
+    ``get()``, ``defined()`` or ``setdefault()``, which may access any value.
+    """
+
+    #: Template class
+    adapter = bottle.SimpleTemplate
+
+    def __init__(self, *args, **kwargs):
+        super(SimpleTemplateEngine, self).__init__(*args, **kwargs)
+        self.templates = OrderedDict()
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.templates)
+
+    def get_mtime(self, template):
+        """
+        Return the modification time of the template file.
+        """
+        try:
+            return os.stat(template.filename).st_mtime
+        except (OSError, TypeError):
+            return None
+
+    def get_template(self, name):
+        with self.lock:
+            entry = self.templates.pop(name, None)
+            if entry is not None:
+                # Re-insert to mark the template as most recently used
+                self.templates[name] = entry
+        if entry is not None:
+            template, mtime = entry
+            if not self.auto_reload or self.get_mtime(template) == mtime:
+                return template
+        template = self.adapter(name=name, lookup=self.lookup,
+                                **self.settings)
+        template.co  # Compile the template
+        with self.lock:
+            self.templates[name] = (template, self.get_mtime(template))
+            while len(self.templates) > self.max_templates:
+                self.templates.popitem(last=False)
+        return template
+
+    def render_template(self, template, context):
+        names = get_context_names(template)
+        if names is not None:
+            context = narrow_context(context, names)
+        return template.render(context)
+
+    def get_block(self, name, block):
+        """
+        Return the compiled block of the template and the set of names it
+        uses.
+        """
+        template = self.get_template(name)
+        entry = self.blocks.get((name, block))
+        if entry is not None and entry[0] is template:
+            return entry[1:]
+        source = template.source
+        if not source:
+            with open(template.filename, 'rb') as f:
+                source = f.read()
+        region = extract_block(bottle.touni(source, template.encoding),
+                               block)
+        if region is None:
+            raise bottle.TemplateError('Block {!r} not found in template '
+                                       '{!r}.'.format(block, name))
+        block_template = self.adapter(source=region, lookup=self.lookup,
+                                      **self.settings)
+        names = get_code_names(block_template.co)
+        with self.lock:
+            # Blocks of templates which were discarded are discarded as well
+            self.blocks = dict((key, value)
+                               for key, value in self.blocks.items()
+                               if key[0] in self.templates)
+            self.blocks[(name, block)] = (template, block_template, names)
+        return block_template, names
+
+    def render_block(self, name, block, context):
+        block_template, names = self.get_block(name, block)
+        return block_template.render(narrow_context(context, names))
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+            self.blocks.clear()
+
+
+class Jinja2Engine(TemplateEngine):
+    """
+    Engine which renders Jinja2 templates using a single
+    :py:class:`jinja2.Environment`, whose template cache is limited to
+    ``max_templates``. Template names without an extension are looked up
+    with the extensions listed in the ``extensions`` attribute. Templates are
+    rendered incrementally when streamed.
+    """
+
+    #: Extensions tried when template name is not found as is
+    extensions = ('html', 'jinja2', 'j2', 'tpl')
+
+    def __init__(self, *args, **kwargs):
+        if jinja2 is None:
+            raise RuntimeError('Jinja2Engine requires jinja2 package')
+        super(Jinja2Engine, self).__init__(*args, **kwargs)
+        self.env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(self.lookup),
+            cache_size=self.max_templates,
+            auto_reload=self.auto_reload,
+            **self.settings)
+
+    def get_template(self, name):
+        names = [name] + ['{}.{}'.format(name, ext)
+                          for ext in self.extensions]
+        try:
+            return self.env.select_template(names)
+        except jinja2.TemplatesNotFound:
+            raise bottle.TemplateError(
+                'Template {!r} not found.'.format(name))
+
+    def render_template(self, template, context):
+        return template.render(context)
+
+    def stream_template(self, template, context):
+        return template.generate(context)
+
+    def render_block(self, name, block, context):
+        template = self.get_template(name)
+        try:
+            render = template.blocks[block]
+        except KeyError:
+            raise bottle.TemplateError('Block {!r} not found in template '
+                                       '{!r}.'.format(block, name))
+        return u''.join(render(template.new_context(dict(context))))
+
+    def clear(self):
+        self.env.cache.clear()
+
+
+class MakoEngine(TemplateEngine):
+    """
+    Engine which renders Mako templates using a single
+    :py:class:`mako.lookup.TemplateLookup`, whose template collection is
+    limited to ``max_templates``.
+    """
+
+    #: Extensions tried when template name is not found as is
+    extensions = ('html', 'mako', 'tpl')
+
+    def __init__(self, *args, **kwargs):
+        if mako_lookup is None:
+            raise RuntimeError('MakoEngine requires mako package')
+        super(MakoEngine, self).__init__(*args, **kwargs)
+        self.template_lookup = self.create_lookup()
+
+    def create_lookup(self):
+        """
+        Return a new template lookup object.
+        """
+        return mako_lookup.TemplateLookup(
+            directories=self.lookup,
+            collection_size=self.max_templates,
+            filesystem_checks=self.auto_reload,
+            **self.settings)
+
+    def get_template(self, name):
+        for uri in [name] + ['{}.{}'.format(name, ext)
+                             for ext in self.extensions]:
+            try:
+                return self.template_lookup.get_template(uri)
+            except mako_exceptions.TopLevelLookupException:
+                continue
+        raise bottle.TemplateError('Template {!r} not found.'.format(name))
+
+    def render_template(self, template, context):
+        return template.render(**context)
+
+    def render_block(self, name, block, context):
+        template = self.get_template(name)
+        if not template.has_def(block):
+            raise bottle.TemplateError('Block {!r} not found in template '
+                                       '{!r}.'.format(block, name))
+        return template.get_def(block).render(**context)
+
+    def clear(self):
+        self.template_lookup = self.create_lookup()
+
+
+def parse_bool(value):
+    """
+    Convert a config value, which may be a string, to a boolean.
+    """
+    if hasattr(value, 'lower'):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def get_engine(engine_class, app):
+    """
+    Return the instance of ``engine_class`` for the application, creating it
+    on first use.
+    """
+    with registry_lock:
+        engines = registry.setdefault(app, {})
+        engine = engines.get(engine_class)
+        if engine is None:
+            config = app.config
+            engine = engines[engine_class] = engine_class(
+                max_templates=int(config.get(
+                    'streamline.templates.max_templates', 256)),
+                auto_reload=parse_bool(config.get(
+                    'streamline.templates.auto_reload', False)))
+    return engine
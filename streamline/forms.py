@@ -46,6 +46,10 @@ class FormMixin(object):
     #: :py:class:`~streamline.forms.FormAdaptor`.
     form_factory = FormAdaptor
 
+    #: Result of the form validation, or ``None`` if the form was not
+    #: validated
+    form_is_valid = None
+
     def get_form_factory(self):
         """
         Return form factory function/class. Default behvarior is to return the
@@ -105,7 +109,8 @@ class FormMixin(object):
             handled in classes that include the
             :py:class:`~streamline.forms.FormBase` mixin.
         """
-        if self.validate_form(self.form):
+        self.form_is_valid = self.validate_form(self.form)
+        if self.form_is_valid:
             return self.form_valid(*args, **kwargs)
         return self.form_invalid(*args, **kwargs)
 
@@ -0,0 +1,431 @@
+"""
+This module contains a metrics registry which collects per-route request
+metrics, and a route handler class which serves them in the Prometheus text
+exposition format.
+
+Metrics are collected for all route handler classes once the registry is
+installed::
+
+    from streamline import metrics
+
+    metrics.install()
+    metrics.MetricsRoute.route()
+
+The following metrics are collected, labeled with the route name returned by
+:py:meth:`~streamline.base.RouteBase.get_name`:
+
+- ``streamline_requests_total``: number of requests by method and status
+- ``streamline_request_duration_seconds``: histogram of request latency
+- ``streamline_response_size_bytes``: histogram of response body sizes
+- ``streamline_template_render_seconds``: histogram of template render time
+- ``streamline_form_validations_total``: form validation results
+
+To keep contention low, each thread updates its own set of metrics without
+locking, and the sets are only merged when metrics are exported. When the
+application runs in several (prefork) worker processes, specify a directory
+shared by the workers as ``multiprocess_dir``. Each worker periodically writes
+its metrics to a file in that directory, and the metrics of all workers are
+added together when exported. Metrics are also written every
+``flush_interval`` seconds by a background thread, and when the worker
+exits, so that the metrics of idle workers are not left behind.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+
+from .base import RouteBase
+from .timing import clock
+
+
+INF = float('inf')
+
+#: Default latency histogram buckets in seconds
+TIME_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, INF)
+
+#: Default response size histogram buckets in bytes
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, INF)
+
+#: Metric types and descriptions
+METRICS = {
+    'streamline_requests_total': (
+        'counter', 'Total number of requests.'),
+    'streamline_request_duration_seconds': (
+        'histogram', 'Time spent handling requests.'),
+    'streamline_response_size_bytes': (
+        'histogram', 'Size of response bodies.'),
+    'streamline_template_render_seconds': (
+        'histogram', 'Time spent rendering templates.'),
+    'streamline_form_validations_total': (
+        'counter', 'Total number of form validations.'),
+}
+
+
+def escape_label(value):
+    """
+    Escape label value for use in the text exposition format.
+    """
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+
+def format_labels(labels):
+    """
+    Format a sequence of ``(name, value)`` pairs as a label set.
+    """
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(k, escape_label(v))
+                                    for k, v in labels))
+
+
+def format_value(value):
+    """
+    Format a sample value or bucket boundary.
+    """
+    if value == INF:
+        return '+Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def merge(target, source):
+    """
+    Add the metrics in ``source`` to ``target``. Both are dicts mapping
+    ``(name, labels)`` keys to counter values or lists of histogram values.
+    """
+    for key, value in source:
+        if isinstance(value, list):
+            current = target.get(key)
+            if current is None:
+                target[key] = list(value)
+            else:
+                for i, v in enumerate(value):
+                    current[i] += v
+        else:
+            target[key] = target.get(key, 0) + value
+
+
+class MetricsRegistry(object):
+    """
+    Collection of counters and histograms. Each thread records the metrics
+    into its own dict, and dicts of all threads are merged on export.
+
+    Histograms are stored as lists containing the number of observations in
+    each bucket, followed by the sum and count of observations.
+    """
+
+    def __init__(self, time_buckets=TIME_BUCKETS, size_buckets=SIZE_BUCKETS,
+                 multiprocess_dir=None, flush_interval=5.0):
+        self.time_buckets = self.normalize_buckets(time_buckets)
+        self.size_buckets = self.normalize_buckets(size_buckets)
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # Held while the metrics are written to the multiprocess directory
+        self.flush_lock = threading.Lock()
+        self.reset()
+
+    @staticmethod
+    def normalize_buckets(buckets):
+        """
+        Return sorted buckets as a tuple, ending with the infinity bucket.
+        """
+        buckets = sorted(buckets)
+        if buckets[-1] != INF:
+            buckets.append(INF)
+        return tuple(buckets)
+
+    def reset(self):
+        """
+        Discard all metrics recorded in this process.
+        """
+        self.pid = os.getpid()
+        self.local = threading.local()
+        # Pairs of threads and the dicts in which they record metrics
+        self.stores = []
+        # Metrics recorded by threads which have finished
+        self.retired = {}
+        self.last_flush = clock()
+        self.flusher_pid = None
+
+    def get_store(self):
+        """
+        Return the dict in which the current thread records the metrics.
+        """
+        if self.pid != os.getpid():
+            # Metrics inherited from the parent process are not ours
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.reset()
+        try:
+            return self.local.store
+        except AttributeError:
+            store = self.local.store = {}
+            with self.lock:
+                self.prune()
+                self.stores.append((threading.current_thread(), store))
+                if self.multiprocess_dir and \
+                        self.flusher_pid != os.getpid():
+                    self.start_flusher()
+            return store
+
+    def prune(self):
+        """
+        Merge the metrics of threads which have finished into the retired
+        metrics, so that servers which start a thread per request do not
+        accumulate a dict per request. Must be called with the lock held.
+        """
+        alive = []
+        for thread, store in self.stores:
+            if thread.is_alive():
+                alive.append((thread, store))
+            else:
+                merge(self.retired, list(store.items()))
+        self.stores = alive
+
+    def start_flusher(self):
+        """
+        Start a thread which writes the metrics of this process to the
+        multiprocess directory every ``flush_interval`` seconds, so that
+        metrics are exported even when the process stops handling requests,
+        and write them once more when the process exits.
+        """
+        pid = self.flusher_pid = os.getpid()
+        thread = threading.Thread(target=self.run_flusher, args=(pid,))
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.flush_at_exit, pid)
+
+    def run_flusher(self, pid):
+        """
+        Flush the metrics periodically while the registry belongs to process
+        ``pid``.
+        """
+        while self.flusher_pid == pid:
+            time.sleep(self.flush_interval)
+            if self.flusher_pid == pid and \
+                    clock() - self.last_flush >= self.flush_interval:
+                self.try_flush()
+
+    def flush_at_exit(self, pid):
+        """
+        Flush the metrics if the exiting process is the one that registered
+        this handler (forked children inherit the handlers).
+        """
+        if self.flusher_pid == pid == os.getpid():
+            self.try_flush(blocking=True)
+
+    def try_flush(self, blocking=False):
+        """
+        Flush the metrics, ignoring errors (e.g., when the multiprocess
+        directory has been removed). Failed flushes are retried later. Unless
+        ``blocking`` is ``True``, the metrics are not flushed if another
+        thread is already flushing them.
+        """
+        try:
+            self.flush(blocking)
+        except (IOError, OSError):
+            pass
+
+    def inc(self, name, labels, value=1):
+        """
+        Increment a counter.
+        """
+        store = self.get_store()
+        key = (name, labels)
+        store[key] = store.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        """
+        Record an observation in a histogram with specified buckets.
+        """
+        store = self.get_store()
+        key = (name, labels)
+        hist = store.get(key)
+        if hist is None:
+            hist = store[key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                hist[i] += 1
+                break
+        hist[-2] += value
+        hist[-1] += 1
+
+    def observe_route(self, route, timing):
+        """
+        Record the metrics for a finished request using the route handler
+        object and its :py:class:`~streamline.timing.Timing` record.
+        """
+        name = route.get_name()
+        route_label = (('route', name),)
+        self.inc('streamline_requests_total',
+                 (('route', name),
+                  ('method', route.method.upper()),
+                  ('status', str(timing.status))))
+        self.observe('streamline_request_duration_seconds',
+                     (('route', name), ('method', route.method.upper())),
+                     timing.elapsed, self.time_buckets)
+        self.observe('streamline_response_size_bytes', route_label,
+                     timing.size, self.size_buckets)
+        if any(phase == 'render' for phase, _ in timing.phases):
+            self.observe('streamline_template_render_seconds', route_label,
+                         timing.get('render'), self.time_buckets)
+        valid = getattr(route, 'form_is_valid', None)
+        if valid is not None:
+            self.inc('streamline_form_validations_total',
+                     (('route', name),
+                      ('result', 'valid' if valid else 'invalid')))
+        if self.multiprocess_dir and \
+                clock() - self.last_flush > self.flush_interval:
+            # This runs while the response is sent, so errors must not
+            # propagate, and the request does not wait for another flush
+            self.try_flush()
+
+    def snapshot(self):
+        """
+        Return a dict containing the metrics of all threads in this process.
+        """
+        with self.lock:
+            self.prune()
+            stores = [store for _, store in self.stores]
+            merged = {}
+            merge(merged, list(self.retired.items()))
+        for store in stores:
+            # Copying the items is atomic, so the owning thread may keep
+            # updating the store while we merge
+            merge(merged, list(store.items()))
+        return merged
+
+    def get_path(self, pid):
+        """
+        Return the path of the file in which process ``pid`` stores metrics.
+        """
+        return os.path.join(self.multiprocess_dir,
+                            'metrics-{}.json'.format(pid))
+
+    def flush(self, blocking=True):
+        """
+        Write the metrics of this process to the multiprocess directory.
+        Flushes are serialized, and if ``blocking`` is ``False``, the method
+        returns ``False`` without flushing when another thread is already
+        flushing the metrics. Returns ``True`` otherwise.
+        """
+        if not self.flush_lock.acquire(blocking):
+            return False
+        try:
+            self.last_flush = clock()
+            data = [[name, [list(l) for l in labels], value]
+                    for (name, labels), value in self.snapshot().items()]
+            path = self.get_path(os.getpid())
+            tmp = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, path)
+        finally:
+            self.flush_lock.release()
+        return True
+
+    def collect(self):
+        """
+        Return a dict containing the metrics of all threads in this process,
+        and of other processes that wrote their metrics to the multiprocess
+        directory.
+        """
+        merged = self.snapshot()
+        if not self.multiprocess_dir:
+            return merged
+        own = os.path.basename(self.get_path(os.getpid()))
+        for filename in os.listdir(self.multiprocess_dir):
+            if not filename.endswith('.json') or filename == own:
+                continue
+            path = os.path.join(self.multiprocess_dir, filename)
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            merge(merged, [((name, tuple(tuple(l) for l in labels)), value)
+                           for name, labels, value in data])
+        return merged
+
+    def get_buckets(self, name):
+        """
+        Return the buckets of the histogram with specified name.
+        """
+        if name == 'streamline_response_size_bytes':
+            return self.size_buckets
+        return self.time_buckets
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+        by_name = {}
+        for (name, labels), value in self.collect().items():
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(by_name):
+            kind, description = METRICS.get(name, ('untyped', name))
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in sorted(by_name[name]):
+                if kind != 'histogram':
+                    lines.append('{}{} {}'.format(name, format_labels(labels),
+                                                  format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.get_buckets(name), value):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name,
+                        format_labels(labels + (('le', format_value(bound)),)),
+                        cumulative))
+                lines.append('{}_sum{} {}'.format(
+                    name, format_labels(labels), format_value(value[-2])))
+                lines.append('{}_count{} {}'.format(
+                    name, format_labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+#: Default metrics registry
+registry = MetricsRegistry()
+
+
+def install(metrics_registry=None, route_class=RouteBase):
+    """
+    Start collecting metrics for ``route_class`` and all its subclasses
+    (defaults to all route handler classes). If ``metrics_registry`` is
+    omitted, the default registry is used. Returns the registry.
+    """
+    metrics_registry = metrics_registry or registry
+    route_class.metrics = metrics_registry
+    return metrics_registry
+
+
+class MetricsRoute(RouteBase):
+    """
+    Route handler class which serves the metrics in the Prometheus text
+    exposition format. The metrics of the default registry are served unless
+    metrics are collected into a different registry.
+    """
+
+    #: Route path
+    path = '/metrics'
+
+    #: Content type of the text exposition format
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def get_registry(self):
+        """
+        Return the registry whose metrics are served.
+        """
+        return self.metrics or registry
+
+    def get(self):
+        self.response.content_type = self.content_type
+        return self.get_registry().render()
@@ -2,9 +2,336 @@
 This module contains mixins and classes for working with templates.
 """
 
+import functools
+import glob
+import hashlib
+import marshal
+import os
+import re
+import sys
+
 import bottle
 
-from .base import NonIterableRouteBase
+from . import context, engines, utils
+from .base import (FLUSH, NonIterableRouteBase, StreamingResponseMixin,
+                   text_type)
+from .timing import clock
+
+
+#: Parts of the template source which are not minified: elements whose
+#: whitespace is significant and template tags and expressions
+PRESERVED_RE = re.compile(
+    r'<(pre|textarea|script|style)\b.*?</\1\s*>'
+    r'|\{\{.*?\}\}|\{%.*?%\}|\{#.*?#\}|<%.*?%>',
+    re.I | re.S)
+LINE_BREAK_RE = re.compile(r'[ \t]*\n\s*')
+SPACE_RE = re.compile(r'[ \t]{2,}')
+
+#: Minified templates compiled by :py:func:`minified_template`
+MINIFIED_TEMPLATES = {}
+
+#: Number of seconds spent loading and compiling each preloaded template
+template_load_times = {}
+
+#: Tag which identifies the interpreter in names of compiled template files
+if hasattr(sys, 'implementation'):
+    CACHE_TAG = sys.implementation.cache_tag
+else:
+    CACHE_TAG = 'python-{}{}'.format(*sys.version_info[:2])
+
+
+def collapse_whitespace(text):
+    """
+    Remove indentation, trailing whitespace and blank lines from the text,
+    and collapse runs of spaces into one, except in template code lines
+    (those starting with ``%``).
+    """
+    lines = LINE_BREAK_RE.sub('\n', text).split('\n')
+    return '\n'.join(line if line.startswith('%') else SPACE_RE.sub(' ', line)
+                     for line in lines)
+
+
+def minify_html(source):
+    """
+    Return the template source with redundant whitespace removed. Contents
+    of ``pre``, ``textarea``, ``script`` and ``style`` elements, and template
+    tags and expressions are left intact. Line breaks are kept, so that line
+    based template syntax still works.
+    """
+    parts = []
+    pos = 0
+    for match in PRESERVED_RE.finditer(source):
+        parts.append(collapse_whitespace(source[pos:match.start()]))
+        parts.append(match.group(0))
+        pos = match.end()
+    parts.append(collapse_whitespace(source[pos:]))
+    return ''.join(parts)
+
+
+class MinifiedSimpleTemplate(bottle.SimpleTemplate):
+    """
+    :py:class:`~bottle.SimpleTemplate` whose source is minified using
+    :py:func:`minify_html` when the template is loaded. Since the minified
+    source is compiled, rendering cost is unchanged while the output is
+    smaller. Included templates are minified as well.
+    """
+
+    def prepare(self, **kwargs):
+        super(MinifiedSimpleTemplate, self).prepare(**kwargs)
+        source = self.source
+        if not source:
+            with open(self.filename, 'rb') as f:
+                source = f.read()
+        self.source = minify_html(bottle.touni(source, self.encoding))
+
+
+class CodeCache(object):
+    """
+    Directory in which compiled template code is stored, similar to Python's
+    bytecode cache. Files are named after the hash of the template filename,
+    hash of the source, and the interpreter's cache tag, so code is only
+    reused for the same source compiled by a compatible interpreter. When a
+    template is compiled after its source has changed, the code compiled from
+    the previous source is removed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get_prefix(self, filename, settings):
+        """
+        Return the part of the file name which identifies the template.
+        """
+        data = repr((filename, settings)).encode('utf8')
+        return hashlib.sha1(data).hexdigest()[:16]
+
+    def get_path(self, source, filename, settings):
+        """
+        Return the path of the file in which the code compiled from
+        ``source`` is stored.
+        """
+        digest = hashlib.sha1(source.encode('utf8')).hexdigest()
+        return os.path.join(self.path, '{}-{}.{}.code'.format(
+            self.get_prefix(filename, settings), digest, CACHE_TAG))
+
+    def load(self, path):
+        """
+        Return the code object stored in ``path``, or ``None`` if it is
+        missing or cannot be read.
+        """
+        try:
+            with open(path, 'rb') as f:
+                return marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def save(self, path, code):
+        """
+        Store the code object in ``path``, and remove code compiled from
+        other versions of the same template.
+        """
+        prefix = os.path.basename(path).split('-')[0]
+        for old in glob.glob(os.path.join(self.path, prefix + '-*.code')):
+            if old != path:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                marshal.dump(code, f)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            # The cache is an optimization, so failing to write is harmless
+            pass
+
+
+class CodeCacheMixin(object):
+    """
+    Mixin for :py:class:`~bottle.SimpleTemplate` adapter classes which stores
+    the compiled template code in the :py:class:`CodeCache` specified by the
+    ``code_cache`` attribute, and loads it from there instead of compiling
+    the template again. Use :py:func:`cached_template_func` to create a
+    template function that uses it.
+    """
+
+    #: :py:class:`CodeCache` object (``None`` disables the cache)
+    code_cache = None
+
+    @bottle.cached_property
+    def co(self):
+        compile_code = bottle.SimpleTemplate.__dict__['co'].func
+        if self.code_cache is None:
+            return compile_code(self)
+        if not self.source:
+            with open(self.filename, 'rb') as f:
+                self.source = f.read()
+        source = bottle.touni(self.source, self.encoding)
+        settings = sorted((k, getattr(v, '__name__', repr(v)))
+                          for k, v in self.settings.items())
+        path = self.code_cache.get_path(source, self.filename, settings)
+        code = self.code_cache.load(path)
+        if code is None:
+            code = compile_code(self)
+            self.code_cache.save(path, code)
+        return code
+
+
+def cached_template_func(path, adapter=bottle.SimpleTemplate):
+    """
+    Return a template function compatible with :py:func:`bottle.template`
+    which stores compiled templates in the directory at ``path``, so that
+    worker processes load them instead of compiling them on startup. The
+    ``adapter`` may be :py:class:`~bottle.SimpleTemplate` or its subclass
+    such as :py:class:`MinifiedSimpleTemplate`. Compiled templates are kept
+    in a dict of the returned function, separately from the templates used
+    by :py:func:`bottle.template`. Example::
+
+        cached_template = cached_template_func('/var/cache/myapp/templates')
+
+        class Home(TemplateRoute):
+            template_name = 'home'
+            template_func = staticmethod(cached_template)
+    """
+    cached_adapter = type('Cached' + adapter.__name__,
+                          (CodeCacheMixin, adapter),
+                          {'code_cache': CodeCache(path)})
+    templates = {}
+
+    def cached_template(*args, **kwargs):
+        tpl = args[0] if args else None
+        for dictarg in args[1:]:
+            kwargs.update(dictarg)
+        template = get_template(tpl, cached_adapter,
+                                kwargs.pop('template_lookup', None),
+                                kwargs.pop('template_settings', None),
+                                templates)
+        return template.render(kwargs)
+
+    cached_template.template_loader = (cached_adapter, templates)
+    return cached_template
+
+
+def minified_template(*args, **kwargs):
+    """
+    Render a template like :py:func:`bottle.template`, but minify its source
+    when it is loaded (see :py:class:`MinifiedSimpleTemplate`). Minified
+    templates are compiled once and cached separately from the templates
+    used by :py:func:`bottle.template`. This function can be used as
+    :py:attr:`~TemplateMixin.template_func`::
+
+        class Home(TemplateRoute):
+            template_name = 'home'
+            template_func = staticmethod(minified_template)
+    """
+    tpl = args[0] if args else None
+    for dictarg in args[1:]:
+        kwargs.update(dictarg)
+    template = get_template(tpl, MinifiedSimpleTemplate,
+                            kwargs.pop('template_lookup', None),
+                            kwargs.pop('template_settings', None),
+                            MINIFIED_TEMPLATES)
+    return template.render(kwargs)
+
+
+def get_template(tpl, adapter=bottle.SimpleTemplate, lookup=None,
+                 settings=None, cache=None):
+    """
+    Return the template object for template name or source ``tpl``, and
+    store it in ``cache`` (:py:data:`bottle.TEMPLATES` by default). This
+    function looks up and creates templates the same way as
+    :py:func:`bottle.template`, so templates it loads into
+    :py:data:`bottle.TEMPLATES` are used by :py:func:`bottle.template`.
+    """
+    if lookup is None:
+        lookup = bottle.TEMPLATE_PATH
+    if cache is None:
+        cache = bottle.TEMPLATES
+    key = (id(lookup), tpl)
+    template = cache.get(key)
+    if template is None or bottle.DEBUG:
+        settings = settings or {}
+        if '\n' in tpl or '{' in tpl or '%' in tpl or '$' in tpl:
+            template = adapter(source=tpl, lookup=lookup, **settings)
+        else:
+            template = adapter(name=tpl, lookup=lookup, **settings)
+        cache[key] = template
+    return template
+
+
+def get_template_loader(template_func):
+    """
+    Return the template adapter class and cache used by the template
+    function, or ``None`` if the function is not known. Known functions are
+    :py:func:`bottle.template`, its partials such as
+    :py:func:`bottle.jinja2_template`, :py:func:`minified_template`, and
+    functions returned by :py:func:`cached_template_func`.
+    """
+    # Only look at attributes that were set on the function, as opposed to
+    # those which any callable object may provide
+    loader = getattr(template_func, '__dict__', {}).get('template_loader')
+    if loader is not None:
+        return loader
+    if template_func is minified_template:
+        return MinifiedSimpleTemplate, MINIFIED_TEMPLATES
+    if template_func is bottle.template:
+        return bottle.SimpleTemplate, bottle.TEMPLATES
+    if isinstance(template_func, functools.partial) and \
+            template_func.func is bottle.template:
+        adapter = template_func.keywords.get('template_adapter',
+                                             bottle.SimpleTemplate)
+        return adapter, bottle.TEMPLATES
+    return None
+
+
+def load_template(name, template_func=bottle.template):
+    """
+    Locate, read and compile the template with specified name, so that it is
+    ready to be rendered by ``template_func``, and return the number of
+    seconds it took. The ``template_func`` may also be a
+    :py:class:`~streamline.engines.TemplateEngine` object. The time is also
+    stored in :py:data:`template_load_times`. Raises :py:exc:`bottle.TemplateError` if
+    the template does not exist, and :py:exc:`ValueError` if templates of
+    ``template_func`` cannot be preloaded.
+    """
+    if isinstance(template_func, engines.TemplateEngine):
+        start = clock()
+        template_func.load(name)
+        elapsed = template_load_times[name] = clock() - start
+        return elapsed
+    loader = get_template_loader(template_func)
+    if loader is None:
+        raise ValueError('Cannot preload templates rendered by '
+                         '{!r}'.format(template_func))
+    adapter, cache = loader
+    start = clock()
+    template = get_template(name, adapter, cache=cache)
+    # SimpleTemplate compiles the code on first access, other adapters
+    # compile the templates when they are created
+    getattr(template, 'co', None)
+    elapsed = template_load_times[name] = clock() - start
+    return elapsed
+
+
+def warm_up(app=None):
+    """
+    Load and compile the templates of all template route classes registered
+    on ``app`` (Bottle's default app if omitted), so that the first requests
+    after the application starts do not pay for it. This is typically called
+    in each worker process after the routes are registered. Returns a dict
+    which maps template names to the number of seconds it took to load them.
+    Missing templates raise :py:exc:`bottle.TemplateError`.
+    """
+    app = app or bottle.default_app()
+    times = {}
+    for route in app.routes:
+        cls = route.callback
+        if isinstance(cls, type) and issubclass(cls, TemplateMixin):
+            times.update(cls.load_templates(app))
+    return times
 
 
 class TemplateMixin(object):
@@ -23,6 +350,61 @@ class TemplateMixin(object):
     #: Default (base) template context
     default_context = {'request': bottle.request}
 
+    #: :py:class:`~streamline.timing.Timing` object used to record the time
+    #: spent building the context and rendering the template
+    timing = None
+
+    #: :py:class:`~streamline.engines.TemplateEngine` subclass used to render
+    #: the templates instead of :py:attr:`~TemplateMixin.template_func`. Each
+    #: application uses its own instance of the engine.
+    template_engine = None
+
+    #: Whether :py:meth:`~TemplateMixin.render_template` returns an iterator
+    #: of rendered chunks (see :py:class:`StreamingTemplateRoute`)
+    stream_template = False
+
+    #: Whether templates are loaded and compiled when the route is registered
+    #: (see :py:meth:`~TemplateMixin.load_templates`)
+    preload_templates = False
+
+    @classmethod
+    def route(cls, path=None, name=None, app=None, **kwargs):
+        """
+        Register the route, and load the templates if
+        :py:attr:`~TemplateMixin.preload_templates` is enabled.
+        """
+        super(TemplateMixin, cls).route(path, name, app, **kwargs)
+        if cls.preload_templates:
+            cls.load_templates(app)
+
+    @classmethod
+    def get_template_names(cls):
+        """
+        Return the names of templates which are loaded by
+        :py:meth:`~TemplateMixin.load_templates`. Default behavior is to
+        return the :py:attr:`~TemplateMixin.template_name` property if it is
+        set.
+        """
+        return [cls.template_name] if cls.template_name else []
+
+    @classmethod
+    def load_templates(cls, app=None):
+        """
+        Load and compile the templates returned by
+        :py:meth:`~TemplateMixin.get_template_names` using the template
+        engine for ``app`` (Bottle's default app if omitted) or the loader of
+        :py:attr:`~TemplateMixin.template_func`, and return a dict which maps
+        template names to the number of seconds it took to load them. Fails
+        with :py:exc:`bottle.TemplateError` if a template does not exist.
+        """
+        if cls.template_engine is not None:
+            template_func = engines.get_engine(cls.template_engine,
+                                               app or bottle.default_app())
+        else:
+            template_func = cls.template_func
+        return dict((name, load_template(name, template_func))
+                    for name in cls.get_template_names())
+
     def get_template_name(self, template_name=None):
         """
         Returns template name. Default behavior is to return the value of the
@@ -38,16 +420,21 @@ class TemplateMixin(object):
 
     def get_default_context(self):
         """
-        Returns default context. Default behavior is to return the value of the
-        :py:attr:`~TemplateMixin.default_context` property. The property must
-        be a dict, and it is copied before being returned so that the original
-        remains intact.
+        Returns default context. Default behavior is to return a
+        :py:class:`~streamline.context.LazyContext` backed by the
+        :py:attr:`~TemplateMixin.default_context` property and the context
+        providers registered for the application, so that the original dict
+        remains intact without being copied. Values wrapped with
+        :py:func:`~streamline.context.lazy` are only computed if the template
+        uses them.
         """
-        return self.default_context.copy()
+        return context.LazyContext(
+            self, self.default_context,
+            context.get_providers(getattr(self, 'app', None)))
 
     def get_context(self):
         """
-        Returns the complete template context. This context is is a dict, and
+        Returns the complete template context. This context is a mapping, and
         is built from the default context by augmenting it with the contents of
         the ``body`` attribute on the route handler class.
 
@@ -65,19 +452,126 @@ class TemplateMixin(object):
     def get_template_func(self):
         """
         Return a template rendering function. Default behavior is to return the
+        engine of the current application if
+        :py:attr:`~TemplateMixin.template_engine` is set, or the
         :py:attr:`~TemplateMixin.template_func`, which must be a callable.
         """
+        if self.template_engine is not None:
+            return engines.get_engine(self.template_engine, self.app)
         return self.template_func
 
     def render_template(self):
         """
         Renders the template using the template name, context, and function
-        obtained by calling the respective methods.
+        obtained by calling the respective methods. If
+        :py:attr:`~TemplateMixin.stream_template` is enabled, the result of
+        :py:meth:`~TemplateMixin.render_template_stream` is returned instead.
+
+        If timing is recorded, the time spent building the context and
+        rendering the template is recorded as ``context`` and ``render``
+        phases respectively.
+        """
+        if self.stream_template:
+            return self.render_template_stream()
+        template = self.get_template_name()
+        timing = self.timing
+        if timing is None:
+            ctx = self.get_context()
+            fn = self.get_template_func()
+            return self.call_template_func(fn, template, ctx)
+        start = clock()
+        ctx = self.get_context()
+        fn = self.get_template_func()
+        rendered = clock()
+        timing.add('context', rendered - start)
+        try:
+            return self.call_template_func(fn, template, ctx)
+        finally:
+            timing.add('render', clock() - rendered)
+
+    def render_template_stream(self):
+        """
+        Return an iterator of rendered chunks of the template. Templates are
+        rendered incrementally if :py:attr:`~TemplateMixin.template_engine`
+        supports it (see
+        :py:meth:`~streamline.engines.TemplateEngine.stream_template`), and as
+        a single chunk otherwise.
+
+        If timing is recorded, the time spent building the context is
+        recorded as ``context`` phase, while rendering is part of the
+        ``body`` phase.
         """
         template = self.get_template_name()
+        start = clock()
         ctx = self.get_context()
+        if self.timing is not None:
+            self.timing.add('context', clock() - start)
         fn = self.get_template_func()
-        return fn(template, ctx)
+        if isinstance(fn, engines.TemplateEngine) and \
+                self.get_template_block() is None:
+            return fn.stream(template, ctx)
+        return iter([self.call_template_func(fn, template, ctx)])
+
+    def get_template_block(self):
+        """
+        Return the name of the template block to render instead of the whole
+        template, or ``None`` to render the whole template. Default behavior
+        is to return ``None``.
+        """
+        return None
+
+    def call_template_func(self, fn, template, ctx):
+        """
+        Render the template using the template function ``fn``. When the
+        context is a :py:class:`~streamline.context.LazyContext` and ``fn``
+        is :py:func:`bottle.template` or another function whose templates
+        can be loaded by :py:func:`get_template_loader`, only the context
+        values which the template uses are evaluated (see
+        :py:func:`~streamline.engines.get_context_names`). If
+        :py:meth:`~TemplateMixin.get_template_block` returns a block name,
+        only that block is rendered, which requires ``fn`` to be a
+        :py:class:`~streamline.engines.TemplateEngine` object or
+        :py:func:`bottle.template` (in which case the application's
+        :py:class:`~streamline.engines.SimpleTemplateEngine` is used).
+        """
+        block = self.get_template_block()
+        if block is None:
+            loader = None
+            if isinstance(ctx, context.LazyContext) and \
+                    not isinstance(fn, functools.partial):
+                loader = get_template_loader(fn)
+            if loader is None:
+                return fn(template, ctx)
+            # Render the template the same way as the function does, but
+            # only evaluate the context values the template uses
+            adapter, cache = loader
+            tpl = get_template(template, adapter, cache=cache)
+            names = engines.get_context_names(tpl)
+            if names is not None:
+                ctx = engines.narrow_context(ctx, names)
+            return tpl.render(ctx)
+        if not isinstance(fn, engines.TemplateEngine):
+            if fn is not bottle.template:
+                raise ValueError('Cannot render blocks using '
+                                 '{!r}'.format(fn))
+            fn = engines.get_engine(engines.SimpleTemplateEngine, self.app)
+        return fn.render_block(template, block, ctx)
+
+
+def flush_after(chunks, marker):
+    """
+    Iterate over ``chunks`` and yield them, followed by the
+    :py:data:`~streamline.base.FLUSH` marker after the first chunk that
+    contains ``marker``.
+    """
+    chunks = iter(chunks)
+    for chunk in chunks:
+        yield chunk
+        if isinstance(chunk, text_type) and marker in chunk:
+            yield FLUSH
+            break
+    for chunk in chunks:
+        yield chunk
 
 
 class TemplateRoute(TemplateMixin, NonIterableRouteBase):
@@ -95,25 +589,108 @@ class TemplateRoute(TemplateMixin, NonIterableRouteBase):
         self.body = self.render_template()
 
 
+class StreamingTemplateRoute(StreamingResponseMixin, TemplateRoute):
+    """
+    Class that renders the template incrementally and sends the response
+    while the template is still being rendered, so that the time to first
+    byte and memory use do not depend on the size of the page. Rendered
+    chunks are buffered like in :py:class:`~streamline.base.StreamingRoute`,
+    but the buffer is flushed as soon as the end of the document head
+    (:py:attr:`~StreamingTemplateRoute.flush_marker`) is rendered, so that
+    browsers can start loading stylesheets and scripts early.
+
+    Incremental rendering requires a template engine that supports it, such
+    as :py:class:`~streamline.engines.Jinja2Engine`::
+
+        class Listing(StreamingTemplateRoute):
+            template_name = 'listing'
+            template_engine = Jinja2Engine
+
+    With other engines and template functions, the whole page is rendered
+    before it is sent.
+
+    :subclasses: :py:class:`~streamline.template.TemplateRoute`
+    :includes: :py:class:`~streamline.base.StreamingResponseMixin`
+    """
+
+    stream_template = True
+
+    #: Text after which the buffered chunks are flushed (``None`` disables
+    #: early flushing)
+    flush_marker = '</head>'
+
+    def render_template_stream(self):
+        chunks = super(StreamingTemplateRoute, self).render_template_stream()
+        if self.flush_marker is None:
+            return chunks
+        return flush_after(chunks, self.flush_marker)
+
+
 class XHRPartialRoute(TemplateRoute):
     """
     Class that renders different templates depending on whether request is XHR
     or not.
 
+    Since the response depends on the ``X-Requested-With`` header, the header
+    is listed in the ``Vary`` header of both kinds of responses, so that
+    browsers and proxies cache the full page and the partial separately.
+    Server-side caching (:py:class:`~streamline.cache.CachedRouteMixin`) also
+    keeps separate entries for the two variants.
+
     :subclasses: :py:class:`~streamline.template.TemplateRoute`
     """
 
     #: Name of a partial template that is rendered for XHR requests
     partial_template_name = None
 
+    #: Name of the template block that is rendered for XHR requests instead
+    #: of a separate partial template. Only the block's code is executed,
+    #: and with template engines that support it, only the context values
+    #: used by the block are looked up (see
+    #: :py:class:`~streamline.engines.SimpleTemplateEngine`).
+    partial_block_name = None
+
+    #: Value of the ``Cache-Control`` header for XHR responses. By default,
+    #: partials are not cached. Set it to a different policy (e.g.,
+    #: ``'private, max-age=60'``) for partials that can be cached, or to
+    #: ``None`` to leave the header as set by the handler.
+    xhr_cache_control = 'no-store'
+
     def get_template_name(self):
         template_name = (self.partial_template_name
                          if self.request.is_xhr else None)
         return super(XHRPartialRoute, self).get_template_name(template_name)
 
+    def get_template_block(self):
+        """
+        Return :py:attr:`~XHRPartialRoute.partial_block_name` for XHR
+        requests, and ``None`` otherwise.
+        """
+        if self.request.is_xhr:
+            return self.partial_block_name
+        return None
+
+    @classmethod
+    def get_template_names(cls):
+        names = super(XHRPartialRoute, cls).get_template_names()
+        if cls.partial_template_name:
+            names.append(cls.partial_template_name)
+        return names
+
+    def get_xhr_cache_control(self):
+        """
+        Return the value of the ``Cache-Control`` header for XHR responses.
+        Default behavior is to return the
+        :py:attr:`~XHRPartialRoute.xhr_cache_control` property.
+        """
+        return self.xhr_cache_control
+
     def create_response(self):
         if self.request.is_xhr:
-            self.response.headers['Cache-Control'] = 'no-store'
+            cache_control = self.get_xhr_cache_control()
+            if cache_control is not None:
+                self.response.headers['Cache-Control'] = cache_control
         super(XHRPartialRoute, self).create_response()
+        utils.add_vary(self.response.headers, 'X-Requested-With')
 
 ROCARoute = XHRPartialRoute
@@ -0,0 +1,81 @@
+"""
+This module contains tools for measuring the time spent in different phases
+of request handling.
+"""
+
+import re
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import time as clock
+
+
+TOKEN_RE = re.compile(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]")
+
+
+def get_hook_name(hook):
+    """
+    Return a name for the hook suitable for use as a phase name.
+    """
+    name = getattr(hook, '__name__', None) or type(hook).__name__
+    return TOKEN_RE.sub('_', name)
+
+
+class Timing(object):
+    """
+    Record of the time spent in each phase of handling a single request.
+    Phases are stored in the :py:attr:`~Timing.phases` list as ``(name,
+    duration)`` tuples, in the order in which they were completed. Durations
+    are in seconds.
+
+    Once the request is finished, :py:attr:`~Timing.elapsed` holds the wall
+    clock time since ``start``, :py:attr:`~Timing.status` the response status
+    code, and :py:attr:`~Timing.size` the number of body bytes produced.
+    """
+
+    def __init__(self, start=None):
+        self.start = clock() if start is None else start
+        self.phases = []
+        self.elapsed = None
+        self.status = None
+        self.size = None
+
+    def add(self, name, duration):
+        """
+        Record the duration of a phase.
+        """
+        self.phases.append((name, duration))
+
+    def get(self, name):
+        """
+        Return the total duration of the phases with the specified name.
+        """
+        return sum(d for n, d in self.phases if n == name)
+
+    def finish(self, status, size):
+        """
+        Mark the request as finished.
+        """
+        self.elapsed = clock() - self.start
+        self.status = status
+        self.size = size
+
+    @property
+    def total(self):
+        """
+        Total duration of all recorded phases.
+        """
+        return sum(d for _, d in self.phases)
+
+    def as_header(self):
+        """
+        Return the recorded phases formatted as a ``Server-Timing`` header
+        value. Durations are in milliseconds.
+        """
+        return ', '.join('{};dur={:.3f}'.format(TOKEN_RE.sub('_', name),
+                                                duration * 1000)
+                         for name, duration in self.phases)
+
+    def __repr__(self):
+        return '<Timing {}>'.format(self.as_header())
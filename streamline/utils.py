@@ -2,7 +2,9 @@
 This module includes utility functions that are used in other modules.
 """
 
+import os
 import re
+import stat
 
 
 WORD_RE = re.compile('([A-Z]+[a-z0-9]*)')
@@ -26,3 +28,56 @@ def decamelize(s):
 
     """
     return '_'.join(WORD_RE.findall(s)).lower()
+
+
+def with_metaclass(meta, *bases):
+    """
+    Create a base class with a metaclass in a way that works on both Python 2
+    and Python 3.
+
+    Example::
+
+        >>> class Foo(with_metaclass(Meta, object)):
+        ...     pass
+
+    The temporary class that is created by this function is replaced by the
+    actual class when the subclass is created, so it never shows up in the
+    MRO.
+    """
+    class metaclass(meta):
+        def __new__(cls, name, this_bases, attrs):
+            return meta(name, bases, attrs)
+    return type.__new__(metaclass, 'temporary_class', (), {})
+
+
+def get_file_size(fileobj):
+    """
+    Return the number of bytes that remain to be read from a file object, or
+    ``None`` if the size cannot be determined (e.g., the object is not backed
+    by a regular file).
+    """
+    try:
+        st = os.fstat(fileobj.fileno())
+        pos = fileobj.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st.st_size - pos
+
+
+def add_vary(headers, *names):
+    """
+    Add header names to the ``Vary`` header in ``headers`` (a dict-like
+    object), keeping the names that are already listed.
+    """
+    current = headers.get('Vary')
+    values = [v.strip() for v in current.split(',')] if current else []
+    seen = set(v.lower() for v in values)
+    if '*' in seen:
+        return
+    for name in names:
+        if name.lower() not in seen:
+            values.append(name)
+            seen.add(name.lower())
+    headers['Vary'] = ', '.join(values)
@@ -1,4 +1,5 @@
 import os
+import sys
 import time
 import signal
 import httplib
@@ -16,6 +17,11 @@ import pytest
 TESTDIR = os.path.abspath(os.path.dirname(__file__))
 SAMPLES = os.path.join(TESTDIR, 'sample_apps')
 
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append(os.path.join('unit', 'test_aio.py'))
+    collect_ignore.append(os.path.join('unit', 'test_asgi.py'))
+
 
 class TestClient:
     XHR = {'X-Requested-With': 'XMLHttpRequest'}
@@ -0,0 +1,101 @@
+import asyncio
+
+import bottle
+import mock
+
+from streamline import aio as mod
+
+
+MOD = mod.__name__
+
+
+def test_event_loop_thread_runs_coroutine():
+    async def coro():
+        await asyncio.sleep(0)
+        return 'foo'
+    loop = mod.EventLoopThread()
+    assert loop.run(coro()) == 'foo'
+    assert loop.thread.daemon
+
+
+def test_event_loop_thread_restarted_after_fork():
+    loop = mod.EventLoopThread()
+    first = loop.get_loop()
+    assert loop.get_loop() is first
+    loop.pid = -1
+    assert loop.get_loop() is not first
+
+
+@mock.patch.object(mod.AsyncRouteBase, 'request')
+@mock.patch.object(mod.AsyncRouteBase, 'response', bottle.BaseResponse())
+def test_coroutine_handler(request):
+    request.method = 'GET'
+
+    class Foo(mod.AsyncRouteBase):
+        async def get(self, name):
+            self.response.headers['foo'] = 'bar'
+            return 'Hello, {}'.format(name)
+    f = Foo('world')
+    f.create_response()
+    assert f.body == 'Hello, world'
+    assert Foo.response.headers['foo'] == 'bar'
+
+
+@mock.patch.object(mod.AsyncRouteBase, 'request')
+def test_regular_handler(request):
+    request.method = 'GET'
+
+    class Foo(mod.AsyncRouteBase):
+        def get(self):
+            return 'foo'
+    f = Foo()
+    f.create_response()
+    assert f.body == 'foo'
+
+
+@mock.patch.object(mod.AsyncTemplateRoute, 'request')
+@mock.patch.object(mod.AsyncTemplateRoute, 'response', bottle.BaseResponse())
+def test_coroutine_template_handler(request):
+    request.method = 'GET'
+    template_func = mock.Mock(return_value='rendered')
+
+    class Foo(mod.AsyncTemplateRoute):
+        template_name = 'foo'
+
+        async def get(self):
+            return {'foo': 'bar'}
+    Foo.template_func = template_func
+    f = Foo()
+    f.create_response()
+    assert f.body == 'rendered'
+    ctx = template_func.call_args[0][1]
+    assert ctx['foo'] == 'bar'
+
+
+@mock.patch.object(mod.AsyncFormRoute, 'request')
+@mock.patch.object(mod.AsyncFormRoute, 'response', bottle.BaseResponse())
+def test_coroutine_form_valid(request):
+    request.method = 'POST'
+    request.forms = {}
+
+    class Foo(mod.AsyncFormRoute):
+        async def form_valid(self):
+            return 'valid'
+    f = Foo()
+    f.create_response()
+    assert f.body == 'valid'
+
+
+@mock.patch.object(mod.AsyncRouteBase, 'request')
+@mock.patch.object(mod.AsyncRouteBase, 'response', bottle.BaseResponse())
+def test_coroutine_hooks(request):
+    calls = []
+
+    async def hook(route):
+        calls.append('hook')
+
+    class Foo(mod.AsyncRouteBase):
+        pass
+    f = Foo()
+    f.run_hooks([hook])
+    assert calls == ['hook']
@@ -0,0 +1,140 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import bottle
+import pytest
+
+from streamline import asgi as mod
+from streamline.base import RouteBase, StreamingRoute
+from streamline.template import XHRPartialRoute
+
+
+def call(app, scope, body=b''):
+    messages = []
+    received = [{'type': 'http.request', 'body': body}]
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        messages.append(message)
+
+    scope = dict({'type': 'http', 'query_string': b'', 'headers': []},
+                 **scope)
+    asyncio.run(app(scope, receive, send))
+    return messages
+
+
+def make_app(*routes, **kwargs):
+    app = bottle.Bottle()
+    for path, route in routes:
+        route.route(path, app=app)
+    return mod.ASGIApplication(app, **kwargs)
+
+
+def test_get_environ():
+    app = mod.ASGIApplication(bottle.Bottle())
+    scope = {
+        'type': 'http',
+        'method': 'GET',
+        'path': '/foo',
+        'query_string': b'a=1',
+        'headers': [(b'content-type', b'text/plain'),
+                    (b'x-foo', b'1'),
+                    (b'x-foo', b'2')],
+        'server': ('example.com', 8000),
+    }
+    environ = app.get_environ(scope, None)
+    assert environ['PATH_INFO'] == '/foo'
+    assert environ['QUERY_STRING'] == 'a=1'
+    assert environ['CONTENT_TYPE'] == 'text/plain'
+    assert environ['HTTP_X_FOO'] == '1,2'
+    assert environ['SERVER_PORT'] == '8000'
+
+
+def test_route_response():
+    class Hello(RouteBase):
+        def get(self, name):
+            self.response.headers['foo'] = 'bar'
+            return 'Hello, {}'.format(name)
+    app = make_app(('/<name>', Hello))
+    messages = call(app, {'method': 'GET', 'path': '/world'})
+    start = messages[0]
+    assert start['status'] == 200
+    assert (b'foo', b'bar') in start['headers']
+    assert (b'content-length', b'12') in start['headers']
+    assert b''.join(m.get('body', b'') for m in messages[1:]) == \
+        b'Hello, world'
+    assert messages[-1].get('more_body', False) is False
+
+
+def test_form_data():
+    class Echo(RouteBase):
+        def post(self):
+            return self.request.forms.get('foo')
+    app = make_app(('/', Echo))
+    messages = call(app, {
+        'method': 'POST',
+        'path': '/',
+        'headers': [(b'content-type', b'application/x-www-form-urlencoded')],
+    }, body=b'foo=bar')
+    assert messages[1]['body'] == b'bar'
+
+
+def test_method_not_allowed():
+    class Hello(RouteBase):
+        def get(self):
+            return 'hello'
+    app = make_app(('/', Hello))
+    messages = call(app, {'method': 'DELETE', 'path': '/'})
+    assert messages[0]['status'] == 405
+
+
+def test_streaming_response():
+    class Stream(StreamingRoute):
+        buffer_size = 1
+
+        def get(self):
+            for _ in range(5):
+                yield self.request.path
+                yield bottle.request.query.get('a')
+    executor = ThreadPoolExecutor(4)
+    app = make_app(('/foo', Stream), executor=executor)
+    try:
+        for _ in range(3):
+            messages = call(app, {'method': 'GET', 'path': '/foo',
+                                  'query_string': b'a=bar'})
+            bodies = [m['body'] for m in messages[1:]]
+            assert bodies == [b'/foo', b'bar'] * 5 + [b'']
+    finally:
+        executor.shutdown()
+
+
+def test_streaming_response_error():
+    class Stream(StreamingRoute):
+        buffer_size = 1
+
+        def get(self):
+            yield 'foo'
+            raise ValueError('boom')
+    app = make_app(('/', Stream))
+    with pytest.raises(ValueError):
+        call(app, {'method': 'GET', 'path': '/'})
+
+
+def test_xhr_partial():
+    class Page(XHRPartialRoute):
+        template_name = 'full'
+        partial_template_name = 'partial'
+
+        def get(self):
+            return {}
+    Page.template_func = staticmethod(lambda name, ctx: name)
+    app = make_app(('/', Page))
+    messages = call(app, {
+        'method': 'GET',
+        'path': '/',
+        'headers': [(b'x-requested-with', b'XMLHttpRequest')],
+    })
+    assert messages[1]['body'] == b'partial'
+    assert (b'cache-control', b'no-store') in messages[0]['headers']
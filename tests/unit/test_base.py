@@ -1,4 +1,7 @@
+import datetime
+
 import pytest
+import bottle
 import mock
 
 from streamline import base as mod
@@ -359,3 +362,575 @@ def test_hook_decorators(request):
     foo = Foo()
     foo = list(foo)
     assert calls == ['fn1', 'get', 'fn2']
+
+
+def test_compiled_handlers():
+    class FooBar(mod.RouteBase):
+        def get(self):
+            pass
+
+        def post(self):
+            pass
+    assert sorted(FooBar._handlers) == ['get', 'post']
+    assert FooBar._handlers['get'] is FooBar.__dict__['get']
+
+
+def test_compiled_handlers_inherited():
+    class Foo(mod.RouteBase):
+        def get(self):
+            pass
+
+    class Bar(Foo):
+        def delete(self):
+            pass
+    assert Bar.get_valid_methods() == ['GET', 'DELETE']
+    assert Foo.get_valid_methods() == ['GET']
+
+
+def test_compiled_handlers_updated_on_assignment():
+    class Foo(mod.RouteBase):
+        pass
+
+    class Bar(Foo):
+        pass
+    Foo.put = lambda self: 'put'
+    assert Bar.get_valid_methods() == ['PUT']
+    del Foo.put
+    assert Bar.get_valid_methods() == []
+
+
+def test_compiled_name_updated_on_assignment():
+    class FooBar(mod.RouteBase):
+        pass
+    FooBar.name = 'teddy'
+    assert FooBar.get_name() == 'teddy'
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+def test_method_not_allowed_sets_allow_header(request):
+    import bottle
+
+    class FooBar(mod.RouteBase):
+        def get(self):
+            pass
+
+        def patch(self):
+            pass
+    request.method = 'POST'
+    f = FooBar()
+    with pytest.raises(bottle.HTTPError) as exc:
+        f.create_response()
+    assert exc.value.status_code == 405
+    assert exc.value.headers['Allow'] == 'GET, PATCH'
+
+
+@mock.patch.object(mod.StreamingRoute, 'request')
+@mock.patch.object(mod.StreamingRoute, 'response')
+def test_streaming_route_coalesces_chunks(response, request):
+    response.charset = 'UTF-8'
+    request.method = 'GET'
+
+    class Foo(mod.StreamingRoute):
+        buffer_size = 4
+
+        def get(self):
+            yield 'ab'
+            yield b'cd'
+            yield 'e'
+            yield self.FLUSH
+            yield 'f'
+    assert list(Foo()) == [b'abcd', b'e', b'f']
+
+
+@mock.patch.object(mod.StreamingRoute, 'request')
+@mock.patch.object(mod.StreamingRoute, 'response')
+def test_streaming_route_string_body(response, request):
+    response.charset = 'UTF-8'
+    request.method = 'GET'
+
+    class Foo(mod.StreamingRoute):
+        def get(self):
+            return 'foo'
+    assert list(Foo()) == [b'foo']
+
+
+@mock.patch.object(mod.StreamingRoute, 'request')
+def test_streaming_route_http_response(request):
+    request.method = 'GET'
+
+    class Foo(mod.StreamingRoute):
+        def get(self):
+            return self.HTTPResponse('foo')
+    body = list(Foo())
+    assert len(body) == 1
+    assert isinstance(body[0], mod.bottle.HTTPResponse)
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+@mock.patch.object(mod.RouteBase, 'response')
+def test_adapt_body_text(response, request):
+    response.charset = 'UTF-8'
+    response.headers = {}
+
+    class Foo(mod.RouteBase):
+        pass
+    f = Foo()
+    assert list(f.adapt_body(u'f\xf6o')) == [b'f\xc3\xb6o']
+    assert response.headers == {'Content-Length': '4'}
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+@mock.patch.object(mod.RouteBase, 'response')
+def test_adapt_body_bytes_like(response, request):
+    response.headers = {}
+
+    class Foo(mod.RouteBase):
+        pass
+    f = Foo()
+    assert list(f.adapt_body(bytearray(b'foo'))) == [b'foo']
+    assert list(f.adapt_body(memoryview(b'foo'))) == [b'foo']
+    assert response.headers == {'Content-Length': '3'}
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+@mock.patch.object(mod.RouteBase, 'response')
+def test_adapt_body_keeps_content_length(response, request):
+    response.headers = {'Content-Length': '12'}
+
+    class Foo(mod.RouteBase):
+        pass
+    f = Foo()
+    f.adapt_body(b'foo')
+    assert response.headers == {'Content-Length': '12'}
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+@mock.patch.object(mod.RouteBase, 'response')
+def test_adapt_body_list(response, request):
+    response.charset = 'UTF-8'
+    response.headers = {}
+
+    class Foo(mod.RouteBase):
+        pass
+    f = Foo()
+    assert list(f.adapt_body(['foo', b'bar'])) == [b'foo', b'bar']
+    assert response.headers == {'Content-Length': '6'}
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+@mock.patch.object(mod.RouteBase, 'response')
+def test_adapt_body_generator(response, request):
+    response.headers = {}
+
+    class Foo(mod.RouteBase):
+        pass
+    f = Foo()
+    gen = (c for c in ['foo', 'bar'])
+    assert list(f.adapt_body(gen)) == ['foo', 'bar']
+    assert response.headers == {}
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+def test_adapt_body_file(request, tmpdir):
+    import bottle
+    path = tmpdir.join('foo.txt')
+    path.write('foobar')
+
+    class Foo(mod.RouteBase):
+        pass
+    f = Foo()
+    fd = open(str(path), 'rb')
+    fd.read(3)
+    resp = bottle.BaseResponse()
+    with mock.patch.object(Foo, 'response', resp):
+        body = list(f.adapt_body(fd))
+    assert len(body) == 1
+    assert isinstance(body[0], bottle.HTTPResponse)
+    assert body[0].body is fd
+    assert body[0].headers['Content-Length'] == '3'
+    fd.close()
+
+
+def test_class_scoped_hooks():
+    def hook1(route):
+        pass
+
+    def hook2(route):
+        pass
+
+    class Foo(mod.RouteBase):
+        pass
+
+    class Bar(Foo):
+        pass
+
+    class Baz(mod.RouteBase):
+        pass
+
+    Foo.before(hook1)
+    Bar.before(hook2)
+    assert Bar.get_before_hooks()[-2:] == [hook1, hook2]
+    assert hook1 in Foo.get_before_hooks()
+    assert hook2 not in Foo.get_before_hooks()
+    assert hook1 not in Baz.get_before_hooks()
+
+
+def test_assigned_hooks_replace_inherited():
+    def hook1(route):
+        pass
+
+    def hook2(route):
+        pass
+
+    def hook3(route):
+        pass
+
+    class Foo(mod.RouteBase):
+        pass
+
+    class Bar(Foo):
+        before_hooks = [hook2]
+
+    class Baz(Bar):
+        pass
+
+    Foo.before(hook1)
+    Baz.before(hook3)
+    assert hook1 in Foo.get_before_hooks()
+    assert Bar.get_before_hooks() == [hook2]
+    assert Baz.get_before_hooks() == [hook2, hook3]
+    Baz.before_hooks = []
+    assert Baz.get_before_hooks() == []
+
+
+def test_after_hooks_reverse_order():
+    def hook1(route):
+        pass
+
+    def hook2(route):
+        pass
+
+    class Foo(mod.RouteBase):
+        pass
+
+    class Bar(Foo):
+        pass
+
+    Foo.after(hook1)
+    Bar.after(hook2)
+    assert Bar.get_after_hooks()[:2] == [hook2, hook1]
+
+
+@mock.patch.object(mod.RouteBase, 'bottle')
+def test_path_scoped_hooks(bottle):
+    def hook(route):
+        pass
+
+    class Foo(mod.RouteBase):
+        path = '/admin/foo'
+
+    class Bar(mod.RouteBase):
+        path = '/health'
+
+    mod.before(path='/admin/')(hook)
+    assert hook in Foo.get_before_hooks()
+    assert hook not in Bar.get_before_hooks()
+    Bar.route('/admin/health')
+    assert hook in Bar.get_before_hooks()
+
+
+def test_name_scoped_hooks():
+    def hook(route):
+        pass
+
+    class Foo(mod.RouteBase):
+        name = 'api:foo'
+
+    class Bar(mod.RouteBase):
+        name = 'pages:bar'
+
+    mod.after(name='api:')(hook)
+    assert hook in Foo.get_after_hooks()
+    assert hook not in Bar.get_after_hooks()
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+@mock.patch.object(mod.RouteBase, 'response')
+def test_before_hook_short_circuits(response, request):
+    calls = []
+    request.method = 'GET'
+    response.charset = 'UTF-8'
+    response.headers = {}
+
+    class Foo(mod.RouteBase):
+        def get(self):
+            calls.append('get')
+            return 'handler'
+
+    Foo.before(lambda route: 'hook')
+    Foo.before(lambda route: calls.append('second'))
+    Foo.after(lambda route: calls.append('after'))
+    Foo.after(lambda route: calls.append('always'), always=True)
+    assert list(Foo()) == [b'hook']
+    assert calls == ['always']
+    assert response.headers == {'Content-Length': '4'}
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+def test_before_hook_short_circuits_with_http_response(request):
+    request.method = 'GET'
+
+    class Foo(mod.RouteBase):
+        def get(self):
+            return 'handler'
+
+    resp = mod.bottle.HTTPResponse(status=403)
+    Foo.before(lambda route: resp)
+    assert list(Foo()) == [resp]
+
+
+def test_short_circuit_after_hooks():
+    def hook1(route):
+        pass
+
+    def hook2(route):
+        pass
+
+    class Foo(mod.RouteBase):
+        pass
+
+    Foo.after(hook1)
+    Foo.after(hook2, always=True)
+    assert Foo.get_after_hooks(short_circuit=True) == [hook2]
+    assert Foo.get_after_hooks()[:2] == [hook2, hook1]
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+@mock.patch.object(mod.RouteBase, 'response')
+def test_timing_disabled_by_default(response, request):
+    request.method = 'GET'
+    response.headers = {}
+
+    class Foo(mod.RouteBase):
+        def get(self):
+            return b'foo'
+    f = Foo()
+    list(f)
+    assert f.timing is None
+    assert 'Server-Timing' not in response.headers
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+@mock.patch.object(mod.RouteBase, 'response')
+def test_timing_records_phases(response, request):
+    request.method = 'GET'
+    request.environ = {}
+    response.headers = {}
+    reported = []
+
+    def check_auth(route):
+        pass
+
+    class Foo(mod.RouteBase):
+        record_timing = True
+        server_timing = True
+
+        def get(self, name):
+            return b'foo'
+
+        def report_timing(self, timing):
+            reported.append(timing)
+
+    Foo.before(check_auth)
+    f = Foo(name='bar')
+    assert list(f) == [b'foo']
+    # Other tests register global hooks, so only check the relative order
+    phases = [name for name, _ in f.timing.phases]
+    assert phases[0] == 'init'
+    assert phases.index('before.check_auth') < phases.index('handler')
+    assert phases[-1] == 'body'
+    assert request.environ['streamline.timing'] is f.timing
+    assert reported == [f.timing]
+    header = response.headers['Server-Timing']
+    assert header.startswith('init;dur=')
+    assert 'handler;dur=' in header
+    assert 'body' not in header
+
+
+def conditional_request(**headers):
+    environ = {'REQUEST_METHOD': 'GET', 'bottle.app': mock.Mock()}
+    for name, value in headers.items():
+        environ['HTTP_' + name.upper()] = value
+    return bottle.BaseRequest(environ)
+
+
+def test_conditional_get_etag():
+    calls = []
+
+    class Foo(mod.RouteBase):
+        def get_etag(self):
+            return 'v1'
+
+        def get(self):
+            calls.append('get')
+            return 'foo'
+
+    assert Foo._conditional
+    with mock.patch.object(Foo, 'response', bottle.BaseResponse()) as resp:
+        with mock.patch.object(Foo, 'request', conditional_request()):
+            assert list(Foo()) == [b'foo']
+        assert resp.headers['ETag'] == '"v1"'
+    with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+        request = conditional_request(if_none_match='"v0", W/"v1"')
+        with mock.patch.object(Foo, 'request', request):
+            body = list(Foo())
+    assert len(body) == 1
+    assert body[0].status_code == 304
+    assert body[0].headers['ETag'] == '"v1"'
+    assert calls == ['get']
+
+
+def test_conditional_get_last_modified():
+    class Foo(mod.RouteBase):
+        def get_last_modified(self):
+            return datetime.datetime(2020, 1, 2, 3, 4, 5)
+
+        def get(self):
+            return 'foo'
+
+    def status(since):
+        request = conditional_request(if_modified_since=since)
+        with mock.patch.object(Foo, 'request', request):
+            with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+                body = list(Foo())
+        return getattr(body[0], 'status_code', 200)
+
+    assert status('Thu, 02 Jan 2020 03:04:05 GMT') == 304
+    assert status('Thu, 02 Jan 2020 03:04:04 GMT') == 200
+
+
+def test_not_conditional_by_default():
+    class Foo(mod.RouteBase):
+        def get(self):
+            return 'foo'
+
+    assert not Foo._conditional
+
+
+def test_auto_etag():
+    class Foo(mod.RouteBase):
+        auto_etag = True
+
+        def get(self):
+            return 'foo'
+
+    with mock.patch.object(Foo, 'response', bottle.BaseResponse()) as resp:
+        with mock.patch.object(Foo, 'request', conditional_request()):
+            assert list(Foo()) == [b'foo']
+        etag = resp.headers['ETag']
+    assert etag.startswith('W/"')
+    with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+        request = conditional_request(if_none_match=etag)
+        with mock.patch.object(Foo, 'request', request):
+            body = list(Foo())
+    assert body[0].status_code == 304
+
+
+def test_build_cache_headers():
+    assert mod.build_cache_headers() == []
+    assert mod.build_cache_headers(
+        max_age=60, s_maxage=3600, cache_visibility='public',
+        stale_while_revalidate=30, stale_if_error=86400,
+        vary=['Accept-Encoding', 'Cookie'], surrogate_keys=['posts', 'p1']
+    ) == [
+        ('Cache-Control', 'public, max-age=60, s-maxage=3600, '
+                          'stale-while-revalidate=30, stale-if-error=86400'),
+        ('Vary', 'Accept-Encoding, Cookie'),
+        ('Surrogate-Key', 'posts p1'),
+    ]
+
+
+def test_cache_policy():
+    class Foo(mod.RouteBase):
+        max_age = 60
+        cache_visibility = 'public'
+        vary = ['Cookie']
+
+        def get(self):
+            return 'foo'
+
+        def post(self):
+            return 'foo'
+
+    class Bar(Foo):
+        def get(self):
+            self.set_cache_policy(cache_visibility='private', max_age=None,
+                                  surrogate_keys=['bar'])
+            return 'bar'
+
+    assert Foo._cache_headers == [('Cache-Control', 'public, max-age=60'),
+                                  ('Vary', 'Cookie')]
+
+    def headers(cls, method='GET'):
+        request = conditional_request()
+        request.environ['REQUEST_METHOD'] = method
+        with mock.patch.object(cls, 'request', request):
+            with mock.patch.object(cls, 'response', bottle.BaseResponse()):
+                route = cls()
+                route.response.headers['Vary'] = 'Accept'
+                list(route)
+                return dict(route.response.headerlist)
+
+    h = headers(Foo)
+    assert h['Cache-Control'] == 'public, max-age=60'
+    assert h['Vary'] == 'Accept, Cookie'
+    assert 'Cache-Control' not in headers(Foo, 'POST')
+    h = headers(Bar)
+    assert h['Cache-Control'] == 'private'
+    assert h['Surrogate-Key'] == 'bar'
+    Foo.max_age = 10
+    assert Bar._cache_headers[0] == ('Cache-Control', 'public, max-age=10')
+
+
+def test_cache_policy_rejects_strings():
+    with pytest.raises(TypeError):
+        mod.build_cache_headers(vary='Cookie')
+    with pytest.raises(TypeError):
+        mod.build_cache_headers(vary=u'Cookie')
+    with pytest.raises(TypeError):
+        mod.build_cache_headers(surrogate_keys='posts')
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+def test_hooks_appended_after_class_creation(request):
+    calls = []
+    request.method = 'GET'
+
+    class Foo(mod.RouteBase):
+        def get(self):
+            calls.append('get')
+            return []
+
+    class Bar(Foo):
+        pass
+
+    def before_hook(route):
+        calls.append('before')
+
+    def after_hook(route):
+        calls.append('after')
+
+    assert isinstance(Bar.before_hooks, mod.HookList)
+    list(Bar())
+    mod.RouteBase.before_hooks.append(before_hook)
+    Foo.after_hooks = [after_hook]
+    try:
+        assert before_hook in Bar.get_before_hooks()
+        del calls[:]
+        list(Bar())
+        assert calls == ['before', 'get', 'after']
+    finally:
+        mod.RouteBase.before_hooks.remove(before_hook)
+    del calls[:]
+    list(Bar())
+    assert calls == ['get', 'after']
@@ -0,0 +1,284 @@
+import json
+import threading
+
+import bottle
+import mock
+
+from streamline import batch as mod
+from streamline.base import RouteBase
+
+
+MOD = mod.__name__
+
+
+class ThreadExecutor(object):
+    def __init__(self):
+        self.calls = 0
+
+    def map(self, fn, items):
+        main = threading.current_thread()
+        results = []
+
+        def run(item):
+            if threading.current_thread() is not main:
+                self.calls += 1
+            results.append(fn(item))
+        for item in items:
+            thread = threading.Thread(target=run, args=(item,))
+            thread.start()
+            thread.join()
+        return results
+
+
+def make_app():
+    app = bottle.Bottle()
+
+    class Item(RouteBase):
+        path = '/items/<item_id:int>'
+
+        def get(self, item_id):
+            self.response.headers['X-Item'] = str(item_id)
+            return u'item {} {} {}'.format(item_id, self.is_xhr,
+                                           self.request.query.get('page'))
+
+    class Missing(RouteBase):
+        path = '/missing'
+
+        def get(self):
+            self.abort(404, 'Nope')
+
+    class Broken(RouteBase):
+        path = '/broken'
+
+        def get(self):
+            raise ValueError()
+
+    def login_required(callback):
+        def wrapper(*args, **kwargs):
+            if bottle.request.get_cookie('user') != 'admin':
+                bottle.abort(403, 'Forbidden')
+            return callback(*args, **kwargs)
+        return wrapper
+
+    class Secret(RouteBase):
+        path = '/secret'
+        include_plugins = [login_required]
+
+        def get(self):
+            return 'secret'
+
+    class Login(RouteBase):
+        path = '/login'
+
+        def get(self):
+            self.response.set_cookie('user', 'admin')
+            self.response.set_cookie('theme', 'dark')
+            self.response.add_header('X-Tag', 'a')
+            self.response.add_header('X-Tag', 'b')
+            return 'ok'
+
+    class Path(RouteBase):
+        path = '/path'
+
+        def get(self):
+            return u'{} {}'.format(bottle.request.path, bottle.request.is_xhr)
+
+    Item.route(name='item', app=app)
+    Secret.route(name='secret', app=app)
+    Path.route(name='path', app=app)
+    Login.route(name='login', app=app)
+    Missing.route(name='missing', app=app)
+    Broken.route(name='broken', app=app)
+    mod.BatchRoute.route(name='batch', app=app)
+    return app
+
+
+def run_batch(app, fragments, method='GET', accept=None, route_class=None,
+              cookie=None):
+    route_class = route_class or mod.BatchRoute
+    data = json.dumps(fragments)
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': '/batch',
+               'QUERY_STRING': '', 'bottle.app': app,
+               'HTTP_IF_NONE_MATCH': '"abc"'}
+    if method == 'GET':
+        environ['QUERY_STRING'] = bottle.urlencode({'fragments': data})
+    else:
+        body = data.encode('utf-8')
+        environ['CONTENT_TYPE'] = 'application/json'
+        environ['CONTENT_LENGTH'] = str(len(body))
+        environ['wsgi.input'] = mod.io.BytesIO(body)
+    if accept:
+        environ['HTTP_ACCEPT'] = accept
+    if cookie:
+        environ['HTTP_COOKIE'] = cookie
+    response = bottle.BaseResponse()
+    with mock.patch.object(route_class, 'request',
+                           bottle.BaseRequest(environ)):
+        with mock.patch.object(route_class, 'response', response):
+            body = b''.join(route_class())
+    return response, body
+
+
+def test_json_envelope():
+    app = make_app()
+    response, body = run_batch(app, [
+        {'name': 'item', 'args': {'item_id': 1}},
+        {'name': 'item', 'args': {'item_id': 2}, 'query': {'page': 3}},
+        {'name': 'missing'},
+        {'name': 'broken'},
+        {'name': 'nonexistent'},
+        {'name': 'batch'},
+    ])
+    assert response.content_type == 'application/json'
+    fragments = json.loads(body.decode('utf-8'))['fragments']
+    assert [(f['name'], f['status']) for f in fragments] == [
+        ('item', 200), ('item', 200), ('missing', 404), ('broken', 500),
+        ('nonexistent', 404), ('batch', 403)]
+    assert fragments[0]['body'] == 'item 1 True None'
+    assert fragments[0]['headers']['X-Item'] == '1'
+    assert 'Content-Length' not in fragments[0]['headers']
+    assert fragments[1]['body'] == 'item 2 True 3'
+    assert fragments[2]['body'] == 'Nope'
+
+
+def test_post():
+    app = make_app()
+    _, body = run_batch(app, {'fragments': [
+        {'name': 'item', 'args': {'item_id': 5}}]}, method='POST')
+    fragments = json.loads(body.decode('utf-8'))['fragments']
+    assert fragments[0]['body'] == 'item 5 True None'
+
+
+def test_fragment_environ():
+    app = make_app()
+    environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/batch',
+               'QUERY_STRING': 'a=1', 'bottle.app': app,
+               'HTTP_COOKIE': 'x=y', 'HTTP_ACCEPT_ENCODING': 'gzip',
+               'HTTP_IF_NONE_MATCH': '"abc"', 'bottle.request.query': {}}
+    with mock.patch.object(mod.BatchRoute, 'request',
+                           bottle.BaseRequest(environ)):
+        route = mod.BatchRoute()
+        fragment_environ = route.get_fragment_environ('/items/1', 'b=2')
+    assert fragment_environ['REQUEST_METHOD'] == 'GET'
+    assert fragment_environ['PATH_INFO'] == '/items/1'
+    assert fragment_environ['QUERY_STRING'] == 'b=2'
+    assert fragment_environ['HTTP_COOKIE'] == 'x=y'
+    assert fragment_environ['HTTP_X_REQUESTED_WITH'] == 'XMLHttpRequest'
+    assert fragment_environ['bottle.app'] is app
+    for key in ('HTTP_ACCEPT_ENCODING', 'HTTP_IF_NONE_MATCH',
+                'bottle.request', 'bottle.request.query'):
+        assert key not in fragment_environ
+
+
+def test_allowed_routes():
+    app = make_app()
+
+    class Batch(mod.BatchRoute):
+        allowed_routes = ('missing',)
+
+    _, body = run_batch(app, [{'name': 'item', 'args': {'item_id': 1}},
+                              {'name': 'missing'}], route_class=Batch)
+    fragments = json.loads(body.decode('utf-8'))['fragments']
+    assert [f['status'] for f in fragments] == [403, 404]
+
+
+def test_invalid_requests():
+    app = make_app()
+    for fragments in ({'foo': 1}, [{'args': {}}],
+                      [{'name': 'missing'}] * 21,
+                      [{'name': ['item']}],
+                      [{'name': 'item', 'args': [1]}],
+                      [{'name': 'item', 'args': {'item_id': 1},
+                        'query': 'abc'}],
+                      [{'name': 'item', 'args': {'item_id': 1},
+                        'query': [['a', 'b', 'c']]}]):
+        try:
+            run_batch(app, fragments)
+        except bottle.HTTPError as exc:
+            assert exc.status_code == 400
+        else:
+            assert False, 'Expected HTTPError'
+
+
+def test_query_pairs():
+    app = make_app()
+    _, body = run_batch(app, [{'name': 'item', 'args': {'item_id': 1},
+                               'query': [['page', '4']]}])
+    fragments = json.loads(body.decode('utf-8'))['fragments']
+    assert fragments[0]['body'] == 'item 1 True 4'
+
+
+def test_fragment_cookies():
+    app = make_app()
+    for accept in (None, 'multipart/mixed'):
+        response, body = run_batch(app, [{'name': 'login'}], accept=accept)
+        cookies = response.headers.getall('Set-Cookie')
+        assert sorted(cookies) == ['theme=dark', 'user=admin']
+        assert b'Set-Cookie' not in body
+    response, body = run_batch(app, [{'name': 'login'}])
+    fragments = json.loads(body.decode('utf-8'))['fragments']
+    assert fragments[0]['headers']['X-Tag'] == 'a, b'
+
+
+def test_multipart_envelope():
+    app = make_app()
+    response, body = run_batch(app, [
+        {'name': 'item', 'args': {'item_id': 1}}, {'name': 'missing'}],
+        accept='multipart/mixed')
+    content_type = response.content_type
+    assert content_type.startswith('multipart/mixed; boundary=')
+    boundary = content_type.split('boundary=')[1].encode('ascii')
+    parts = body.split(b'--' + boundary)
+    assert parts[0] == b''
+    assert parts[-1] == b'--\r\n'
+    assert b'X-Fragment-Name: item\r\n' in parts[1]
+    assert b'X-Fragment-Status: 200\r\n' in parts[1]
+    assert parts[1].endswith(b'\r\n\r\nitem 1 True None\r\n')
+    assert b'X-Fragment-Status: 404\r\n' in parts[2]
+
+
+def test_executor():
+    app = make_app()
+    executor = ThreadExecutor()
+
+    class Batch(mod.BatchRoute):
+        pass
+    Batch.executor = executor
+
+    _, body = run_batch(app, [{'name': 'item', 'args': {'item_id': i}}
+                              for i in range(3)], route_class=Batch)
+    fragments = json.loads(body.decode('utf-8'))['fragments']
+    assert [f['body'] for f in fragments] == [
+        'item {} True None'.format(i) for i in range(3)]
+    assert executor.calls == 3
+
+
+def test_route_plugins_applied():
+    app = make_app()
+    _, body = run_batch(app, [{'name': 'secret'}])
+    fragments = json.loads(body.decode('utf-8'))['fragments']
+    assert fragments[0]['status'] == 403
+    assert fragments[0]['body'] != 'secret'
+    _, body = run_batch(app, [{'name': 'secret'}], cookie='user=admin')
+    fragments = json.loads(body.decode('utf-8'))['fragments']
+    assert fragments[0]['status'] == 200
+    assert fragments[0]['body'] == 'secret'
+
+
+def test_bottle_request_bound():
+    app = make_app()
+    batch_environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/batch'}
+    bottle.request.bind(batch_environ)
+    bottle.response.bind()
+    bottle.response.set_header('X-Batch', '1')
+
+    class Batch(mod.BatchRoute):
+        pass
+
+    for executor in (None, ThreadExecutor()):
+        Batch.executor = executor
+        _, body = run_batch(app, [{'name': 'path'}], route_class=Batch)
+        fragments = json.loads(body.decode('utf-8'))['fragments']
+        assert fragments[0]['body'] == '/path True'
+        assert bottle.request.environ is batch_environ
+        assert bottle.response.get_header('X-Batch') == '1'
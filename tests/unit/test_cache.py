@@ -0,0 +1,605 @@
+import bottle
+import mock
+import pytest
+
+from streamline import cache as mod
+from streamline.base import RouteBase
+from streamline.template import TemplateRoute, XHRPartialRoute
+
+
+MOD = mod.__name__
+
+
+def make_response(body=b'x' * 10, headers=None):
+    return mod.CachedResponse(200, headers or [], body)
+
+
+def test_lru_get_set():
+    cache = mod.LRUCache()
+    resp = make_response()
+    cache.set('foo', resp)
+    assert cache.get('foo') is resp
+    assert cache.get('bar') is None
+
+
+def test_lru_evicts_least_recently_used():
+    cache = mod.LRUCache(max_size=30)
+    cache.set('a', make_response())
+    cache.set('b', make_response())
+    cache.set('c', make_response())
+    cache.get('a')
+    cache.set('d', make_response())
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.size == 30
+
+
+def test_lru_skips_oversized():
+    cache = mod.LRUCache(max_size=5)
+    cache.set('a', make_response())
+    assert len(cache) == 0
+
+
+@mock.patch.object(mod, 'clock')
+def test_lru_expires(clock):
+    cache = mod.LRUCache()
+    clock.return_value = 100
+    cache.set('a', make_response(), timeout=10)
+    clock.return_value = 109
+    assert cache.get('a') is not None
+    clock.return_value = 110
+    assert cache.get('a') is None
+    assert cache.size == 0
+
+
+def test_lru_delete_and_clear():
+    cache = mod.LRUCache()
+    cache.set('a', make_response())
+    cache.set('b', make_response())
+    cache.delete('a')
+    assert cache.get('a') is None
+    assert cache.size == 10
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def make_request(query='', xhr=False):
+    environ = {'REQUEST_METHOD': 'GET', 'QUERY_STRING': query,
+               'bottle.app': mock.Mock()}
+    if xhr:
+        environ['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+    return bottle.BaseRequest(environ)
+
+
+def test_cache_key():
+    class Foo(mod.CachedRouteMixin, RouteBase):
+        name = 'foo'
+        cache_query_params = ['page']
+
+    def key(query='', xhr=False, *args):
+        with mock.patch.object(Foo, 'request', make_request(query, xhr)):
+            return Foo(*args).get_cache_key()
+
+    assert key().startswith('foo:')
+    assert key('page=1') == key('page=1&other=2')
+    assert key('page=1') != key('page=2')
+    assert key() != key(xhr=True)
+    assert key('', False, 'a') != key('', False, 'b')
+
+
+def test_cache_key_vary():
+    backend = mod.LRUCache()
+
+    class Foo(mod.CachedRouteMixin, RouteBase):
+        name = 'foo'
+        cache_backend = backend
+        vary = ('Accept-Language',)
+
+        def get(self):
+            return self.request.get_header('Accept-Language')
+
+    def get(language):
+        request = make_request()
+        request.environ['HTTP_ACCEPT_LANGUAGE'] = language
+        with mock.patch.object(Foo, 'request', request):
+            with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+                return list(Foo())
+
+    assert get('en') == [b'en']
+    assert get('de') == [b'de']
+    assert get('en') == [b'en']
+    assert len(backend) == 2
+
+
+def test_cached_template_route():
+    backend = mod.LRUCache()
+    calls = []
+
+    class Foo(mod.CachedRouteMixin, TemplateRoute):
+        name = 'foo'
+        template_name = 'foo'
+        cache_backend = backend
+
+        def get(self):
+            calls.append('get')
+            self.response.headers['X-Foo'] = 'bar'
+            return {}
+
+    Foo.template_func = staticmethod(lambda name, ctx: u'rendered')
+    with mock.patch.object(Foo, 'request', make_request()):
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            assert list(Foo()) == [b'rendered']
+        response = bottle.BaseResponse()
+        with mock.patch.object(Foo, 'response', response):
+            assert list(Foo()) == [b'rendered']
+            assert response.headers['X-Foo'] == 'bar'
+            assert response.headers['Content-Length'] == '8'
+    assert calls == ['get']
+
+
+def test_not_cached_with_cookies():
+    backend = mod.LRUCache()
+
+    class Foo(mod.CachedRouteMixin, RouteBase):
+        cache_backend = backend
+
+        def get(self):
+            self.response.set_cookie('foo', 'bar')
+            return 'foo'
+
+    with mock.patch.object(Foo, 'request', make_request()):
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            list(Foo())
+    assert len(backend) == 0
+
+
+@pytest.mark.parametrize('cache_control', [
+    'private, max-age=60',
+    'no-store',
+    'No-Cache',
+])
+def test_not_cached_with_cache_control(cache_control):
+    backend = mod.LRUCache()
+    calls = []
+
+    class Foo(mod.CachedRouteMixin, RouteBase):
+        cache_backend = backend
+
+        def get(self):
+            calls.append(self.request.get_cookie('user'))
+            self.response.headers['Cache-Control'] = cache_control
+            return self.request.get_cookie('user')
+
+    for user in ('alice', 'bob'):
+        request = make_request()
+        request.environ['HTTP_COOKIE'] = 'user=' + user
+        with mock.patch.object(Foo, 'request', request):
+            with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+                assert list(Foo()) == [user.encode('ascii')]
+    assert calls == ['alice', 'bob']
+    assert len(backend) == 0
+
+
+def test_xhr_partial_not_cached_by_default():
+    backend = mod.LRUCache()
+
+    class Foo(mod.CachedRouteMixin, XHRPartialRoute):
+        template_name = 'full'
+        partial_template_name = 'partial'
+        cache_backend = backend
+
+        def get(self):
+            return {}
+
+    Foo.template_func = staticmethod(lambda name, ctx: name)
+    with mock.patch.object(Foo, 'request', make_request(xhr=True)):
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            assert list(Foo()) == [b'partial']
+    assert len(backend) == 0
+
+
+def test_not_cached_when_timeout_zero():
+    backend = mod.LRUCache()
+
+    class Foo(mod.CachedRouteMixin, RouteBase):
+        cache_backend = backend
+
+        def get(self):
+            self.cache_timeout = 0
+            return 'foo'
+
+    with mock.patch.object(Foo, 'request', make_request()):
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            list(Foo())
+    assert len(backend) == 0
+
+
+def test_lru_invalidate_tags():
+    cache = mod.LRUCache()
+    cache.set('a', make_response(), tags=('post:1', 'posts'))
+    cache.set('b', make_response(), tags=('post:2', 'posts'))
+    cache.set('c', make_response())
+    cache.invalidate_tags(['post:1'])
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    cache.invalidate_tags(['posts'])
+    assert cache.get('b') is None
+    assert cache.get('c') is not None
+    assert cache.tag_keys == {}
+
+
+def test_shared_memory_cache(tmpdir):
+    path = str(tmpdir.join('cache'))
+    cache = mod.SharedMemoryCache(path, arena_size=4096, index_slots=16,
+                                  tag_slots=16)
+    other = mod.SharedMemoryCache(path, arena_size=4096, index_slots=16,
+                                  tag_slots=16)
+    cache.set('a', make_response(b'foo', [('X-Foo', 'bar')]),
+              tags=('posts',))
+    cache.set('b', make_response(b'bar'))
+    response = other.get('a')
+    assert response.status == 200
+    assert response.headers == [('X-Foo', 'bar')]
+    assert response.body == b'foo'
+    assert other.get('missing') is None
+    other.invalidate_tags(['posts'])
+    assert cache.get('a') is None
+    assert cache.get('b').body == b'bar'
+    cache.delete('b')
+    assert other.get('b') is None
+    cache.set('c', make_response())
+    other.clear()
+    assert cache.get('c') is None
+    cache.close()
+    other.close()
+
+
+def test_shared_memory_cache_overwrites_oldest(tmpdir):
+    cache = mod.SharedMemoryCache(str(tmpdir.join('cache')), arena_size=4096,
+                                  index_slots=64, tag_slots=16)
+    for i in range(20):
+        cache.set(str(i), make_response(b'x' * 500))
+    assert cache.get('0') is None
+    assert cache.get('19').body == b'x' * 500
+    cache.set('big', make_response(b'x' * 5000))
+    assert cache.get('big') is None
+    cache.close()
+
+
+def test_shared_memory_cache_full_tag_table(tmpdir):
+    cache = mod.SharedMemoryCache(str(tmpdir.join('cache')), arena_size=4096,
+                                  index_slots=16, tag_slots=4)
+    with mock.patch.object(mod.log, 'warning') as warning:
+        cache.invalidate_tags(['tag{}'.format(i) for i in range(5)])
+    assert warning.call_count == 1
+    # The tag table was emptied, so new tags are tracked individually again
+    cache.set('a', make_response(), tags=('a',))
+    cache.set('b', make_response(), tags=('b',))
+    with mock.patch.object(mod.log, 'warning') as warning:
+        cache.invalidate_tags(['b', 'other'])
+    assert not warning.called
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    cache.close()
+
+
+@mock.patch.object(mod.time, 'time')
+def test_shared_memory_cache_expires(time, tmpdir):
+    time.return_value = 10
+    cache = mod.SharedMemoryCache(str(tmpdir.join('cache')), arena_size=4096,
+                                  index_slots=16, tag_slots=16)
+    cache.set('a', make_response(), timeout=5)
+    assert cache.get('a') is not None
+    time.return_value = 15
+    assert cache.get('a') is None
+    cache.close()
+
+
+def test_cache_tags():
+    backend = mod.LRUCache()
+
+    class Foo(mod.CachedRouteMixin, RouteBase):
+        cache_backend = backend
+
+        def get(self):
+            self.cache_tags = ['post:1']
+            return 'foo'
+
+    with mock.patch.object(Foo, 'request', make_request()):
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            route = Foo()
+            list(route)
+            assert len(backend) == 1
+            route.invalidate_cache_tags(['post:1'])
+    assert len(backend) == 0
+
+
+@mock.patch.object(mod.time, 'time')
+def test_stale_while_revalidate(time):
+    backend = mod.LRUCache()
+    calls = []
+    refreshed = mod.threading.Event()
+
+    class Foo(mod.CachedRouteMixin, TemplateRoute):
+        template_name = 'foo'
+        cache_backend = backend
+        cache_timeout = 10
+        cache_stale_timeout = 100
+
+        def get(self):
+            calls.append(self.request.query.get('x'))
+            return {'count': len(calls)}
+
+    def template_func(name, ctx):
+        if ctx['count'] > 1:
+            refreshed.set()
+        return u'rendered {}'.format(ctx['count'])
+
+    Foo.template_func = staticmethod(template_func)
+    time.return_value = 0
+    request = make_request('x=1')
+    with mock.patch.object(Foo, 'request', request):
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            assert list(Foo()) == [b'rendered 1']
+        time.return_value = 5
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            assert list(Foo()) == [b'rendered 1']
+        assert calls == ['1']
+        time.return_value = 20
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            assert list(Foo()) == [b'rendered 1']
+        assert refreshed.wait(5)
+        for _ in range(100):
+            if not mod.revalidating:
+                break
+            mod.threading.Event().wait(0.01)
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            assert list(Foo()) == [b'rendered 2']
+    assert calls == ['1', '1']
+
+
+def test_refresh_binds_request():
+    backend = mod.LRUCache()
+    seen = []
+
+    class Foo(mod.CachedRouteMixin, TemplateRoute):
+        template_name = 'foo'
+        cache_backend = backend
+
+        def get(self):
+            return {}
+
+    def hook(route):
+        seen.append(bottle.request.get_cookie('lang'))
+
+    def template_func(name, ctx):
+        return u'{} {}'.format(name, ctx['request'].path)
+
+    Foo.before(hook)
+    Foo.template_func = staticmethod(template_func)
+    request = make_request()
+    request.environ['PATH_INFO'] = '/foo'
+    request.environ['HTTP_COOKIE'] = 'lang=en'
+    with mock.patch.object(Foo, 'request', request):
+        route = Foo()
+    key = route.get_cache_key()
+    mod.revalidating.add(key)
+    thread = mod.threading.Thread(target=route.refresh_cached_response,
+                                  args=(key, request.environ.copy()))
+    thread.start()
+    thread.join(5)
+    assert seen == ['en']
+    assert backend.get(key).body == b'foo /foo'
+    assert key not in mod.revalidating
+
+
+def test_refresh_failure_logged():
+    class Foo(mod.CachedRouteMixin, RouteBase):
+        def get(self):
+            raise ValueError()
+
+    with mock.patch.object(Foo, 'request', make_request()):
+        route = Foo()
+    mod.revalidating.add('foo')
+    with mock.patch.object(mod, 'log') as log:
+        route.refresh_cached_response('foo', make_request().environ)
+    assert log.exception.called
+    assert 'foo' not in mod.revalidating
+
+
+def test_revalidate_single_flight():
+    class Foo(mod.CachedRouteMixin, RouteBase):
+        pass
+
+    with mock.patch.object(Foo, 'request', make_request()):
+        route = Foo()
+    route.cache_key = 'foo'
+    mod.revalidating.add('foo')
+    try:
+        with mock.patch.object(mod.threading, 'Thread') as thread:
+            route.revalidate()
+        assert not thread.called
+    finally:
+        mod.revalidating.discard('foo')
+
+
+def test_coalescing():
+    started = mod.threading.Event()
+    waiting = mod.threading.Semaphore(0)
+    proceed = mod.threading.Event()
+    calls = []
+    results = []
+
+    class Flight(mod.Flight):
+        def wait(self, timeout=None):
+            waiting.release()
+            return super(Flight, self).wait(timeout)
+
+    class Foo(mod.CoalescingRouteMixin, RouteBase):
+        def get(self):
+            calls.append('get')
+            started.set()
+            proceed.wait(5)
+            self.response.headers['X-Foo'] = 'bar'
+            return 'foo'
+
+    def handle():
+        route = Foo()
+        route.response = bottle.BaseResponse()
+        results.append((list(route), route.response.headers.get('X-Foo'),
+                        route.coalesced))
+
+    with mock.patch.object(mod, 'Flight', Flight):
+        with mock.patch.object(Foo, 'request', make_request('a=1')):
+            leader = mod.threading.Thread(target=handle)
+            leader.start()
+            assert started.wait(5)
+            followers = [mod.threading.Thread(target=handle)
+                         for _ in range(3)]
+            for thread in followers:
+                thread.start()
+            for _ in followers:
+                assert waiting.acquire(timeout=5)
+            proceed.set()
+            for thread in [leader] + followers:
+                thread.join(5)
+    assert calls == ['get']
+    assert sorted(results) == [([b'foo'], 'bar', False)] + \
+        [([b'foo'], 'bar', True)] * 3
+    assert mod.in_flight == {}
+
+
+def test_coalescing_not_shared_on_error():
+    class Foo(mod.CoalescingRouteMixin, RouteBase):
+        def get(self):
+            raise ValueError()
+
+    with mock.patch.object(Foo, 'request', make_request()):
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            route = Foo()
+            key = route.get_coalesce_key()
+            flight = mod.Flight()
+            with mock.patch.object(mod, 'Flight', return_value=flight):
+                try:
+                    list(route)
+                except ValueError:
+                    pass
+    assert flight.event.is_set()
+    assert flight.response is None
+    assert key not in mod.in_flight
+
+
+def test_coalesce_key():
+    class Foo(mod.CoalescingRouteMixin, RouteBase):
+        name = 'foo'
+
+    def key(query=''):
+        with mock.patch.object(Foo, 'request', make_request(query)):
+            return Foo().get_coalesce_key()
+
+    assert key('a=1&b=2') == key('b=2&a=1')
+    assert key('a=1') != key('a=2')
+    Foo.coalesce_query_params = ['a']
+    assert key('a=1&b=2') == key('a=1&b=3')
+
+
+def test_coalesce_key_headers():
+    class Foo(mod.CoalescingRouteMixin, RouteBase):
+        name = 'foo'
+
+    def key(**headers):
+        request = make_request()
+        for name, value in headers.items():
+            request.environ['HTTP_' + name.upper()] = value
+        with mock.patch.object(Foo, 'request', request):
+            return Foo().get_coalesce_key()
+
+    assert key(cookie='user=alice') != key(cookie='user=bob')
+    assert key(authorization='a') != key(authorization='b')
+    assert key(accept_language='en') == key(accept_language='de')
+    Foo.vary = ('Accept-Language',)
+    assert key(accept_language='en') != key(accept_language='de')
+    Foo.coalesce_headers = ()
+    assert key(cookie='user=alice') == key(cookie='user=bob')
+
+
+def test_coalescing_personalized():
+    started = mod.threading.Event()
+    proceed = mod.threading.Event()
+    results = {}
+
+    class Foo(mod.CoalescingRouteMixin, RouteBase):
+        def get(self):
+            user = self.request.get_cookie('user')
+            if user == 'alice':
+                started.set()
+                proceed.wait(5)
+            return 'hello ' + user
+
+    def handle(user):
+        request = make_request()
+        request.environ['HTTP_COOKIE'] = 'user=' + user
+        route = Foo.__new__(Foo)
+        route.request = request
+        route.response = bottle.BaseResponse()
+        route.__init__()
+        results[user] = list(route)
+
+    alice = mod.threading.Thread(target=handle, args=('alice',))
+    alice.start()
+    assert started.wait(5)
+    bob = mod.threading.Thread(target=handle, args=('bob',))
+    bob.start()
+    # Bob's request does not wait for Alice's
+    bob.join(5)
+    assert not bob.is_alive()
+    proceed.set()
+    alice.join(5)
+    assert results == {'alice': [b'hello alice'], 'bob': [b'hello bob']}
+
+
+def test_cached_response_not_modified():
+    backend = mod.LRUCache()
+
+    class Foo(mod.CachedRouteMixin, RouteBase):
+        cache_backend = backend
+
+        def get(self):
+            self.response.headers['ETag'] = '"v1"'
+            return 'foo'
+
+    with mock.patch.object(Foo, 'request', make_request()):
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            assert list(Foo()) == [b'foo']
+    request = make_request()
+    request.environ['HTTP_IF_NONE_MATCH'] = '"v1"'
+    with mock.patch.object(Foo, 'request', request):
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            route = Foo()
+            body = list(route)
+    assert route.cache_hit
+    assert body[0].status_code == 304
+
+
+def test_cached_xhr_partial_variants():
+    backend = mod.LRUCache()
+
+    class Foo(mod.CachedRouteMixin, XHRPartialRoute):
+        template_name = 'full'
+        partial_template_name = 'partial'
+        xhr_cache_control = 'public, max-age=60'
+        cache_backend = backend
+
+        def get(self):
+            return {}
+
+    Foo.template_func = staticmethod(lambda name, ctx: name)
+    for _ in range(2):
+        for xhr, expected in ((False, b'full'), (True, b'partial')):
+            response = bottle.BaseResponse()
+            with mock.patch.object(Foo, 'request', make_request(xhr=xhr)):
+                with mock.patch.object(Foo, 'response', response):
+                    assert list(Foo()) == [expected]
+            assert response.headers['Vary'] == 'X-Requested-With'
+    assert len(backend) == 2
@@ -0,0 +1,129 @@
+import gzip
+import io
+import zlib
+
+import bottle
+import mock
+
+from streamline import compress as mod
+from streamline.base import FLUSH, RouteBase, StreamingRoute
+
+
+BODY = u'hello world ' * 100
+
+
+def make_request(accept_encoding=None):
+    environ = {'REQUEST_METHOD': 'GET', 'bottle.app': mock.Mock()}
+    if accept_encoding is not None:
+        environ['HTTP_ACCEPT_ENCODING'] = accept_encoding
+    return bottle.BaseRequest(environ)
+
+
+def handle(cls, accept_encoding='gzip'):
+    response = bottle.BaseResponse()
+    with mock.patch.object(cls, 'request', make_request(accept_encoding)):
+        with mock.patch.object(cls, 'response', response):
+            body = b''.join(cls())
+    return response, body
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+
+
+def test_negotiate_encoding():
+    encodings = ('br', 'gzip', 'deflate')
+    assert mod.negotiate_encoding('gzip, deflate', encodings) == 'gzip'
+    assert mod.negotiate_encoding('deflate;q=1, gzip;q=0.5',
+                                  encodings) == 'deflate'
+    assert mod.negotiate_encoding('gzip;q=0, *', encodings) == 'br'
+    assert mod.negotiate_encoding('identity', encodings) is None
+    assert mod.negotiate_encoding('gzip;q=0', encodings) is None
+
+
+def test_compress_bytes():
+    cache = mod.LRUCache()
+
+    class Foo(mod.CompressionMixin, RouteBase):
+        compression_cache = cache
+
+        def get(self):
+            self.response.headers['ETag'] = '"v1"'
+            return BODY
+
+    response, body = handle(Foo)
+    assert gunzip(body) == BODY.encode('utf8')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Content-Length'] == str(len(body))
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert response.headers['ETag'] == 'W/"v1"'
+    assert len(cache) == 1
+    with mock.patch.object(mod, 'compress') as compress:
+        assert handle(Foo)[1] == body
+    assert not compress.called
+    response, body = handle(Foo, 'deflate')
+    assert zlib.decompress(body) == BODY.encode('utf8')
+
+
+def test_compress_skipped():
+    class Foo(mod.CompressionMixin, RouteBase):
+        def get(self):
+            return self.request.query.get('body', BODY)
+
+    response, body = handle(Foo, None)
+    assert body == BODY.encode('utf8')
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Vary'] == 'Accept-Encoding'
+
+    class Small(Foo):
+        def get(self):
+            return u'hello'
+
+    response, body = handle(Small)
+    assert body == b'hello'
+    assert 'Content-Encoding' not in response.headers
+
+    class Image(Foo):
+        def get(self):
+            self.response.content_type = 'image/png'
+            return BODY
+
+    response, body = handle(Image)
+    assert body == BODY.encode('utf8')
+    assert 'Vary' not in response.headers
+
+
+def test_compress_stream():
+    class Foo(mod.CompressionMixin, StreamingRoute):
+        buffer_size = 10
+
+        def get(self):
+            for _ in range(100):
+                yield u'hello world '
+
+    response, body = handle(Foo)
+    assert gunzip(body) == BODY.encode('utf8')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in response.headers
+
+
+def test_compress_generator_not_flushed_per_chunk():
+    class Foo(mod.CompressionMixin, RouteBase):
+        compress_flush_size = 600
+
+        def get(self):
+            yield u'head '
+            yield FLUSH
+            for _ in range(100):
+                yield u'hello world '
+
+    response = bottle.BaseResponse()
+    with mock.patch.object(Foo, 'request', make_request('deflate')):
+        with mock.patch.object(Foo, 'response', response):
+            chunks = list(Foo())
+    decompressor = zlib.decompressobj()
+    assert decompressor.decompress(chunks[0]) == b'head '
+    # One flush after every 600 bytes, and the final chunk
+    assert len(chunks) == 4
+    body = zlib.decompress(b''.join(chunks))
+    assert body == (u'head ' + BODY).encode('utf8')
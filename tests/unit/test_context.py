@@ -0,0 +1,99 @@
+import bottle
+import mock
+
+from streamline import context as mod
+from streamline.template import TemplateMixin
+
+
+MOD = mod.__name__
+
+
+def test_lazy_context():
+    calls = []
+
+    def provider(route):
+        calls.append(route)
+        return 'value'
+
+    route = object()
+    base = {'a': 1, 'b': mod.lazy(provider)}
+    ctx = mod.LazyContext(route, base, {'b': 2, 'c': 3})
+    assert 'b' in ctx
+    assert calls == []
+    assert ctx['b'] == 'value'
+    assert ctx['b'] == 'value'
+    assert calls == [route]
+    assert ctx['c'] == 3
+    ctx['d'] = 4
+    del ctx['a']
+    assert 'a' not in ctx
+    assert sorted(ctx) == ['b', 'c', 'd']
+    assert len(ctx) == 3
+    assert ctx.get('a') is None
+    assert base == {'a': 1, 'b': base['b']}
+    copy = ctx.copy()
+    copy['a'] = 5
+    assert ctx == {'b': 'value', 'c': 3, 'd': 4}
+    assert copy == {'a': 5, 'b': 'value', 'c': 3, 'd': 4}
+
+
+def test_provider_ttl():
+    calls = []
+    provider = mod.ContextProvider(lambda route: calls.append(route) or
+                                   len(calls), ttl=10)
+    with mock.patch.object(mod, 'clock', return_value=100):
+        assert provider('a') == 1
+        assert provider('b') == 1
+    with mock.patch.object(mod, 'clock', return_value=111):
+        assert provider('c') == 2
+    provider.clear()
+    assert provider('d') == 3
+    assert calls == ['a', 'c', 'd']
+
+
+def test_context_provider():
+    app = bottle.Bottle()
+
+    @mod.context_provider(app=app)
+    def menu(route):
+        return ['home']
+
+    mod.register_provider('title', lambda route: route.title, app=app)
+    assert sorted(mod.get_providers(app)) == ['menu', 'title']
+    assert mod.get_providers(bottle.Bottle()) == {}
+    assert mod.get_providers(None) == {}
+
+    class Foo(TemplateMixin):
+        default_context = {'title': 'class'}
+        title = 'provider'
+        body = {'body': 1}
+
+    f = Foo()
+    f.app = app
+    ctx = f.get_context()
+    assert not ctx.is_evaluated('menu')
+    assert ctx['menu'] == ['home']
+    assert ctx['title'] == 'class'
+    assert ctx['body'] == 1
+
+
+def test_default_template_func_evaluates_used_values():
+    app = bottle.Bottle()
+    calls = []
+    mod.register_provider('menu', lambda route: calls.append('menu') or 'ab',
+                          app=app)
+
+    class Foo(TemplateMixin):
+        template_name = '{{ x }}'
+        default_context = {
+            'expensive': mod.lazy(lambda route: calls.append('expensive')),
+        }
+        body = {'x': 1}
+
+    f = Foo()
+    f.app = app
+    assert f.render_template() == '1'
+    assert calls == []
+    f.template_name = '{{ x }} {{ menu }}'
+    assert f.render_template() == '1 ab'
+    assert calls == ['menu']
@@ -0,0 +1,132 @@
+import os
+
+import bottle
+import mock
+import pytest
+
+from streamline import engines as mod
+from streamline.context import LazyContext, lazy
+from streamline.template import TemplateRoute
+
+
+def test_simple_template_engine(tmpdir):
+    for name in ('a', 'b', 'c'):
+        tmpdir.join(name + '.tpl').write(name + ' {{ x }}')
+    engine = mod.SimpleTemplateEngine(lookup=[str(tmpdir)], max_templates=2)
+    assert engine('a', {'x': 1}) == 'a 1'
+    assert engine('b', x=2) == 'b 2'
+    template = engine.get_template('a')
+    engine('c', x=3)
+    assert list(engine.templates) == ['a', 'c']
+    assert engine.get_template('a') is template
+    with pytest.raises(bottle.TemplateError):
+        engine.get_template('missing')
+    engine.clear()
+    assert len(engine) == 0
+
+
+def test_simple_template_engine_auto_reload(tmpdir):
+    path = tmpdir.join('a.tpl')
+    path.write('old')
+    engine = mod.SimpleTemplateEngine(lookup=[str(tmpdir)])
+    reloading = mod.SimpleTemplateEngine(lookup=[str(tmpdir)],
+                                         auto_reload=True)
+    assert engine('a') == reloading('a') == 'old'
+    path.write('new')
+    mtime = os.stat(str(path)).st_mtime + 10
+    os.utime(str(path), (mtime, mtime))
+    assert engine('a') == 'old'
+    assert reloading('a') == 'new'
+
+
+def test_get_engine():
+    app = bottle.Bottle()
+    app.config['streamline.templates.max_templates'] = '10'
+    app.config['streamline.templates.auto_reload'] = 'true'
+    engine = mod.get_engine(mod.SimpleTemplateEngine, app)
+    assert engine.max_templates == 10
+    assert engine.auto_reload
+    assert mod.get_engine(mod.SimpleTemplateEngine, app) is engine
+    other = mod.get_engine(mod.SimpleTemplateEngine, bottle.Bottle())
+    assert other is not engine
+    assert not other.auto_reload
+
+
+def test_template_route_engine(tmpdir):
+    tmpdir.join('page.tpl').write('page {{ x }}')
+    app = bottle.Bottle()
+
+    class Foo(TemplateRoute):
+        path = '/'
+        template_name = 'page'
+        template_engine = mod.SimpleTemplateEngine
+        preload_templates = True
+
+        def get(self):
+            return {'x': 1}
+
+    with mock.patch.object(bottle, 'TEMPLATE_PATH', [str(tmpdir)]):
+        Foo.route(app=app)
+    engine = mod.get_engine(mod.SimpleTemplateEngine, app)
+    assert list(engine.templates) == ['page']
+    request = bottle.BaseRequest({'REQUEST_METHOD': 'GET', 'bottle.app': app})
+    with mock.patch.object(Foo, 'request', request):
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            assert list(Foo()) == [b'page 1']
+
+
+PAGE = '''<html>
+% # block items
+<ul>
+    % for item in items:
+    <li>{{ item }}</li>
+    % end
+    % # block footer
+    <p>{{ footer }}</p>
+    % # endblock
+</ul>
+% # endblock
+<p>{{ title }}</p>
+</html>
+'''
+
+
+def test_extract_block():
+    assert mod.extract_block(PAGE, 'footer') == '    <p>{{ footer }}</p>\n'
+    assert mod.extract_block(PAGE, 'items').startswith('<ul>\n')
+    assert mod.extract_block(PAGE, 'items').endswith('</ul>\n')
+    assert mod.extract_block(PAGE, 'missing') is None
+
+
+def test_simple_template_engine_render_block(tmpdir):
+    tmpdir.join('page.tpl').write(PAGE)
+    engine = mod.SimpleTemplateEngine(lookup=[str(tmpdir)])
+    accessed = []
+
+    class Context(dict):
+        def __getitem__(self, key):
+            accessed.append(key)
+            return super(Context, self).__getitem__(key)
+
+    ctx = Context(items=[1, 2], footer='foot', title='title')
+    assert engine.render_block('page', 'items', ctx) == (
+        '<ul>\n    <li>1</li>\n    <li>2</li>\n    <p>foot</p>\n</ul>\n')
+    assert sorted(accessed) == ['footer', 'items']
+    full = engine('page', dict(ctx))
+    assert '<p>title</p>' in full and 'block' not in full
+    with pytest.raises(bottle.TemplateError):
+        engine.render_block('page', 'missing', ctx)
+
+
+def test_simple_template_engine_narrows_context(tmpdir):
+    tmpdir.join('partial.tpl').write('{{ a }}')
+    tmpdir.join('page.tpl').write('{{ a }}\n% include("partial")\n')
+    engine = mod.SimpleTemplateEngine(lookup=[str(tmpdir)])
+    lazy_context = LazyContext(None, {'a': 1, 'b': lazy(lambda r: 2)})
+    assert engine('partial', lazy_context) == '1'
+    assert not lazy_context.is_evaluated('b')
+    assert engine.render_template(engine.get_template('page'),
+                                  lazy_context) == '1\n1'
+    assert lazy_context.is_evaluated('b')
+    template = engine.get_template('page')
+    assert mod.get_context_names(template) is None
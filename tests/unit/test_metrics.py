@@ -0,0 +1,215 @@
+import threading
+
+import mock
+
+from streamline import metrics as mod
+
+
+MOD = mod.__name__
+
+
+def test_counters_merged_across_threads():
+    registry = mod.MetricsRegistry()
+    labels = (('route', 'foo'),)
+
+    def work():
+        for _ in range(100):
+            registry.inc('streamline_requests_total', labels)
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert registry.snapshot() == {('streamline_requests_total', labels): 400}
+    # Stores of finished threads are merged into the retired metrics
+    assert registry.stores == []
+    assert registry.retired == {('streamline_requests_total', labels): 400}
+    registry.inc('streamline_requests_total', labels)
+    assert registry.snapshot() == {('streamline_requests_total', labels): 401}
+
+
+def test_thread_per_request_stores_pruned():
+    registry = mod.MetricsRegistry()
+    for _ in range(50):
+        thread = threading.Thread(
+            target=registry.inc, args=('streamline_requests_total', ()))
+        thread.start()
+        thread.join()
+    assert len(registry.stores) <= 1
+    assert registry.snapshot() == {('streamline_requests_total', ()): 50}
+
+
+def test_histogram():
+    registry = mod.MetricsRegistry(time_buckets=(1, 2))
+    labels = (('route', 'foo'),)
+    for value in (0.5, 1.5, 3):
+        registry.observe('streamline_request_duration_seconds', labels,
+                         value, registry.time_buckets)
+    key = ('streamline_request_duration_seconds', labels)
+    assert registry.snapshot()[key] == [1, 1, 1, 5.0, 3]
+
+
+def test_render():
+    registry = mod.MetricsRegistry(time_buckets=(1,))
+    registry.inc('streamline_requests_total',
+                 (('route', 'a"b'), ('status', '200')), 2)
+    registry.observe('streamline_request_duration_seconds',
+                     (('route', 'foo'),), 0.5, registry.time_buckets)
+    assert registry.render() == '\n'.join([
+        '# HELP streamline_request_duration_seconds Time spent handling '
+        'requests.',
+        '# TYPE streamline_request_duration_seconds histogram',
+        'streamline_request_duration_seconds_bucket{route="foo",le="1"} 1',
+        'streamline_request_duration_seconds_bucket{route="foo",le="+Inf"} 1',
+        'streamline_request_duration_seconds_sum{route="foo"} 0.5',
+        'streamline_request_duration_seconds_count{route="foo"} 1',
+        '# HELP streamline_requests_total Total number of requests.',
+        '# TYPE streamline_requests_total counter',
+        'streamline_requests_total{route="a\\"b",status="200"} 2',
+    ]) + '\n'
+
+
+def test_multiprocess(tmpdir):
+    registry = mod.MetricsRegistry(multiprocess_dir=str(tmpdir))
+    labels = (('route', 'foo'),)
+    registry.inc('streamline_requests_total', labels, 3)
+    with mock.patch.object(mod.os, 'getpid', return_value=1):
+        registry.flush()
+    registry.inc('streamline_requests_total', labels, 2)
+    assert tmpdir.join('metrics-1.json').check()
+    assert registry.collect() == {('streamline_requests_total', labels): 8}
+
+
+def test_idle_process_flushed(tmpdir):
+    registry = mod.MetricsRegistry(multiprocess_dir=str(tmpdir),
+                                   flush_interval=0.01)
+    with mock.patch.object(mod.atexit, 'register') as register:
+        registry.inc('streamline_requests_total', (), 3)
+    path = tmpdir.join('metrics-{}.json'.format(mod.os.getpid()))
+    for _ in range(500):
+        if path.check():
+            break
+        threading.Event().wait(0.01)
+    assert path.check()
+    register.assert_called_once_with(registry.flush_at_exit,
+                                     mod.os.getpid())
+    registry.flusher_pid = None  # Stop the flusher thread
+    path.remove()
+    registry.flusher_pid = mod.os.getpid()
+    registry.flush_at_exit(mod.os.getpid())
+    assert path.check()
+    registry.flusher_pid = None
+
+
+def test_concurrent_flushes(tmpdir):
+    registry = mod.MetricsRegistry(multiprocess_dir=str(tmpdir),
+                                   flush_interval=0)
+    registry.flusher_pid = mod.os.getpid()  # Do not start the flusher
+    route = mock.Mock()
+    route.get_name.return_value = 'foo'
+    route.method = 'get'
+    route.form_is_valid = None
+    timing = mock.Mock(status=200, elapsed=0.1, size=10, phases=[])
+    errors = []
+
+    def work():
+        try:
+            for _ in range(300):
+                registry.observe_route(route, timing)
+        except Exception as exc:
+            errors.append(exc)
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    registry.flush()
+    assert [p.basename for p in tmpdir.listdir()] == [
+        'metrics-{}.json'.format(mod.os.getpid())]
+    key = ('streamline_requests_total',
+           (('route', 'foo'), ('method', 'GET'), ('status', '200')))
+    assert registry.collect()[key] == 2400
+
+
+def test_observe_route_ignores_flush_errors(tmpdir):
+    registry = mod.MetricsRegistry(
+        multiprocess_dir=str(tmpdir.join('missing')), flush_interval=0)
+    registry.flusher_pid = mod.os.getpid()
+    route = mock.Mock()
+    route.get_name.return_value = 'foo'
+    route.method = 'get'
+    route.form_is_valid = None
+    timing = mock.Mock(status=200, elapsed=0.1, size=10, phases=[])
+    registry.observe_route(route, timing)
+    assert registry.snapshot()[('streamline_requests_total', (
+        ('route', 'foo'), ('method', 'GET'), ('status', '200')))] == 1
+
+
+def test_reset_after_fork():
+    registry = mod.MetricsRegistry()
+    registry.inc('streamline_requests_total', ())
+    registry.pid = -1
+    registry.inc('streamline_requests_total', ())
+    assert registry.snapshot() == {('streamline_requests_total', ()): 1}
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+@mock.patch.object(mod.RouteBase, 'response')
+def test_route_metrics(response, request):
+    registry = mod.MetricsRegistry()
+    request.method = 'GET'
+    response.status_code = 200
+    response.headers = {}
+
+    class Foo(mod.RouteBase):
+        name = 'foo'
+
+        def get(self):
+            return b'hello'
+
+    mod.install(registry, Foo)
+    assert list(Foo()) == [b'hello']
+    metrics = registry.snapshot()
+    key = ('streamline_requests_total',
+           (('route', 'foo'), ('method', 'GET'), ('status', '200')))
+    assert metrics[key] == 1
+    size = metrics[('streamline_response_size_bytes', (('route', 'foo'),))]
+    assert size[-2:] == [5, 1]
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+def test_route_metrics_error(request):
+    import bottle
+    registry = mod.MetricsRegistry()
+    request.method = 'POST'
+
+    class Foo(mod.RouteBase):
+        name = 'foo'
+        metrics = registry
+
+        def get(self):
+            pass
+    try:
+        iter(Foo())
+    except bottle.HTTPError:
+        pass
+    key = ('streamline_requests_total',
+           (('route', 'foo'), ('method', 'POST'), ('status', '405')))
+    assert registry.snapshot()[key] == 1
+
+
+@mock.patch.object(mod.RouteBase, 'request')
+def test_metrics_route(request):
+    request.method = 'GET'
+    registry = mod.MetricsRegistry()
+    registry.inc('streamline_requests_total', ())
+
+    class Foo(mod.MetricsRoute):
+        pass
+    Foo.get_registry = lambda self: registry
+    f = Foo()
+    with mock.patch.object(Foo, 'response') as response:
+        f.create_response()
+        assert response.content_type == Foo.content_type
+    assert 'streamline_requests_total 1' in f.body
@@ -1,3 +1,4 @@
+import bottle
 import mock
 import pytest
 
@@ -181,8 +182,245 @@ def test_roca_sets_cache_control_header_for_xhr(response, request):
     request.is_xhr = True
     response.headers = {}
     f.create_response()
-    assert response.headers == {'Cache-Control': 'no-store'}
+    assert response.headers == {'Cache-Control': 'no-store',
+                                'Vary': 'X-Requested-With'}
     request.is_xhr = False
     response.headers = {}
     f.create_response()
-    assert response.headers == {}
+    assert response.headers == {'Vary': 'X-Requested-With'}
+
+
+@mock.patch.object(mod.XHRPartialRoute, 'request')
+@mock.patch.object(mod.XHRPartialRoute, 'response')
+def test_roca_xhr_cache_control(response, request):
+    class Foo(mod.XHRPartialRoute):
+        def get(self):
+            self.response.headers['Vary'] = 'Cookie'
+        template_name = 'foo'
+        partial_template_name = 'bar'
+        template_func = mock.Mock()
+        xhr_cache_control = 'private, max-age=60'
+    f = Foo()
+    request.method = 'GET'
+    request.is_xhr = True
+    response.headers = {'Vary': 'Accept-Encoding'}
+    f.create_response()
+    assert response.headers == {'Cache-Control': 'private, max-age=60',
+                                'Vary': 'Cookie, X-Requested-With'}
+    Foo.xhr_cache_control = None
+    response.headers = {'Vary': 'Accept-Encoding'}
+    Foo().create_response()
+    assert 'Cache-Control' not in response.headers
+
+
+def test_render_template_records_timing():
+    from streamline.timing import Timing
+
+    class Foo(mod.TemplateMixin):
+        template_name = 'foo'
+        template_func = mock.Mock(return_value='rendered')
+        body = {}
+    f = Foo()
+    f.timing = Timing()
+    assert f.render_template() == 'rendered'
+    assert [name for name, _ in f.timing.phases] == ['context', 'render']
+
+
+def test_minify_html():
+    source = (
+        '<div>\n'
+        '    <p>Hello    {{ "a  b" }}</p>\n'
+        '\n'
+        '    % if True:\n'
+        '        <pre>\n  keep  </pre>\n'
+        '    % end\n'
+        '</div>\n')
+    assert mod.minify_html(source) == (
+        '<div>\n'
+        '<p>Hello {{ "a  b" }}</p>\n'
+        '% if True:\n'
+        '<pre>\n  keep  </pre>\n'
+        '% end\n'
+        '</div>\n')
+
+
+def test_minified_template(tmpdir):
+    tmpdir.join('page.tpl').write('<ul>\n'
+                                  '    % for i in items:\n'
+                                  '        <li>{{ i }}</li>\n'
+                                  '    % end\n'
+                                  '</ul>\n')
+    lookup = [str(tmpdir)]
+    ret = mod.minified_template('page', {'items': [1, 2]},
+                                template_lookup=lookup)
+    assert ret == '<ul>\n<li>1</li>\n<li>2</li>\n</ul>\n'
+    template = mod.MINIFIED_TEMPLATES[(id(lookup), 'page')]
+    assert template.source.startswith('<ul>\n% for')
+
+
+@mock.patch.dict(bottle.TEMPLATES)
+def test_preload_templates_on_route(tmpdir):
+    tmpdir.join('full.tpl').write('full {{ x }}')
+    tmpdir.join('partial.tpl').write('partial')
+    app = bottle.Bottle()
+
+    class Foo(mod.XHRPartialRoute):
+        path = '/foo'
+        template_name = 'full'
+        partial_template_name = 'partial'
+        preload_templates = True
+
+        def get(self):
+            return {'x': 1}
+
+    with mock.patch.object(bottle, 'TEMPLATE_PATH', [str(tmpdir)]):
+        Foo.route(app=app)
+        template = bottle.TEMPLATES[(id(bottle.TEMPLATE_PATH), 'full')]
+        assert 'co' in template.__dict__
+        assert set(mod.template_load_times) >= set(['full', 'partial'])
+        assert bottle.template('full', x=1) == 'full 1'
+        assert template is bottle.TEMPLATES[(id(bottle.TEMPLATE_PATH),
+                                             'full')]
+        assert set(mod.warm_up(app)) == set(['full', 'partial'])
+
+
+@mock.patch.dict(bottle.TEMPLATES)
+def test_preload_missing_template(tmpdir):
+    class Foo(mod.TemplateRoute):
+        path = '/foo'
+        template_name = 'missing'
+        preload_templates = True
+
+        def get(self):
+            return {}
+
+    with mock.patch.object(bottle, 'TEMPLATE_PATH', [str(tmpdir)]):
+        with pytest.raises(bottle.TemplateError):
+            Foo.route(app=bottle.Bottle())
+
+
+def test_preload_unknown_template_func():
+    class Foo(mod.TemplateMixin):
+        template_name = 'foo'
+        template_func = mock.Mock()
+
+    with pytest.raises(ValueError):
+        Foo.load_templates()
+
+
+@mock.patch.dict(bottle.TEMPLATES)
+def test_cached_template_func(tmpdir):
+    tmpdir.join('page.tpl').write('<p>{{ x }}</p>')
+    cache_dir = tmpdir.join('cache')
+    lookup = [str(tmpdir)]
+    template = mod.cached_template_func(str(cache_dir))
+    assert template('page', x=1, template_lookup=lookup) == '<p>1</p>'
+    files = cache_dir.listdir()
+    assert len(files) == 1
+    assert files[0].basename.endswith(mod.CACHE_TAG + '.code')
+    # A new process loads the code instead of compiling it
+    _, templates = template.template_loader
+    templates.clear()
+    with mock.patch.object(bottle.SimpleTemplate, 'co') as co:
+        assert template('page', x=2, template_lookup=lookup) == '<p>2</p>'
+    assert not co.func.called
+    # Changed source is compiled again and replaces the old code
+    tmpdir.join('page.tpl').write('<b>{{ x }}</b>')
+    templates.clear()
+    assert template('page', x=3, template_lookup=lookup) == '<b>3</b>'
+    assert len(cache_dir.listdir()) == 1
+    assert cache_dir.listdir() != files
+
+
+@mock.patch.dict(bottle.TEMPLATES)
+def test_cached_template_func_separate_cache(tmpdir):
+    tmpdir.join('page.tpl').write('<p>\n  {{ x }}\n</p>')
+    cache_dir = tmpdir.join('cache')
+    lookup = [str(tmpdir)]
+    template = mod.cached_template_func(str(cache_dir),
+                                        mod.MinifiedSimpleTemplate)
+    plain = bottle.template('page', x=1, template_lookup=lookup)
+    assert plain == '<p>\n  1\n</p>'
+    assert template('page', x=1, template_lookup=lookup) == '<p>\n1\n</p>'
+    assert len(cache_dir.listdir()) == 1
+    assert bottle.template('page', x=1, template_lookup=lookup) == plain
+
+
+def test_cached_template_func_preload(tmpdir):
+    tmpdir.join('page.tpl').write('{{ x }}')
+    template = mod.cached_template_func(str(tmpdir.join('cache')))
+    adapter, templates = mod.get_template_loader(template)
+    with mock.patch.object(bottle, 'TEMPLATE_PATH', [str(tmpdir)]):
+        mod.load_template('page', template)
+        assert len(templates) == 1
+        assert template('page', x=1) == '1'
+    assert len(templates) == 1
+
+
+def test_streaming_template_route():
+    from streamline.engines import TemplateEngine
+
+    rendered = []
+
+    class Engine(TemplateEngine):
+        def get_template(self, name):
+            return name
+
+        def stream_template(self, template, context):
+            for chunk in ('<html><head>', '</head>', '<body>',
+                          context['x'], '</body></html>'):
+                rendered.append(chunk)
+                yield chunk
+
+    class Foo(mod.StreamingTemplateRoute):
+        template_name = 'foo'
+        template_engine = Engine
+
+        def get(self):
+            return {'x': 'content'}
+
+    request = bottle.BaseRequest({'REQUEST_METHOD': 'GET',
+                                  'bottle.app': bottle.Bottle()})
+    with mock.patch.object(Foo, 'request', request):
+        with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+            chunks = iter(Foo())
+            assert next(chunks) == b'<html><head></head>'
+            assert rendered == ['<html><head>', '</head>']
+            assert list(chunks) == [b'<body>content</body></html>']
+
+
+def test_render_template_stream_without_engine():
+    class Foo(mod.TemplateMixin):
+        template_name = 'foo'
+        template_func = mock.Mock(return_value='rendered')
+        stream_template = True
+        body = {}
+    assert list(Foo().render_template()) == ['rendered']
+
+
+def test_roca_renders_block_on_xhr(tmpdir):
+    tmpdir.join('page.tpl').write('<h1>{{ title }}</h1>\n'
+                                  '% # block content\n'
+                                  '<p>{{ text }}</p>\n'
+                                  '% # endblock\n')
+    app = bottle.Bottle()
+
+    class Foo(mod.XHRPartialRoute):
+        template_name = 'page'
+        partial_block_name = 'content'
+
+        def get(self):
+            return {'title': 'Title', 'text': 'Text'}
+
+    def render(xhr):
+        environ = {'REQUEST_METHOD': 'GET', 'bottle.app': app}
+        if xhr:
+            environ['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+        with mock.patch.object(Foo, 'request', bottle.BaseRequest(environ)):
+            with mock.patch.object(Foo, 'response', bottle.BaseResponse()):
+                return b''.join(Foo())
+
+    with mock.patch.object(bottle, 'TEMPLATE_PATH', [str(tmpdir)]):
+        with mock.patch.dict(bottle.TEMPLATES):
+            assert render(False) == b'<h1>Title</h1>\n<p>Text</p>\n'
+        assert render(True) == b'<p>Text</p>\n'
@@ -0,0 +1,28 @@
+from streamline import timing as mod
+
+
+MOD = mod.__name__
+
+
+def test_timing_add():
+    t = mod.Timing()
+    t.add('init', 0.5)
+    t.add('handler', 1.0)
+    t.add('handler', 0.25)
+    assert t.phases == [('init', 0.5), ('handler', 1.0), ('handler', 0.25)]
+    assert t.get('handler') == 1.25
+    assert t.total == 1.75
+
+
+def test_timing_header():
+    t = mod.Timing()
+    t.add('init', 0.0005)
+    t.add('before.<lambda>', 0.002)
+    assert t.as_header() == 'init;dur=0.500, before._lambda_;dur=2.000'
+
+
+def test_get_hook_name():
+    def auth_hook(route):
+        pass
+    assert mod.get_hook_name(auth_hook) == 'auth_hook'
+    assert mod.get_hook_name(lambda r: None) == '_lambda_'